@@ -18,16 +18,20 @@
 
 An AAR may contain resources under the /res directory. This tool extracts all
 of the resources into a directory. If no resources exist, it creates an
-empty.xml file that defines no resources.
-
-In the future, this script may be extended to also extract assets.
+empty.xml file that defines no resources. It can also extract assets and
+databinding metadata, in the same pass over the AAR.
 """
 
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+from concurrent import futures
+import multiprocessing
 import os
+import re
+import shutil
 import sys
 import zipfile
 
@@ -51,29 +55,54 @@ flags.DEFINE_string("output_databinding_setter_store_dir", None,
                     "Output directory for databinding setter_store.json files")
 
 
-def ExtractResources(aar, output_res_dir):
-  """Extract resource from an `aar` file to the `output_res_dir` directory."""
-  aar_contains_no_resources = True
-  output_res_dir_abs = os.path.abspath(output_res_dir)
-  for name in aar.namelist():
-    if name.startswith("res/") and not name.endswith("/"):
-      ExtractOneFile(aar, name, output_res_dir_abs)
-      aar_contains_no_resources = False
-  if aar_contains_no_resources:
+# Matches the entries to extract. Exactly one group matches, which is the
+# index + 1 of the output the entry goes to: resources, assets, databinding br
+# files or databinding setter stores.
+_ENTRY_PATTERN = re.compile(
+    r"(?s)(?:(res)/.*[^/]|(assets)/.*[^/]|"
+    r"data-binding/.*(?:(br\.bin)|(setter_store\.json)))\Z")
+
+
+def Extract(aar,
+            output_res_dir=None,
+            output_assets_dir=None,
+            output_databinding_br_dir=None,
+            output_databinding_setter_store_dir=None):
+  """Extracts files from an `aar` file to output directories.
+
+  Entries are classified in one pass over the `aar`, and all outputs are
+  written concurrently. Outputs whose directory is None aren't extracted.
+
+  Args:
+    aar: The AAR, as a ZipFile.
+    output_res_dir: Directory to extract resources to. Gets an empty.xml if
+      there are no resources.
+    output_assets_dir: Directory to extract assets to. Gets a placeholder file
+      if there are no assets.
+    output_databinding_br_dir: Directory to extract databinding br files to.
+    output_databinding_setter_store_dir: Directory to extract databinding
+      setter_store.json files to.
+  """
+  output_dirs = (output_res_dir, output_assets_dir, output_databinding_br_dir,
+                 output_databinding_setter_store_dir)
+  abs_output_dirs = [
+      os.path.abspath(d) if d is not None else None for d in output_dirs
+  ]
+  files = []
+  extracted = [False] * len(output_dirs)
+  for info in aar.infolist():
+    match = _ENTRY_PATTERN.match(info.filename)
+    if match and output_dirs[match.lastindex - 1] is not None:
+      abs_output_dir = abs_output_dirs[match.lastindex - 1]
+      files.append((info, _OutputPath(abs_output_dir, info.filename)))
+      extracted[match.lastindex - 1] = True
+  ExtractFiles(aar, files)
+
+  if output_res_dir is not None and not extracted[0]:
     empty_xml_filename = six.ensure_str(
         output_res_dir) + "/res/values/empty.xml"
     WriteFileWithJunctions(empty_xml_filename, b"<resources/>")
-
-
-def ExtractAssets(aar, output_assets_dir):
-  """Extracts assets from an `aar` file to the `output_assets_dir` directory."""
-  aar_contains_no_assets = True
-  output_assets_dir_abs = os.path.abspath(output_assets_dir)
-  for name in aar.namelist():
-    if name.startswith("assets/") and not name.endswith("/"):
-      ExtractOneFile(aar, name, output_assets_dir_abs)
-      aar_contains_no_assets = False
-  if aar_contains_no_assets:
+  if output_assets_dir is not None and not extracted[1]:
     # aapt will ignore this file and not print an error message, because it
     # thinks that it is a swap file. We need to create at least one file so that
     # Bazel does not complain that the output tree artifact was not created.
@@ -83,12 +112,84 @@ def ExtractAssets(aar, output_assets_dir):
     WriteFileWithJunctions(empty_asset_filename, b"")
 
 
+def ExtractResources(aar, output_res_dir):
+  """Extract resource from an `aar` file to the `output_res_dir` directory."""
+  Extract(aar, output_res_dir=output_res_dir)
+
+
+def ExtractAssets(aar, output_assets_dir):
+  """Extracts assets from an `aar` file to the `output_assets_dir` directory."""
+  Extract(aar, output_assets_dir=output_assets_dir)
+
+
 def ExtractDatabinding(aar, file_suffix, output_databinding_dir):
   """Extracts databinding metadata files from an `aar`."""
   output_databinding_dir_abs = os.path.abspath(output_databinding_dir)
-  for name in aar.namelist():
-    if name.startswith("data-binding/") and name.endswith(file_suffix):
-      ExtractOneFile(aar, name, output_databinding_dir_abs)
+  ExtractFiles(aar, [
+      (info, _OutputPath(output_databinding_dir_abs, info.filename))
+      for info in aar.infolist()
+      if info.filename.startswith("data-binding/") and
+      info.filename.endswith(file_suffix)
+  ])
+
+
+def _OutputPath(abs_output_dir, name):
+  """Returns where to extract an entry to, like ZipFile.extract would."""
+  # Drop empty, "." and ".." components so entries can't escape the output
+  # directory.
+  parts = [part for part in name.split("/") if part not in ("", ".", "..")]
+  return os.path.join(abs_output_dir, *parts)
+
+
+def _Map(function, items):
+  """Applies function to all items, concurrently if possible."""
+  # Python 2's ZipFile can't be read from several threads.
+  if six.PY2 or len(items) <= 1:
+    for item in items:
+      function(item)
+  else:
+    with futures.ThreadPoolExecutor(
+        max_workers=min(len(items), multiprocessing.cpu_count())) as executor:
+      # Consume the results to propagate exceptions.
+      list(executor.map(function, items))
+
+
+def ExtractFiles(aar, files):
+  """Extracts files from an `aar`, concurrently.
+
+  Args:
+    aar: The AAR, as a ZipFile.
+    files: List of (ZipInfo, absolute output path) of the files to extract.
+  """
+  by_dir = collections.OrderedDict()
+  for info, path in files:
+    by_dir.setdefault(os.path.dirname(path), []).append((info, path))
+
+  if os.name == "nt":
+    # Create one junction per directory, because its path might be too long.
+    # Creating the junction also creates all parent directories.
+    def _ExtractDir(item):
+      dirname, dir_files = item
+      with junction.TempJunction(dirname) as junc:
+        for info, path in dir_files:
+          _ExtractFile(aar, info, os.path.join(junc, os.path.basename(path)))
+
+    _Map(_ExtractDir, list(by_dir.items()))
+  else:
+    for dirname in by_dir:
+      if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    _Map(lambda item: _ExtractFile(aar, *item), files)
+
+
+def _ExtractFile(aar, info, path):
+  """Extracts one entry of the `aar` to path, whose directory must exist."""
+  # Open the compressed entry as a file object, so this works even on a
+  # junction. The tradeoff is that we lose the permission bits of the
+  # compressed file, but extract() doesn't restore them either.
+  with aar.open(info) as src_fd:
+    with open(path, "wb") as dest_fd:
+      shutil.copyfileobj(src_fd, dest_fd)
 
 
 def WriteFileWithJunctions(filename, content):
@@ -110,45 +211,11 @@ def WriteFileWithJunctions(filename, content):
     _WriteFile(filename)
 
 
-def ExtractOneFile(aar, name, abs_output_dir):
-  """Extract one file from the aar to the output directory."""
-  if os.name == "nt":
-    fullpath = os.path.normpath(os.path.join(abs_output_dir, name))
-    if name[-1] == "/":
-      # The zip entry is a directory. Create a junction to it, which also
-      # takes care of creating the directory and all of its parents in a
-      # longpath-safe manner.
-      # We must pretend to have extracted this directory, even if it's
-      # empty, therefore we mustn't rely on creating it as a parent
-      # directory of a subsequently extracted zip entry (because there may
-      # be no such subsequent entry).
-      with junction.TempJunction(fullpath.rstrip("/")) as juncpath:
-        pass
-    else:
-      # The zip entry is a file. Create a junction to its parent directory,
-      # then open the compressed entry as a file object, so we can extract
-      # the data even if the extracted file's path would be too long.
-      # The tradeoff is that we lose the permission bits of the compressed
-      # file, but Unix permissions don't mean much on Windows anyway.
-      with junction.TempJunction(os.path.dirname(fullpath)) as juncpath:
-        extracted_path = os.path.join(juncpath, os.path.basename(fullpath))
-        with aar.open(name) as src_fd:
-          with open(extracted_path, "wb") as dest_fd:
-            dest_fd.write(src_fd.read())
-  else:
-    aar.extract(name, abs_output_dir)
-
-
 def main(unused_argv):
   with zipfile.ZipFile(FLAGS.input_aar, "r") as aar:
-    ExtractResources(aar, FLAGS.output_res_dir)
-    if FLAGS.output_assets_dir is not None:
-      ExtractAssets(aar, FLAGS.output_assets_dir)
-    if FLAGS.output_databinding_br_dir is not None:
-      ExtractDatabinding(aar, "br.bin", FLAGS.output_databinding_br_dir)
-    if FLAGS.output_databinding_setter_store_dir is not None:
-      ExtractDatabinding(aar, "setter_store.json",
-                         FLAGS.output_databinding_setter_store_dir)
+    Extract(aar, FLAGS.output_res_dir, FLAGS.output_assets_dir,
+            FLAGS.output_databinding_br_dir,
+            FLAGS.output_databinding_setter_store_dir)
 
 
 if __name__ == "__main__":
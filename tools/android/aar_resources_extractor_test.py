@@ -138,6 +138,40 @@ class AarResourcesExtractorTest(unittest.TestCase):
     with open("out_dir/setter_store/" + setter_store_filepath, "r") as f:
       self.assertEqual("setter store data", f.read())
 
+  def testExtractsAllOutputsInOnePass(self):
+    aar = zipfile.ZipFile(io.BytesIO(), "w")
+    aar.writestr("res/values/values.xml", "some values")
+    aar.writestr("res/layouts/layout.xml", "some layout")
+    aar.writestr("assets/a", "some asset")
+    aar.writestr("data-binding/lib--br.bin", "br data")
+    aar.writestr("data-binding/lib--setter_store.json", "setter store data")
+    aar.writestr("classes.jar", "classes")
+    aar.writestr("res/../../escaped", "escaped")
+
+    aar_resources_extractor.Extract(aar, "out_dir/res", "out_dir/assets",
+                                    "out_dir/br", "out_dir/setter_store")
+    self.assertCountEqual([
+        _HostPath("out_dir/res/res/values/values.xml"),
+        _HostPath("out_dir/res/res/layouts/layout.xml"),
+        _HostPath("out_dir/res/res/escaped"),
+        _HostPath("out_dir/assets/assets/a"),
+        _HostPath("out_dir/br/data-binding/lib--br.bin"),
+        _HostPath("out_dir/setter_store/data-binding/lib--setter_store.json"),
+    ], self.DirContents("out_dir"))
+    with open("out_dir/res/res/values/values.xml", "r") as values_xml:
+      self.assertEqual("some values", values_xml.read())
+    with open("out_dir/br/data-binding/lib--br.bin", "r") as f:
+      self.assertEqual("br data", f.read())
+
+  def testExtractWritesPlaceholders(self):
+    aar = zipfile.ZipFile(io.BytesIO(), "w")
+    aar.writestr("classes.jar", "classes")
+    aar_resources_extractor.Extract(aar, "out_dir/res", "out_dir/assets")
+    self.assertCountEqual([
+        _HostPath("out_dir/res/res/values/empty.xml"),
+        _HostPath("out_dir/assets/assets/empty_asset_generated_by_bazel~"),
+    ], self.DirContents("out_dir"))
+
 
 if __name__ == "__main__":
   unittest.main()
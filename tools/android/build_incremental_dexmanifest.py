@@ -14,8 +14,8 @@
 
 """Construct a dex manifest from a set of input .dex.zip files.
 
-Usage: %s <output manifest> <input zip file>*
-       %s @<params file>
+Usage: %s [--checksum_cache=<file>] <output manifest> <input zip file>*
+       %s [--checksum_cache=<file>] @<params file>
 
 Input files must be either .zip files containing one or more .dex files or
 .dex files.
@@ -28,60 +28,75 @@ following form:
 or
 
 <input dex> - <path in output zip> <SHA-256 checksum>
+
+With --checksum_cache, checksums of unchanged inputs are read from and saved to
+the given file, see checksum_cache.py. The file must be outside of any sandbox
+to be of use across actions.
 """
 
-import hashlib
-import os
-import shutil
+from concurrent import futures
 import sys
-import tempfile
 import zipfile
 
+from tools.android import checksum_cache
+
 
 class DexmanifestBuilder(object):
   """Implementation of the dex manifest builder."""
 
-  def __init__(self):
+  def __init__(self, checksums=None):
+    """Creates a builder.
+
+    Args:
+      checksums: The ChecksumCache to compute checksums with. Defaults to an
+        in-memory one.
+    """
     self.manifest_lines = []
-    self.dir_counter = 1
     self.output_dex_counter = 1
     self.checksums = set()
-    self.tmpdir = None
+    if checksums is None:
+      checksums = checksum_cache.ChecksumCache()
+    self.checksum_cache = checksums
+
+  def ZipChecksums(self, input_filename):
+    """Computes the checksums of the dexes in a .zip file.
 
-  def __enter__(self):
-    self.tmpdir = tempfile.mkdtemp()
-    return self
+    Dexes are hashed as they are decompressed, without extracting them. Those
+    whose checksum is cached aren't even read.
 
-  def __exit__(self, unused_type, unused_value, unused_traceback):
-    shutil.rmtree(self.tmpdir, True)
+    Args:
+      input_filename: the .zip file
 
-  def Checksum(self, filename):
-    """Compute the SHA-256 checksum of a file."""
-    h = hashlib.sha256()
-    with open(filename, "rb") as f:
-      while True:
-        data = f.read(65536)
-        if not data:
-          break
+    Returns:
+      A list of (path in zip, checksum) for the dexes, in zip order.
+    """
+    result = []
+    with zipfile.ZipFile(input_filename, "r") as input_dex_zip:
+      for input_dex_dex in input_dex_zip.namelist():
+        if not input_dex_dex.endswith(".dex"):
+          continue
 
-        h.update(data)
+        def Hash(input_dex_dex=input_dex_dex):
+          with input_dex_zip.open(input_dex_dex) as dex:
+            return checksum_cache.Sha256Stream(dex)
 
-    return h.hexdigest()
+        result.append((input_dex_dex, self.checksum_cache.Get(
+            input_filename, Hash, member=input_dex_dex)))
+    return result
 
-  def AddDex(self, input_dex_or_zip, zippath, dex):
+  def AddDex(self, input_dex_or_zip, zippath, fs_checksum):
     """Adds a dex file to the output.
 
     Args:
       input_dex_or_zip: the input file written to the manifest
       zippath: the zip path written to the manifest or None if the input file
           is not a .zip .
-      dex: the dex file to be added
+      fs_checksum: the checksum of the dex file to be added
 
     Returns:
       None.
     """
 
-    fs_checksum = self.Checksum(dex)
     if fs_checksum in self.checksums:
       return
 
@@ -102,31 +117,38 @@ class DexmanifestBuilder(object):
       with open(argv[0][1:]) as param_file:
         argv = [a.strip() for a in param_file.readlines()]
 
-    for input_filename in argv[1:]:
-      input_filename = input_filename.strip()
-      if input_filename.endswith(".zip"):
-        with zipfile.ZipFile(input_filename, "r") as input_dex_zip:
-          input_dex_dir = os.path.join(self.tmpdir, str(self.dir_counter))
-          os.makedirs(input_dex_dir)
-          self.dir_counter += 1
-
-          for input_dex_dex in input_dex_zip.namelist():
-            if not input_dex_dex.endswith(".dex"):
-              continue
-
-            input_dex_zip.extract(input_dex_dex, input_dex_dir)
-            fs_dex = input_dex_dir + "/" + input_dex_dex
-            self.AddDex(input_filename, input_dex_dex, fs_dex)
-      elif input_filename.endswith(".dex"):
-        self.AddDex(input_filename, None, input_filename)
-
+    # Inputs are checksummed in parallel, but added to the manifest in order so
+    # that the output is deterministic.
+    with futures.ThreadPoolExecutor(
+        max_workers=checksum_cache.DefaultJobs()) as executor:
+      inputs = []
+      for input_filename in argv[1:]:
+        input_filename = input_filename.strip()
+        if input_filename.endswith(".zip"):
+          inputs.append((input_filename, executor.submit(
+              self.ZipChecksums, input_filename)))
+        elif input_filename.endswith(".dex"):
+          inputs.append((input_filename, executor.submit(
+              self.checksum_cache.Checksum, input_filename)))
+
+      for input_filename, checksums in inputs:
+        if input_filename.endswith(".zip"):
+          for input_dex_dex, fs_checksum in checksums.result():
+            self.AddDex(input_filename, input_dex_dex, fs_checksum)
+        else:
+          self.AddDex(input_filename, None, checksums.result())
+
+    self.checksum_cache.Save()
     with open(argv[0], "wb") as manifest:
       manifest.write(("\n".join(self.manifest_lines)).encode("utf-8"))
 
 
 def main(argv):
-  with DexmanifestBuilder() as b:
-    b.Run(argv[1:])
+  args = argv[1:]
+  cache_path = None
+  if args and args[0].startswith("--checksum_cache="):
+    cache_path = args.pop(0)[len("--checksum_cache="):]
+  DexmanifestBuilder(checksum_cache.ChecksumCache(cache_path)).Run(args)
 
 
 if __name__ == "__main__":
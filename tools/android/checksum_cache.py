@@ -0,0 +1,250 @@
+# Lint as: python2, python3
+# pylint: disable=g-direct-third-party-import
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A persistent cache of SHA-256 checksums of files.
+
+Entries are keyed by absolute path and validated against the file's size,
+modification time and inode, so unchanged files are never read again. Entries
+may also describe a member of a zip file, in which case they are validated
+against the zip file.
+
+The cache file is a log of JSON entries, one per line. Saving only appends the
+entries that changed; the log is rewritten without outdated entries once it
+grows to several times the number of entries. A lost or torn update merely
+costs a re-hash.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from concurrent import futures
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+
+# Name of the cache file in the output base.
+CACHE_FILENAME = "android_checksum_cache.json"
+
+# Maximum number of threads to hash files with by default. The tools run next
+# to other build actions, so they shouldn't take all CPUs.
+MAX_JOBS = 4
+
+# The log is rewritten when it has more lines than this many times the number
+# of entries, and at least _MIN_COMPACTION_LINES lines.
+_COMPACTION_RATIO = 2
+_MIN_COMPACTION_LINES = 1000
+
+
+def Sha256(filename):
+  """Compute the SHA-256 checksum of a file."""
+  with open(filename, "rb") as f:
+    return Sha256Stream(f)
+
+
+def Sha256Stream(stream):
+  """Compute the SHA-256 checksum of the rest of a binary stream."""
+  h = hashlib.sha256()
+  while True:
+    data = stream.read(65536)
+    if not data:
+      break
+
+    h.update(data)
+
+  return h.hexdigest()
+
+
+def OutputBaseCachePath(execroot):
+  """Returns where to keep the cache for a given execroot.
+
+  Args:
+    execroot: The execroot, which is <output base>/execroot/<workspace name>.
+
+  Returns:
+    The path of the cache file in the output base, or None if execroot doesn't
+    look like an execroot.
+  """
+  execroot = os.path.abspath(execroot)
+  parent = os.path.dirname(execroot)
+  if os.path.basename(parent) != "execroot":
+    return None
+  return os.path.join(os.path.dirname(parent), CACHE_FILENAME)
+
+
+class ChecksumCache(object):
+  """A cache of file checksums, optionally persisted to a file.
+
+  Lookups are thread-safe.
+  """
+
+  def __init__(self, path=None):
+    """Creates a cache.
+
+    Args:
+      path: The file to load the cache from and save it to. If None, the cache
+        is only kept in memory.
+    """
+    self._path = path
+    self._lock = threading.Lock()
+    # Maps "<path>" or "<zip path>!<member>" -> [size, mtime, inode, checksum].
+    self._entries = {}
+    # The entries that changed since the cache was loaded or saved.
+    self._changed = {}
+    # The number of lines in the cache file, and whether any is corrupt.
+    self._lines = 0
+    self._corrupt = False
+    if path:
+      try:
+        with open(path, "r") as f:
+          for line in f:
+            self._lines += 1
+            self._LoadLine(line)
+      except (IOError, OSError):
+        # A missing cache is just empty.
+        pass
+
+  def _LoadLine(self, line):
+    """Loads an entry written by Save."""
+    try:
+      entry = json.loads(line)
+    except ValueError:
+      entry = None
+    if not (isinstance(entry, list) and len(entry) == 5):
+      # Torn appends and older formats are dropped when the log is rewritten.
+      self._corrupt = True
+      return
+    self._entries[entry[0]] = entry[1:]
+
+  def Get(self, filename, compute, member=None):
+    """Returns the checksum of a file, computing it if it's not cached.
+
+    Args:
+      filename: The file, whose size, modification time and inode validate the
+        entry.
+      compute: Function without arguments that computes the checksum.
+      member: If set, the entry is for this member of the zip file filename.
+
+    Returns:
+      The checksum.
+    """
+    key = os.path.abspath(filename)
+    if member is not None:
+      key += "!" + member
+    # Stat before computing so that the entry goes stale if the file changes
+    # while we read it.
+    st = os.stat(filename)
+    stamp = [st.st_size, st.st_mtime, st.st_ino]
+    with self._lock:
+      entry = self._entries.get(key)
+    if entry is not None and entry[:3] == stamp:
+      return entry[3]
+
+    checksum = compute()
+    with self._lock:
+      self._entries[key] = self._changed[key] = stamp + [checksum]
+    return checksum
+
+  def Checksum(self, filename):
+    """Returns the SHA-256 checksum of a file."""
+    return self.Get(filename, lambda: Sha256(filename))
+
+  def Checksums(self, filenames, jobs=None):
+    """Returns the SHA-256 checksums of several files.
+
+    Files that aren't cached are hashed in parallel.
+
+    Args:
+      filenames: The files to checksum.
+      jobs: The number of threads to hash with. Defaults to the number of CPUs,
+        up to MAX_JOBS.
+
+    Returns:
+      A list of checksums, in the same order as filenames.
+    """
+    filenames = list(filenames)
+    if len(filenames) <= 1:
+      return [self.Checksum(filename) for filename in filenames]
+    with futures.ThreadPoolExecutor(
+        max_workers=jobs or DefaultJobs()) as executor:
+      return list(executor.map(self.Checksum, filenames))
+
+  def Save(self):
+    """Writes the changed entries to the cache file, if there is one.
+
+    Failures are ignored: the cache is only an optimization.
+    """
+    if not self._path:
+      return
+    with self._lock:
+      changed = self._changed
+      self._changed = {}
+      lines = self._lines + len(changed)
+      compact = self._corrupt or (
+          lines >= _MIN_COMPACTION_LINES and
+          lines > _COMPACTION_RATIO * len(self._entries))
+      if compact:
+        changed = dict(self._entries)
+    if not changed:
+      return
+    try:
+      if compact:
+        self._Rewrite(changed)
+      else:
+        # A single write, so concurrent appends don't interleave.
+        with open(self._path, "a") as f:
+          f.write("".join(
+              json.dumps([key] + entry) + "\n"
+              for key, entry in changed.items()))
+        self._lines = lines
+    except (IOError, OSError):
+      pass
+
+  def _Rewrite(self, entries):
+    """Replaces the cache file with entries of files that still exist."""
+    entries = dict((key, entry) for key, entry in entries.items()
+                   if os.path.exists(key.split("!", 1)[0]))
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(self._path), prefix=CACHE_FILENAME)
+    try:
+      with os.fdopen(fd, "w") as f:
+        for key, entry in entries.items():
+          f.write(json.dumps([key] + entry) + "\n")
+      _Replace(temp_path, self._path)
+    except (IOError, OSError):
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+      raise
+    self._lines = len(entries)
+    self._corrupt = False
+
+
+def DefaultJobs():
+  """Returns the default number of threads to hash files with."""
+  return min(MAX_JOBS, multiprocessing.cpu_count())
+
+
+def _Replace(src, dst):
+  """Atomically replaces dst with src, where the platform allows."""
+  if hasattr(os, "replace"):
+    os.replace(src, dst)
+  else:
+    # Python 2 can't atomically replace files on Windows.
+    if os.name == "nt" and os.path.exists(dst):
+      os.remove(dst)
+    os.rename(src, dst)
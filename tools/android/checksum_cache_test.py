@@ -0,0 +1,155 @@
+# Lint as: python2, python3
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for checksum_cache."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import os
+import tempfile
+import unittest
+
+from tools.android import checksum_cache
+
+
+class ChecksumCacheTest(unittest.TestCase):
+  """Unit tests for checksum_cache.py."""
+
+  def setUp(self):
+    self._dir = tempfile.mkdtemp(dir=os.environ.get("TEST_TMPDIR"))
+    self._cache_path = os.path.join(self._dir, "cache.json")
+
+  def _WriteFile(self, name, content):
+    path = os.path.join(self._dir, name)
+    with open(path, "wb") as f:
+      f.write(content)
+    return path
+
+  def testChecksum(self):
+    path = self._WriteFile("a", b"content")
+    cache = checksum_cache.ChecksumCache()
+    self.assertEqual(hashlib.sha256(b"content").hexdigest(),
+                     cache.Checksum(path))
+
+  def testGetComputesOnlyOnce(self):
+    path = self._WriteFile("a", b"content")
+    cache = checksum_cache.ChecksumCache()
+    computed = []
+
+    def Compute():
+      computed.append(True)
+      return "checksum"
+
+    self.assertEqual("checksum", cache.Get(path, Compute))
+    self.assertEqual("checksum", cache.Get(path, Compute))
+    self.assertEqual("other", cache.Get(path, lambda: "other", member="m"))
+    self.assertEqual(1, len(computed))
+
+  def testChangedFileIsRehashed(self):
+    path = self._WriteFile("a", b"content")
+    cache = checksum_cache.ChecksumCache()
+    cache.Checksum(path)
+    self._WriteFile("a", b"new content")
+    self.assertEqual(hashlib.sha256(b"new content").hexdigest(),
+                     cache.Checksum(path))
+
+  def _CacheLines(self):
+    with open(self._cache_path) as f:
+      return f.read().splitlines()
+
+  def testSaveAndLoad(self):
+    path = self._WriteFile("a", b"content")
+    cache = checksum_cache.ChecksumCache(self._cache_path)
+    cache.Get(path, lambda: "checksum")
+    cache.Save()
+
+    cache = checksum_cache.ChecksumCache(self._cache_path)
+    self.assertEqual("checksum", cache.Get(path, lambda: "recomputed"))
+
+  def testSaveOnlyAppendsChangedEntries(self):
+    a = self._WriteFile("a", b"content")
+    b = self._WriteFile("b", b"content")
+    cache = checksum_cache.ChecksumCache(self._cache_path)
+    cache.Get(a, lambda: "checksum")
+    cache.Save()
+    self.assertEqual(1, len(self._CacheLines()))
+
+    cache = checksum_cache.ChecksumCache(self._cache_path)
+    cache.Get(a, lambda: "recomputed")
+    cache.Save()
+    self.assertEqual(1, len(self._CacheLines()))
+    cache.Get(b, lambda: "other")
+    cache.Save()
+    self.assertEqual(2, len(self._CacheLines()))
+    self.assertIn(os.path.abspath(b), self._CacheLines()[1])
+
+  def testLogIsCompacted(self):
+    path = self._WriteFile("a", b"content")
+    deleted = self._WriteFile("b", b"content")
+    cache = checksum_cache.ChecksumCache(self._cache_path)
+    cache.Get(path, lambda: "checksum")
+    cache.Get(deleted, lambda: "deleted")
+    cache.Save()
+    # Pad the log with outdated entries, as repeated saves would.
+    with open(self._cache_path, "a") as f:
+      for _ in range(checksum_cache._MIN_COMPACTION_LINES):
+        f.write(self._CacheLines()[0] + "\n")
+    os.remove(deleted)
+
+    cache = checksum_cache.ChecksumCache(self._cache_path)
+    os.utime(path, (0, 0))
+    self.assertEqual("new", cache.Get(path, lambda: "new"))
+    cache.Save()
+    self.assertEqual(1, len(self._CacheLines()))
+    cache = checksum_cache.ChecksumCache(self._cache_path)
+    self.assertEqual("new", cache.Get(path, lambda: "recomputed"))
+
+  def testCorruptCacheIsIgnored(self):
+    path = self._WriteFile("a", b"content")
+    self._WriteFile("cache.json", b"{not json")
+    cache = checksum_cache.ChecksumCache(self._cache_path)
+    self.assertEqual(hashlib.sha256(b"content").hexdigest(),
+                     cache.Checksum(path))
+    # The corrupt line is dropped rather than appended to.
+    cache.Save()
+    self.assertEqual(1, len(self._CacheLines()))
+    cache = checksum_cache.ChecksumCache(self._cache_path)
+    self.assertEqual(hashlib.sha256(b"content").hexdigest(),
+                     cache.Get(path, lambda: "recomputed"))
+
+  def testChecksums(self):
+    paths = [self._WriteFile(str(i), b"content%d" % i) for i in range(5)]
+    cache = checksum_cache.ChecksumCache()
+    self.assertEqual(
+        [hashlib.sha256(b"content%d" % i).hexdigest() for i in range(5)],
+        cache.Checksums(paths, jobs=2))
+
+  def testDefaultJobsIsCapped(self):
+    self.assertGreaterEqual(checksum_cache.DefaultJobs(), 1)
+    self.assertLessEqual(checksum_cache.DefaultJobs(), checksum_cache.MAX_JOBS)
+
+  def testOutputBaseCachePath(self):
+    output_base = os.path.join(self._dir, "output_base")
+    self.assertEqual(
+        os.path.join(output_base, checksum_cache.CACHE_FILENAME),
+        checksum_cache.OutputBaseCachePath(
+            os.path.join(output_base, "execroot", "workspace")))
+    self.assertIsNone(checksum_cache.OutputBaseCachePath(self._dir))
+
+
+if __name__ == "__main__":
+  unittest.main()
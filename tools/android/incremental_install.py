@@ -23,7 +23,6 @@ from __future__ import print_function
 
 import collections
 from concurrent import futures
-import hashlib
 import logging
 import os
 import posixpath
@@ -32,13 +31,18 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+import uuid
 import zipfile
 
 # Do not edit this line. Copybara replaces it with PY2 migration helper.
 from absl import app
 from absl import flags
 import six
+from six.moves import queue
+
+from tools.android import checksum_cache
 
 flags.DEFINE_string("split_main_apk", None, "The main APK for split install")
 flags.DEFINE_multi_string("split_apk", [], "Split APKs to install")
@@ -52,6 +56,18 @@ flags.DEFINE_string("adb", None, "ADB to use")
 flags.DEFINE_string("stub_datafile", None, "The stub data file")
 flags.DEFINE_string("output_marker", None, "The output marker file")
 flags.DEFINE_multi_string("extra_adb_arg", [], "Extra arguments to adb")
+flags.DEFINE_multi_string(
+    "device_serial", [],
+    "Serial of a device to install to. If given multiple times, installs to "
+    "all of the devices concurrently")
+flags.DEFINE_string(
+    "checksum_cache", None,
+    "File to cache checksums of local files in. Defaults to a file in the "
+    "output base, if --execroot is an execroot.")
+flags.DEFINE_boolean(
+    "adb_shell_session", False,
+    "Whether to run shell commands in one persistent 'adb shell' session "
+    "instead of starting adb for each of them")
 flags.DEFINE_string("execroot", ".", "The exec root")
 flags.DEFINE_integer(
     "adb_jobs",
@@ -81,6 +97,15 @@ COMPATIBLE_ABIS = {
     "arm64-v8a": ["armeabi-v7a", "armeabi"]
 }
 
+# Small files are pushed many at a time to amortize adb's per-invocation
+# overhead. A batch has at most this many files, to keep command lines short.
+MAX_PUSH_BATCH_FILES = 100
+
+# A batch aims to hold 1/adb_jobs of the bytes to push, so that all adb
+# instances stay busy, within these bounds.
+MIN_PUSH_BATCH_BYTES = 1 << 20
+MAX_PUSH_BATCH_BYTES = 16 << 20
+
 
 class AdbError(Exception):
   """An exception class signaling an error in an adb invocation."""
@@ -131,25 +156,173 @@ hostpath = os.path
 targetpath = posixpath
 
 
+# A file in a zip that's to be pushed to the device. It's only extracted right
+# before it's pushed, by the adb worker that pushes it.
+ZipMember = collections.namedtuple("ZipMember", ["zip_path", "name", "size"])
+
+
+def _SourceSize(source):
+  """Returns the size of a local path or ZipMember."""
+  if isinstance(source, ZipMember):
+    return source.size
+  return hostpath.getsize(source)
+
+
+# How long a shell session may go without output before it's given up on.
+_SHELL_SESSION_TIMEOUT_SECS = 60
+
+
+class _ShellSessionTimeoutError(Exception):
+  """Raised when a shell session stops responding."""
+
+
+class _ShellSession(object):
+  """A long-lived 'adb shell' that runs commands sent over its stdin.
+
+  After each command, the session echoes a sentinel followed by the command's
+  exit code on stdout, and the sentinel alone on stderr. These delimit the
+  command's output on both streams. This requires the device to support
+  shell_v2, which keeps stdout and stderr apart.
+
+  Both streams are read by threads, so that reads can time out.
+  """
+
+  def __init__(self, args, env):
+    self._sentinel = "__incremental_install_%s__" % uuid.uuid4().hex
+    self._timeout = _SHELL_SESSION_TIMEOUT_SECS
+    self._process = subprocess.Popen(
+        args,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=env)
+    self._stdout = self._StartReader(self._process.stdout)
+    self._stderr = self._StartReader(self._process.stderr)
+
+  @staticmethod
+  def _StartReader(stream):
+    """Returns a queue of the lines of stream, ended by None."""
+    lines = queue.Queue()
+
+    def Read():
+      for line in iter(stream.readline, b""):
+        lines.put(line)
+      lines.put(None)
+
+    reader = threading.Thread(target=Read)
+    reader.daemon = True
+    reader.start()
+    return lines
+
+  def Run(self, cmd):
+    """Runs a shell command in the session.
+
+    Args:
+      cmd: The shell command line.
+
+    Returns:
+      A (returncode, stdout, stderr) tuple. If the session ended before the
+      command completed (for example because adb couldn't connect to the
+      device), this is adb's own return code and output instead.
+
+    Raises:
+      _ShellSessionTimeoutError: If the session didn't write anything for the
+        timeout. The session is killed.
+    """
+    # The subshell keeps the command from reading the rest of the script from
+    # stdin. Newlines keep a trailing comment from swallowing the parenthesis.
+    script = "(\n%s\n) </dev/null\necho %s $?\necho %s >&2\n" % (
+        cmd, self._sentinel, self._sentinel)
+    try:
+      self._process.stdin.write(script.encode("utf-8"))
+      self._process.stdin.flush()
+    except IOError:
+      # The session is gone. Its output says why.
+      pass
+
+    stdout, returncode = self._ReadUntilSentinel(self._stdout)
+    stderr, _ = self._ReadUntilSentinel(self._stderr)
+    if returncode is None:
+      returncode = self._process.wait()
+    return returncode, stdout, stderr
+
+  def IsAlive(self):
+    return self._process.poll() is None
+
+  def Close(self):
+    """Ends the session."""
+    try:
+      self._process.stdin.close()
+    except IOError:
+      pass
+    self._process.wait()
+
+  def _ReadUntilSentinel(self, stream_lines):
+    """Reads a stream up to the sentinel.
+
+    Args:
+      stream_lines: The queue of the stream's lines, see _StartReader.
+
+    Returns:
+      A (output, value) tuple, where output is what was read before the
+      sentinel, and value is the integer printed after the sentinel, if any. If
+      the stream ends before the sentinel, returns all of it and None.
+
+    Raises:
+      _ShellSessionTimeoutError: If no line was read for the timeout.
+    """
+    lines = []
+    while True:
+      try:
+        line = stream_lines.get(timeout=self._timeout)
+      except queue.Empty:
+        self._process.kill()
+        raise _ShellSessionTimeoutError()
+      if line is None:
+        break
+      line = six.ensure_str(line, "utf-8").rstrip("\r\n")
+      index = line.find(self._sentinel)
+      if index == -1:
+        lines.append(line)
+        continue
+      # Output without a trailing newline ends up on the sentinel's line.
+      if index:
+        lines.append(line[:index])
+      value = line[index + len(self._sentinel):].strip()
+      return "\n".join(lines), int(value) if value else None
+    return "\n".join(lines), None
+
+
 class Adb(object):
   """A class to handle interaction with adb."""
 
   def __init__(self, adb_path, temp_dir, adb_jobs, user_home_dir,
-               extra_adb_args):
+               extra_adb_args, shell_session=False):
     self._adb_path = adb_path
     self._temp_dir = temp_dir
     self._user_home_dir = user_home_dir
     self._file_counter = 1
+    self._file_counter_lock = threading.Lock()
+    self.jobs = adb_jobs
     self._executor = futures.ThreadPoolExecutor(max_workers=adb_jobs)
     self._extra_adb_args = extra_adb_args or []
-
-  def _Exec(self, adb_args):
-    """Executes the given adb command + args."""
-    args = [self._adb_path] + self._extra_adb_args + adb_args
-    # TODO(ahumesky): Because multiple instances of adb are executed in
-    # parallel, these debug logging lines will get interleaved.
-    logging.debug("Executing: %s", " ".join(args))
-
+    # Whether _Shell uses a persistent session. It's started on first use, if
+    # the device supports it.
+    self._use_shell_session = shell_session
+    self._shell_session_supported = None
+    self._shell_session = None
+    self._shell_session_lock = threading.Lock()
+
+  def Close(self):
+    """Releases the resources of this instance."""
+    with self._shell_session_lock:
+      if self._shell_session is not None:
+        self._shell_session.Close()
+        self._shell_session = None
+    self._executor.shutdown()
+
+  def _Env(self):
+    """Returns the environment to run adb in."""
     # adb sometimes requires the user's home directory to access things in
     # $HOME/.android (e.g. keys to authorize with the device). To avoid any
     # potential problems with python picking up things in the user's home
@@ -166,17 +339,40 @@ class Adb(object):
         raise EnvvarError(("The %SYSTEMROOT% environment variable must "
                            "be set or Adb won't work"))
       env["SYSTEMROOT"] = value
+    return env
+
+  def _Exec(self, adb_args):
+    """Executes the given adb command + args."""
+    args = [self._adb_path] + self._extra_adb_args + adb_args
+    # TODO(ahumesky): Because multiple instances of adb are executed in
+    # parallel, these debug logging lines will get interleaved.
+    logging.debug("Executing: %s", " ".join(args))
 
     adb = subprocess.Popen(
         args,
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
-        env=env)
+        env=self._Env())
     stdout, stderr = adb.communicate()
+    return self._CheckResult(args, adb.returncode, stdout, stderr)
+
+  def _CheckResult(self, args, returncode, stdout, stderr):
+    """Raises the appropriate error if an adb command failed.
+
+    Args:
+      args: The command line of the adb command.
+      returncode: The return code of the command.
+      stdout: The stdout of the command.
+      stderr: The stderr of the command.
+
+    Returns:
+      A (returncode, stdout, stderr, args) tuple, with stdout and stderr
+      stripped.
+    """
     stdout = stdout.strip()
     stderr = stderr.strip()
-    logging.debug("adb ret: %s", adb.returncode)
+    logging.debug("adb ret: %s", returncode)
     logging.debug("adb out: %s", stdout)
     logging.debug("adb err: %s", stderr)
 
@@ -196,18 +392,19 @@ class Adb(object):
     elif "INSTALL_FAILED_OLDER_SDK" in stdout:
       raise OldSdkException()
 
-    if adb.returncode != 0:
-      raise AdbError(args, adb.returncode, stdout, stderr)
+    if returncode != 0:
+      raise AdbError(args, returncode, stdout, stderr)
 
-    return adb.returncode, stdout, stderr, args
+    return returncode, stdout, stderr, args
 
   def _ExecParallel(self, adb_args):
     return self._executor.submit(self._Exec, adb_args)
 
   def _CreateLocalFile(self):
     """Returns a path to a temporary local file in the temp directory."""
-    local = hostpath.join(self._temp_dir, "adbfile_%d" % self._file_counter)
-    self._file_counter += 1
+    with self._file_counter_lock:
+      local = hostpath.join(self._temp_dir, "adbfile_%d" % self._file_counter)
+      self._file_counter += 1
     return local
 
   def GetInstallTime(self, package):
@@ -229,6 +426,73 @@ class Adb(object):
     """Invoke 'adb push' in parallel."""
     return self._ExecParallel(["push", local, remote])
 
+  def PushMultiple(self, files, remote_dir):
+    """Invoke 'adb push' in parallel for several files at once.
+
+    Files are staged and pushed by the same adb worker, so preparing one batch
+    overlaps with pushing others.
+
+    Args:
+      files: List of (source, remote) pairs, where source is a local path or a
+        ZipMember. All remote paths must be directly in remote_dir, which must
+        already exist.
+      remote_dir: The directory on the device to push the files to.
+
+    Returns:
+      A future for the push.
+    """
+    return self._executor.submit(self._PushMultiple, files, remote_dir)
+
+  def _PushMultiple(self, files, remote_dir):
+    """Stages files to push with one 'adb push' and pushes them.
+
+    adb pushes multiple sources into a directory under their own names, so
+    files whose local name differs from their remote one are hard linked (or
+    copied) into a local staging directory under the remote name first. Zip
+    members are extracted straight to their staged name.
+
+    Args:
+      files: See PushMultiple.
+      remote_dir: See PushMultiple.
+
+    Returns:
+      See _Exec.
+    """
+    staging_dir = None
+    sources = []
+    zips = {}
+    try:
+      for source, remote in files:
+        name = targetpath.basename(remote)
+        if not isinstance(source, ZipMember) and (
+            len(files) == 1 or hostpath.basename(source) == name):
+          sources.append(source)
+          continue
+        if staging_dir is None:
+          staging_dir = self._CreateLocalFile()
+          os.makedirs(staging_dir)
+        staged = hostpath.join(staging_dir, name)
+        if isinstance(source, ZipMember):
+          if source.zip_path not in zips:
+            zips[source.zip_path] = zipfile.ZipFile(source.zip_path)
+          with zips[source.zip_path].open(source.name) as src:
+            with open(staged, "wb") as dst:
+              shutil.copyfileobj(src, dst)
+        else:
+          try:
+            os.link(source, staged)
+          except (AttributeError, OSError):
+            # Hard links aren't available on this platform or across devices.
+            shutil.copyfile(source, staged)
+        sources.append(staged)
+    finally:
+      for z in zips.values():
+        z.close()
+
+    if len(files) == 1:
+      return self._Exec(["push", sources[0], files[0][1]])
+    return self._Exec(["push"] + sources + [remote_dir])
+
   def PushString(self, contents, remote):
     """Push a given string to a given path on the device in parallel."""
     local = self._CreateLocalFile()
@@ -317,9 +581,46 @@ class Adb(object):
       self._Shell("am clear-debug-app %s" % package)
     self._Shell("monkey -p %s -c android.intent.category.LAUNCHER 1" % package)
 
+  def _SupportsShellSession(self):
+    """Returns whether the device keeps stdout and stderr of shells apart."""
+    try:
+      _, stdout, _, _ = self._Exec(["features"])
+    except AdbError:
+      # adb is too old to know the command.
+      return False
+    return "shell_v2" in re.split(r"[,\s]+", stdout)
+
   def _Shell(self, cmd):
     """Invoke 'adb shell'."""
-    return self._Exec(["shell", cmd])
+    if not self._use_shell_session:
+      return self._Exec(["shell", cmd])
+
+    # -T keeps adb from allocating a pty, which would echo the commands.
+    args = [self._adb_path] + self._extra_adb_args + ["shell", "-T"]
+    logging.debug("Executing in shell session: %s", cmd)
+    with self._shell_session_lock:
+      if self._shell_session_supported is None:
+        self._shell_session_supported = self._SupportsShellSession()
+      if not self._shell_session_supported:
+        # Without shell_v2 (before API 24), adb merges stderr into stdout, so
+        # the session can't delimit the output of commands.
+        self._use_shell_session = False
+        return self._Exec(["shell", cmd])
+      if self._shell_session is None:
+        self._shell_session = _ShellSession(args, self._Env())
+      try:
+        returncode, stdout, stderr = self._shell_session.Run(cmd)
+      except _ShellSessionTimeoutError:
+        logging.warning("adb shell session timed out, not using it anymore")
+        self._shell_session.Close()
+        self._shell_session = None
+        self._use_shell_session = False
+        return self._Exec(["shell", cmd])
+      if not self._shell_session.IsAlive():
+        # Start a new session next time.
+        self._shell_session.Close()
+        self._shell_session = None
+    return self._CheckResult(args + [cmd], returncode, stdout, stderr)
 
   @staticmethod
   def _IsHostOsWindows():
@@ -354,22 +655,29 @@ def GetAppPackage(stub_datafile):
     return six.ensure_str(f.readlines()[1], "utf-8").strip()
 
 
-def UploadDexes(adb, execroot, app_dir, temp_dir, dexmanifest, full_install):
-  """Uploads dexes to the device so that the state.
+# Files to push to the device, followed by their manifest. files is a list of
+# (local, remote) paths, and manifest is the contents of the file to push to
+# manifest_path once all of them are pushed.
+Upload = collections.namedtuple(
+    "Upload", ["description", "files", "manifest", "manifest_path"])
+
+
+def PrepareDexUpload(adb, execroot, app_dir, dexmanifest, full_install):
+  """Prepares uploading dexes to the device.
 
   Does the minimum amount of work necessary to make the state of the device
-  consistent with what was built.
+  consistent with what was built. Stale dexes and the on-device manifest are
+  deleted right away; the actual upload is left to PushUploads.
 
   Args:
     adb: the Adb instance representing the device to install to
     execroot: the execroot
     app_dir: the directory things should be installed under on the device
-    temp_dir: a local temporary directory
     dexmanifest: contents of the dex manifest
     full_install: whether to do a full install
 
   Returns:
-    None.
+    The Upload to push, or None if the dexes are up-to-date.
   """
 
   # Fetch the manifest on the device
@@ -406,36 +714,32 @@ def UploadDexes(adb, execroot, app_dir, temp_dir, dexmanifest, full_install):
   if not dexes_to_delete and not dexes_to_upload:
     # If we have nothing to do, don't bother removing and rewriting the manifest
     logging.info("Application dexes up-to-date")
-    return
+    return None
 
   # Delete the manifest so that we know how to get back to a consistent state
   # if we are interrupted.
   adb.Delete(targetpath.join(dex_dir, "manifest"))
 
-  # Tuple of (local, remote) files to push to the device.
+  # Tuple of (source, remote) files to push to the device.
   files_to_push = []
 
-  # Sort dexes to be uploaded by the zip file they are in so that we only need
-  # to open each zip only once.
-  dexzips_in_upload = set(new_manifest[d].input_file for d in dexes_to_upload
-                          if new_manifest[d].zippath != "-")
-  for i, dexzip_name in enumerate(dexzips_in_upload):
-    zip_dexes = [
-        d for d in dexes_to_upload if new_manifest[d].input_file == dexzip_name]
-    dexzip_tempdir = hostpath.join(temp_dir, "dex", str(i))
-    with zipfile.ZipFile(hostpath.join(execroot, dexzip_name)) as dexzip:
-      for dex in zip_dexes:
-        zippath = new_manifest[dex].zippath
-        dexzip.extract(zippath, dexzip_tempdir)
-        files_to_push.append((hostpath.join(dexzip_tempdir, zippath),
-                              targetpath.join(dex_dir, dex)))
-
-  # Now gather all the dexes that are not within a .zip file.
-  dexes_to_upload = set(
-      d for d in dexes_to_upload if new_manifest[d].zippath == "-")
+  # Group dexes to be uploaded by the zip file they are in so that we only need
+  # to open each zip once. Dexes in zips are extracted when they are pushed.
+  zip_dexes = collections.defaultdict(list)
   for dex in dexes_to_upload:
-    files_to_push.append((new_manifest[dex].input_file, targetpath.join(
-        dex_dir, dex)))
+    entry = new_manifest[dex]
+    if entry.zippath == "-":
+      files_to_push.append((entry.input_file, targetpath.join(dex_dir, dex)))
+    else:
+      zip_dexes[entry.input_file].append(dex)
+  for dexzip_name, dexes in zip_dexes.items():
+    dexzip_path = hostpath.join(execroot, dexzip_name)
+    with zipfile.ZipFile(dexzip_path) as dexzip:
+      for dex in dexes:
+        zippath = new_manifest[dex].zippath
+        files_to_push.append(
+            (ZipMember(dexzip_path, zippath, dexzip.getinfo(zippath).file_size),
+             targetpath.join(dex_dir, dex)))
 
   num_files = len(dexes_to_delete) + len(files_to_push)
   logging.info("Updating %d dex%s...", num_files, "es" if num_files > 1 else "")
@@ -443,73 +747,42 @@ def UploadDexes(adb, execroot, app_dir, temp_dir, dexmanifest, full_install):
   # Delete the dexes that are not in the new manifest
   adb.DeleteMultiple(targetpath.join(dex_dir, dex) for dex in dexes_to_delete)
 
-  # Upload all the files.
-  upload_walltime_start = time.time()
-  fs = [adb.Push(local, remote) for local, remote in files_to_push]
-  done, not_done = futures.wait(fs, return_when=futures.FIRST_EXCEPTION)
-  upload_walltime = time.time() - upload_walltime_start
-  logging.debug("Dex upload walltime: %s seconds", upload_walltime)
-
-  # If there is anything in not_done, then some adb call failed and we
-  # can cancel the rest.
-  if not_done:
-    for f in not_done:
-      f.cancel()
+  return Upload("dex", files_to_push, dexmanifest,
+                targetpath.join(dex_dir, "manifest"))
 
-  # If any adb call resulted in an exception, re-raise it.
-  for f in done:
-    f.result()
 
-  # If no dex upload failed, upload the manifest. If any upload failed, the
-  # exception should have been re-raised above.
-  # Call result() to raise the exception if there was one.
-  adb.PushString(dexmanifest, targetpath.join(dex_dir, "manifest")).result()
-
-
-def Checksum(filename):
-  """Compute the SHA-256 checksum of a file."""
-  h = hashlib.sha256()
-  with open(filename, "rb") as f:
-    while True:
-      data = f.read(65536)
-      if not data:
-        break
-
-      h.update(data)
-
-  return h.hexdigest()
-
-
-def UploadResources(adb, resource_apk, app_dir):
-  """Uploads resources to the device.
+def PrepareResourceUpload(adb, resource_apk, app_dir, checksums):
+  """Prepares uploading resources to the device.
 
   Args:
     adb: The Adb instance representing the device to install to.
     resource_apk: Path to the resource apk.
     app_dir: The directory things should be installed under on the device.
+    checksums: The ChecksumCache to compute checksums with.
 
   Returns:
-    None.
+    The Upload to push, or None if the resources are up-to-date.
   """
 
   # Compute the checksum of the new resources file
-  new_checksum = Checksum(resource_apk)
+  new_checksum = checksums.Checksum(resource_apk)
 
   # Fetch the checksum of the resources file on the device, if it exists
   device_checksum_file = targetpath.join(app_dir, "resources_checksum")
   old_checksum = adb.Pull(device_checksum_file)
   if old_checksum == new_checksum:
     logging.info("Application resources up-to-date")
-    return
+    return None
   logging.info("Updating application resources...")
 
   # Remove the checksum file on the device so that if the transfer is
   # interrupted, we know how to get the device back to a consistent state.
   adb.Delete(device_checksum_file)
-  adb.Push(resource_apk, targetpath.join(app_dir, "resources.ap_")).result()
 
-  # Write the new checksum to the device.
-  adb.PushString(new_checksum, device_checksum_file).result()
+  # The new checksum is written to the device once the resources are pushed.
+  return Upload("resource",
+                [(resource_apk, targetpath.join(app_dir, "resources.ap_"))],
+                new_checksum, device_checksum_file)
 
 
 def ConvertNativeLibs(args):
@@ -543,8 +816,20 @@ def FindAbi(device_abi, app_abis):
   return None
 
 
-def UploadNativeLibs(adb, native_lib_args, app_dir, full_install):
-  """Uploads native libraries to the device."""
+def PrepareNativeLibUpload(adb, native_lib_args, app_dir, full_install,
+                           checksums):
+  """Prepares uploading native libraries to the device.
+
+  Args:
+    adb: The Adb instance representing the device to install to.
+    native_lib_args: The --native_lib command line arguments.
+    app_dir: The directory things should be installed under on the device.
+    full_install: Whether to do a full install.
+    checksums: The ChecksumCache to compute checksums with.
+
+  Returns:
+    The Upload to push, or None if the native libs are up-to-date.
+  """
 
   native_libs = ConvertNativeLibs(native_lib_args)
   libs = set()
@@ -555,8 +840,9 @@ def UploadNativeLibs(adb, native_lib_args, app_dir, full_install):
 
   basename_to_path = {}
   install_checksums = {}
-  for lib in sorted(libs):
-    install_checksums[os.path.basename(lib)] = Checksum(lib)
+  libs = sorted(libs)
+  for lib, checksum in zip(libs, checksums.Checksums(libs)):
+    install_checksums[os.path.basename(lib)] = checksum
     basename_to_path[os.path.basename(lib)] = lib
 
   device_manifest = None
@@ -594,7 +880,7 @@ def UploadNativeLibs(adb, native_lib_args, app_dir, full_install):
 
   if not libs_to_delete and not libs_to_push and device_manifest is not None:
     logging.info("Native libs up-to-date")
-    return
+    return None
 
   num_files = len(libs_to_delete) + len(libs_to_push)
   logging.info("Updating %d native lib%s...",
@@ -606,29 +892,122 @@ def UploadNativeLibs(adb, native_lib_args, app_dir, full_install):
     adb.DeleteMultiple(
         [targetpath.join(app_dir, "native", lib) for lib in libs_to_delete])
 
-  upload_walltime_start = time.time()
-  fs = [adb.Push(local, remote) for local, remote in libs_to_push]
-  done, not_done = futures.wait(fs, return_when=futures.FIRST_EXCEPTION)
-  upload_walltime = time.time() - upload_walltime_start
-  logging.debug("Native library upload walltime: %s seconds", upload_walltime)
-
-  # If there is anything in not_done, then some adb call failed and we
-  # can cancel the rest.
-  if not_done:
-    for f in not_done:
-      f.cancel()
-
-  # If any adb call resulted in an exception, re-raise it.
-  for f in done:
-    f.result()
-
   install_manifest = [
       six.ensure_str(name) + " " + checksum
       for name, checksum in install_checksums.items()
   ]
-  adb.PushString("\n".join(install_manifest),
-                 targetpath.join(app_dir, "native",
-                                 "native_manifest")).result()
+  return Upload("native lib", libs_to_push, "\n".join(install_manifest),
+                targetpath.join(app_dir, "native", "native_manifest"))
+
+
+def BatchPushes(pushes, jobs):
+  """Groups files to push into batches of one adb invocation each.
+
+  Batch sizes adapt to the files: a batch holds up to 1/jobs of all bytes to
+  push (within MIN_PUSH_BATCH_BYTES and MAX_PUSH_BATCH_BYTES) and at most
+  MAX_PUSH_BATCH_FILES files. Many small files thus share an invocation, while
+  large files are pushed on their own.
+
+  Args:
+    pushes: List of (size, source, remote) for the files to push. See
+      Adb.PushMultiple for what sources may be.
+    jobs: The number of adb instances used in parallel.
+
+  Returns:
+    List of (size, [(source, remote), ...], remote_dir) batches, largest first.
+    All files of a batch are directly in its remote_dir.
+  """
+  total_bytes = sum(size for size, _, _ in pushes)
+  max_bytes = min(max(total_bytes // jobs, MIN_PUSH_BATCH_BYTES),
+                  MAX_PUSH_BATCH_BYTES)
+
+  by_dir = collections.defaultdict(list)
+  for size, source, remote in pushes:
+    by_dir[targetpath.dirname(remote)].append((size, source, remote))
+
+  batches = []
+  for remote_dir, dir_pushes in sorted(by_dir.items()):
+    batch_size = 0
+    batch = []
+    dir_pushes.sort(key=lambda push: (push[0], push[2]), reverse=True)
+    for size, source, remote in dir_pushes:
+      if batch and (batch_size + size > max_bytes or
+                    len(batch) == MAX_PUSH_BATCH_FILES):
+        batches.append((batch_size, batch, remote_dir))
+        batch_size = 0
+        batch = []
+      batch_size += size
+      batch.append((source, remote))
+    if batch:
+      batches.append((batch_size, batch, remote_dir))
+
+  batches.sort(key=lambda batch: batch[0], reverse=True)
+  return batches
+
+
+def PushUploads(adb, uploads):
+  """Pushes the files of several uploads to the device concurrently.
+
+  All files of all uploads are pushed at once over the adb thread pool, in
+  batches (see BatchPushes) and largest first so that big files don't end up as
+  stragglers. The only ordering enforced is that each upload's manifest is
+  pushed after all of its files, which happens as soon as they are done,
+  regardless of the other uploads. Callers delete on-device manifests before
+  calling this, so an interrupted upload is detected on the next install.
+
+  Args:
+    adb: The Adb instance representing the device to install to.
+    uploads: The Uploads to push. None entries are ignored.
+
+  Raises:
+    AdbError and friends: If any push fails. Pending pushes are cancelled and no
+      further manifests are pushed.
+  """
+  uploads = [upload for upload in uploads if upload is not None]
+  batches = []
+  for i, upload in enumerate(uploads):
+    pushes = [(_SourceSize(source), source, remote)
+              for source, remote in upload.files]
+    batches.extend((size, files, remote_dir, i) for size, files, remote_dir
+                   in BatchPushes(pushes, adb.jobs))
+  batches.sort(key=lambda batch: batch[0], reverse=True)
+
+  upload_walltime_start = time.time()
+  remaining = [0] * len(uploads)
+  for _, _, _, i in batches:
+    remaining[i] += 1
+  fs = {}
+  manifest_fs = []
+
+  def PushManifest(upload):
+    manifest_fs.append(adb.PushString(upload.manifest, upload.manifest_path))
+
+  for upload, count in zip(uploads, remaining):
+    if not count:
+      PushManifest(upload)
+  for _, files, remote_dir, i in batches:
+    fs[adb.PushMultiple(files, remote_dir)] = i
+
+  try:
+    for f in futures.as_completed(fs):
+      # Re-raise the exception if the push failed.
+      f.result()
+      i = fs[f]
+      remaining[i] -= 1
+      if not remaining[i]:
+        PushManifest(uploads[i])
+    for f in manifest_fs:
+      f.result()
+  except Exception:
+    # Some adb call failed, so we can cancel the rest.
+    for f in list(fs) + manifest_fs:
+      f.cancel()
+    raise
+
+  upload_walltime = time.time() - upload_walltime_start
+  logging.debug("Upload walltime (%s): %s seconds",
+                ", ".join(upload.description for upload in uploads),
+                upload_walltime)
 
 
 def VerifyInstallTimestamp(adb, app_package):
@@ -654,7 +1033,7 @@ def VerifyInstallTimestamp(adb, app_package):
 
 
 def SplitIncrementalInstall(adb, app_package, execroot, split_main_apk,
-                            split_apks):
+                            split_apks, checksums):
   """Does incremental installation using split packages."""
   app_dir = targetpath.join(DEVICE_DIRECTORY, app_package)
   device_manifest_path = targetpath.join(app_dir, "split_manifest")
@@ -668,11 +1047,9 @@ def SplitIncrementalInstall(adb, app_package, execroot, split_main_apk,
         name, checksum = manifest_line.split(" ")
         device_checksums[name] = checksum
 
-  install_checksums = {}
-  install_checksums["__MAIN__"] = Checksum(
-      hostpath.join(execroot, split_main_apk))
-  for apk in split_apks:
-    install_checksums[apk] = Checksum(hostpath.join(execroot, apk))
+  apk_checksums = checksums.Checksums(
+      hostpath.join(execroot, apk) for apk in [split_main_apk] + split_apks)
+  install_checksums = dict(zip(["__MAIN__"] + split_apks, apk_checksums))
 
   reinstall_main = False
   if (device_manifest is None or actual_timestamp is None or
@@ -720,6 +1097,73 @@ def SplitIncrementalInstall(adb, app_package, execroot, split_main_apk,
                  targetpath.join(app_dir, "split_manifest")).result()
 
 
+def _InstallOnDevice(adb, execroot, app_package, start_type, dexmanifest,
+                     apk, native_libs, resource_apk, split_main_apk,
+                     split_apks, checksums):
+  """Installs the app on the device of the given Adb instance.
+
+  See IncrementalInstall for the arguments, except that dexmanifest holds the
+  contents of the dex manifest rather than its path.
+  """
+  app_dir = targetpath.join(DEVICE_DIRECTORY, app_package)
+  if split_main_apk:
+    SplitIncrementalInstall(adb, app_package, execroot, split_main_apk,
+                            split_apks, checksums)
+  else:
+    if not apk:
+      VerifyInstallTimestamp(adb, app_package)
+
+    PushUploads(adb, [
+        PrepareDexUpload(adb, execroot, app_dir, dexmanifest, bool(apk)),
+        PrepareResourceUpload(adb, hostpath.join(execroot, resource_apk),
+                              app_dir, checksums),
+        PrepareNativeLibUpload(adb, native_libs, app_dir, bool(apk),
+                               checksums),
+    ])
+    if apk:
+      apk_path = targetpath.join(execroot, apk)
+      adb.Install(apk_path)
+      future = adb.PushString(
+          adb.GetInstallTime(app_package),
+          targetpath.join(DEVICE_DIRECTORY, app_package, "install_timestamp"))
+      future.result()
+    else:
+      if start_type == "warm":
+        adb.StopAppAndSaveState(app_package)
+      else:
+        adb.StopApp(app_package)
+
+  if start_type in ["cold", "warm", "debug"]:
+    logging.info("Starting application %s", app_package)
+    adb.StartApp(app_package, start_type)
+
+
+def _ErrorMessage(e):
+  """Returns the message to show the user for an installation error.
+
+  Args:
+    e: The exception raised during installation.
+
+  Returns:
+    The message, or None if e isn't a known installation error.
+  """
+  if isinstance(e, DeviceNotFoundError):
+    return "Error: Device not found"
+  elif isinstance(e, DeviceUnauthorizedError):
+    return ("Error: Device unauthorized. Please check the confirmation "
+            "dialog on your device.")
+  elif isinstance(e, MultipleDevicesError):
+    return ("Error: " + str(e) + "\nTry specifying a device serial with "
+            "\"bazel mobile-install --adb_arg=-s --adb_arg=$ANDROID_SERIAL\"")
+  elif isinstance(e, OldSdkException):
+    return ("Error: The device does not support the API level specified in "
+            "the application's manifest. Check minSdkVersion in "
+            "AndroidManifest.xml")
+  elif isinstance(e, (TimestampException, AdbError)):
+    return "Error:\n%s" % str(e)
+  return None
+
+
 def IncrementalInstall(adb_path,
                        execroot,
                        stub_datafile,
@@ -733,7 +1177,10 @@ def IncrementalInstall(adb_path,
                        split_main_apk=None,
                        split_apks=None,
                        user_home_dir=None,
-                       extra_adb_args=None):
+                       extra_adb_args=None,
+                       adb_shell_session=False,
+                       checksum_cache_path=None,
+                       device_serials=None):
   """Performs an incremental install.
 
   Args:
@@ -752,65 +1199,80 @@ def IncrementalInstall(adb_path,
     split_apks: the list of split .apks to be installed.
     user_home_dir: Path to the user's home directory.
     extra_adb_args: Extra arguments that will always be passed to adb.
+    adb_shell_session: Whether to run shell commands in one persistent
+                       'adb shell' session.
+    checksum_cache_path: File to cache checksums of local files in. Defaults to
+                         a file in the output base, if execroot is an execroot.
+    device_serials: Serials of the devices to install to. If there are several,
+                    they're installed to concurrently, and adb_jobs applies to
+                    each of them. If None, adb picks the device.
   """
   temp_dir = tempfile.mkdtemp()
+  checksums = checksum_cache.ChecksumCache(
+      checksum_cache_path or checksum_cache.OutputBaseCachePath(execroot))
+  serials = device_serials or [None]
+  adbs = []
+  for i, serial in enumerate(serials):
+    device_temp_dir = hostpath.join(temp_dir, str(i))
+    os.makedirs(device_temp_dir)
+    device_adb_args = list(extra_adb_args or [])
+    if serial:
+      device_adb_args += ["-s", serial]
+    adbs.append(Adb(adb_path, device_temp_dir, adb_jobs, user_home_dir,
+                    device_adb_args, adb_shell_session))
+
+  def Install(adb):
+    try:
+      _InstallOnDevice(adb, execroot, app_package, start_type, dexmanifest,
+                       apk, native_libs, resource_apk, split_main_apk,
+                       split_apks, checksums)
+      return None
+    except (DeviceNotFoundError, DeviceUnauthorizedError, MultipleDevicesError,
+            OldSdkException, TimestampException, AdbError) as e:
+      return _ErrorMessage(e)
+
   try:
-    adb = Adb(adb_path, temp_dir, adb_jobs, user_home_dir, extra_adb_args)
     app_package = GetAppPackage(hostpath.join(execroot, stub_datafile))
-    app_dir = targetpath.join(DEVICE_DIRECTORY, app_package)
+    # Do the host-side work shared by all devices once: read the dex manifest
+    # and checksum local files. Devices then find the checksums in the cache.
     if split_main_apk:
-      SplitIncrementalInstall(adb, app_package, execroot, split_main_apk,
-                              split_apks)
+      checksums.Checksums(
+          hostpath.join(execroot, split_apk)
+          for split_apk in [split_main_apk] + split_apks)
     else:
-      if not apk:
-        VerifyInstallTimestamp(adb, app_package)
-
       with open(hostpath.join(execroot, dexmanifest), "rb") as f:
         dexmanifest = six.ensure_str(f.read(), "utf-8")
-      UploadDexes(adb, execroot, app_dir, temp_dir, dexmanifest, bool(apk))
-      # TODO(ahumesky): UploadDexes waits for all the dexes to be uploaded, and
-      # then UploadResources is called. We could instead enqueue everything
-      # onto the threadpool so that uploading resources happens sooner.
-      UploadResources(adb, hostpath.join(execroot, resource_apk), app_dir)
-      UploadNativeLibs(adb, native_libs, app_dir, bool(apk))
-      if apk:
-        apk_path = targetpath.join(execroot, apk)
-        adb.Install(apk_path)
-        future = adb.PushString(
-            adb.GetInstallTime(app_package),
-            targetpath.join(DEVICE_DIRECTORY, app_package, "install_timestamp"))
-        future.result()
-      else:
-        if start_type == "warm":
-          adb.StopAppAndSaveState(app_package)
-        else:
-          adb.StopApp(app_package)
-
-    if start_type in ["cold", "warm", "debug"]:
-      logging.info("Starting application %s", app_package)
-      adb.StartApp(app_package, start_type)
+      checksums.Checksums(
+          [hostpath.join(execroot, resource_apk)] +
+          sorted(set(lib for libs in ConvertNativeLibs(native_libs).values()
+                     for lib in libs)))
 
-    with open(output_marker, "wb") as _:
-      pass
-  except DeviceNotFoundError:
-    sys.exit("Error: Device not found")
-  except DeviceUnauthorizedError:
-    sys.exit("Error: Device unauthorized. Please check the confirmation "
-             "dialog on your device.")
-  except MultipleDevicesError as e:
-    sys.exit("Error: " + str(e) + "\nTry specifying a device serial with "
-             "\"bazel mobile-install --adb_arg=-s --adb_arg=$ANDROID_SERIAL\"")
-  except OldSdkException as e:
-    sys.exit("Error: The device does not support the API level specified in "
-             "the application's manifest. Check minSdkVersion in "
-             "AndroidManifest.xml")
-  except TimestampException as e:
-    sys.exit("Error:\n%s" % str(e))
-  except AdbError as e:
-    sys.exit("Error:\n%s" % str(e))
+    if len(adbs) == 1:
+      errors = [Install(adbs[0])]
+    else:
+      with futures.ThreadPoolExecutor(max_workers=len(adbs)) as executor:
+        errors = list(executor.map(Install, adbs))
   finally:
+    checksums.Save()
+    for adb in adbs:
+      adb.Close()
     shutil.rmtree(temp_dir, True)
 
+  if len(serials) == 1:
+    if errors[0]:
+      sys.exit(errors[0])
+  else:
+    logging.info("Installation summary:")
+    for serial, error in zip(serials, errors):
+      logging.info("%s: %s", serial, error or "Success")
+    failures = sum(1 for error in errors if error)
+    if failures:
+      sys.exit("Error: Installation failed on %d of %d devices" %
+               (failures, len(serials)))
+
+  with open(output_marker, "wb") as _:
+    pass
+
 
 def main(unused_argv):
   if FLAGS.verbosity == "1":  # 'verbosity' flag is defined in absl.logging
@@ -839,7 +1301,10 @@ def main(unused_argv):
       apk=FLAGS.apk,
       resource_apk=FLAGS.resource_apk,
       user_home_dir=FLAGS.user_home_dir,
-      extra_adb_args=FLAGS.extra_adb_arg)
+      extra_adb_args=FLAGS.extra_adb_arg,
+      adb_shell_session=FLAGS.adb_shell_session,
+      checksum_cache_path=FLAGS.checksum_cache,
+      device_serials=FLAGS.device_serial)
 
 
 if __name__ == "__main__":
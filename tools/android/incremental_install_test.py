@@ -21,6 +21,7 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import tempfile
 import unittest
 import zipfile
 
@@ -32,6 +33,7 @@ if six.PY3:
 else:
     import mock
 
+from tools.android import checksum_cache
 from tools.android import incremental_install
 
 
@@ -46,6 +48,8 @@ class MockAdb(object):
     self.package_timestamp = None
     self._last_package_timestamp = 1
     self.shell_cmdlns = []
+    self.pushed = []
+    self.push_invocations = []
     self.abi = "armeabi-v7a"
 
   def Exec(self, args):
@@ -59,10 +63,18 @@ class MockAdb(object):
     stderr = ""
     cmd = args[1]
     if cmd == "push":
-      # "/test/adb push local remote"
-      with open(args[2], "rb") as f:
-        content = f.read().decode("utf-8")
-      self.files[args[3]] = content
+      # "/test/adb push local remote" or "/test/adb push local... remote_dir"
+      sources = args[2:-1]
+      self.push_invocations.append(sources)
+      for source in sources:
+        if len(sources) == 1:
+          remote = args[-1]
+        else:
+          remote = os.path.join(args[-1], os.path.basename(source))
+        with open(source, "rb") as f:
+          content = f.read().decode("utf-8")
+        self.files[remote] = content
+        self.pushed.append(remote)
     elif cmd == "pull":
       # "/test/adb pull remote local"
       remote = args[2]
@@ -235,6 +247,79 @@ class IncrementalInstallTest(unittest.TestCase):
     self.assertEqual("content3", self._GetDeviceFile("dex/ip3"))
     self.assertEqual("resource apk", self._GetDeviceFile("resources.ap_"))
 
+  def testPushesLargestFirstAndManifestsLast(self):
+    self._CreateZip()
+    with open("dex1", "wb") as f:
+      f.write(b"much larger content")
+    with open("liba.so", "wb") as f:
+      f.write(b"liba")
+    self._CreateLocalManifest(
+        "zip1 zp1 ip1 0",
+        "dex1 - ip3 0")
+
+    self._CallIncrementalInstall(
+        incremental=False, native_libs=["armeabi-v7a:liba.so"])
+
+    pushed = [os.path.relpath(p, self._GetDeviceAppPath(""))
+              for p in self._mock_adb.pushed]
+    self.assertEqual("dex/ip3", pushed[0])
+    for files, manifest in [(["dex/ip1", "dex/ip3"], "dex/manifest"),
+                            (["resources.ap_"], "resources_checksum"),
+                            (["native/liba.so"], "native/native_manifest")]:
+      for f in files:
+        self.assertLess(pushed.index(f), pushed.index(manifest))
+
+  def testBatchesSmallFiles(self):
+    self._CreateZip("zip1", *[("zp%d" % i, "content%d" % i) for i in range(5)])
+    self._CreateLocalManifest(*["zip1 zp%d ip%d 0" % (i, i) for i in range(5)])
+
+    self._CallIncrementalInstall(incremental=False)
+
+    for i in range(5):
+      self.assertEqual("content%d" % i, self._GetDeviceFile("dex/ip%d" % i))
+    dex_pushes = [sources for sources in self._mock_adb.push_invocations
+                  if all(os.path.basename(source).startswith("ip")
+                         for source in sources)]
+    self.assertEqual(1, len(dex_pushes))
+    self.assertEqual(5, len(dex_pushes[0]))
+
+  def testDexesAreExtractedWhenPushed(self):
+    self._CreateZip()
+    self._CreateLocalManifest(
+        "zip1 zp1 ip1 0",
+        "zip1 zp2 ip2 0")
+    adb = incremental_install.Adb(
+        self._ADB_PATH, tempfile.mkdtemp(dir=os.environ["TEST_TMPDIR"]), 1,
+        None, [])
+    self.addCleanup(adb.Close)
+
+    with open(self._DEXMANIFEST) as f:
+      upload = incremental_install.PrepareDexUpload(
+          adb, self._EXEC_ROOT, self._GetDeviceAppPath(""), f.read(), True)
+    self.assertEqual(
+        [(incremental_install.ZipMember("./zip1", "zp1", 8),
+          self._GetDeviceAppPath("dex/ip1")),
+         (incremental_install.ZipMember("./zip1", "zp2", 8),
+          self._GetDeviceAppPath("dex/ip2"))],
+        sorted(upload.files, key=lambda f: f[1]))
+
+    incremental_install.PushUploads(adb, [upload])
+    self.assertEqual("content1", self._GetDeviceFile("dex/ip1"))
+    self.assertEqual("content2", self._GetDeviceFile("dex/ip2"))
+
+  def testBatchPushes(self):
+    pushes = [
+        (100, "a", "/d/a"),
+        (200, "b", "/d/b"),
+        (3 << 20, "big", "/d/big"),
+        (300, "c", "/e/c"),
+    ]
+    self.assertEqual(
+        incremental_install.BatchPushes(pushes, 4),
+        [(3 << 20, [("big", "/d/big")], "/d"),
+         (300, [("b", "/d/b"), ("a", "/d/a")], "/d"),
+         (300, [("c", "/e/c")], "/e")])
+
   def testSplitInstallToPristineDevice(self):
     with open("split1", "wb") as f:
       f.write(b"split_content1")
@@ -474,7 +559,7 @@ class IncrementalInstallTest(unittest.TestCase):
     # local file so that we can confirm that it was not updated.
     self._PutDeviceFile("resources.ap_", "resources")
     self._PutDeviceFile("resources_checksum",
-                        incremental_install.Checksum(self._RESOURCE_APK))
+                        checksum_cache.Sha256(self._RESOURCE_APK))
     self._PutDeviceFile("install_timestamp", "0")
     self._mock_adb.package_timestamp = "0"
 
@@ -623,6 +708,62 @@ class IncrementalInstallTest(unittest.TestCase):
         # make sure it's the right SystemExit reason
         self.assertTrue("Try specifying a device serial" in str(e))
 
+  def _MockDevices(self, *serials):
+    devices = dict((serial, MockAdb()) for serial in serials)
+
+    def Exec(args):
+      # "/test/adb -s serial ..."
+      self.assertEqual("-s", args[1])
+      return devices[args[2]].Exec(args[:1] + args[3:])
+
+    self._popen.side_effect = lambda args, **kwargs: Exec(args)
+    return devices
+
+  def _CallMultiDeviceInstall(self, *serials):
+    incremental_install.IncrementalInstall(
+        adb_path=self._ADB_PATH,
+        execroot=self._EXEC_ROOT,
+        stub_datafile=self._STUB_DATAFILE,
+        dexmanifest=self._DEXMANIFEST,
+        apk=self._APK,
+        resource_apk=self._RESOURCE_APK,
+        output_marker=self._OUTPUT_MARKER,
+        adb_jobs=1,
+        start_type="no",
+        user_home_dir="/home/root",
+        device_serials=list(serials))
+
+  def testInstallsToMultipleDevices(self):
+    devices = self._MockDevices("serial1", "serial2")
+    self._CreateZip()
+    manifest = self._CreateLocalManifest("zip1 zp1 ip1 0", "zip1 zp2 ip2 0")
+    if os.path.exists(self._OUTPUT_MARKER):
+      os.remove(self._OUTPUT_MARKER)
+
+    self._CallMultiDeviceInstall("serial1", "serial2")
+
+    for device in devices.values():
+      self._mock_adb = device
+      self.assertEqual(manifest, self._GetDeviceFile("dex/manifest"))
+      self.assertEqual("content1", self._GetDeviceFile("dex/ip1"))
+      self.assertEqual("content2", self._GetDeviceFile("dex/ip2"))
+      self.assertEqual("resource apk", self._GetDeviceFile("resources.ap_"))
+    self.assertTrue(os.path.exists(self._OUTPUT_MARKER))
+
+  def testMultipleDevicesFailureIsSummarized(self):
+    devices = self._MockDevices("serial1", "serial2")
+    devices["serial2"].SetError(1, "", "device unauthorized")
+    self._CreateZip()
+    self._CreateLocalManifest("zip1 zp1 ip1 0")
+
+    try:
+      self._CallMultiDeviceInstall("serial1", "serial2")
+      self.fail("Should have quit if installing to a device failed.")
+    except SystemExit as e:
+      self.assertTrue("failed on 1 of 2 devices" in str(e))
+    self._mock_adb = devices["serial1"]
+    self.assertEqual("content1", self._GetDeviceFile("dex/ip1"))
+
   def testIncrementalInstallOnPristineDevice(self):
     self._CreateZip()
     self._CreateLocalManifest(
@@ -671,5 +812,95 @@ class IncrementalInstallTest(unittest.TestCase):
       self.assertTrue("minSdkVersion" in str(e))
 
 
+@unittest.skipIf(os.name == "nt", "Uses a shell script as a fake adb.")
+class ShellSessionTest(unittest.TestCase):
+  """Tests for running shell commands in a persistent adb shell session."""
+
+  def setUp(self):
+    self._temp_dir = os.environ["TEST_TMPDIR"]
+    self._adb_path = os.path.join(self._temp_dir, "fake_adb")
+    self._log = os.path.join(self._temp_dir, "fake_adb.log")
+    if os.path.exists(self._log):
+      os.remove(self._log)
+
+  def _WriteFakeAdb(self, *lines):
+    with open(self._adb_path, "w") as f:
+      f.write("\n".join(("#!/bin/sh", "echo \"$@\" >> %s" % self._log) +
+                        lines) + "\n")
+    os.chmod(self._adb_path, 0o755)
+
+  def _CreateAdb(self):
+    adb = incremental_install.Adb(self._adb_path, self._temp_dir, 1, None, [],
+                                  shell_session=True)
+    self.addCleanup(adb.Close)
+    return adb
+
+  def _WriteFakeAdbWithSession(self, features="shell_v2,cmd"):
+    self._WriteFakeAdb(
+        '[ "$1" = features ] && echo %s && exit 0' % features,
+        '[ "$1 $2" = "shell -T" ] && exec sh',
+        '[ "$1" = shell ] && shift && exec sh -c "$*"')
+
+  def _ReadLog(self):
+    with open(self._log) as f:
+      return f.read().splitlines()
+
+  def testRunsCommandsInOneSession(self):
+    self._WriteFakeAdbWithSession()
+    adb = self._CreateAdb()
+    adb.Mkdir(os.path.join(self._temp_dir, "session_dir"))
+    _, stdout, stderr, _ = adb._Shell("printf out; echo err >&2")
+    self.assertEqual("out", stdout)
+    self.assertEqual("err", stderr)
+    self.assertTrue(os.path.isdir(os.path.join(self._temp_dir, "session_dir")))
+    self.assertEqual(["features", "shell -T"], self._ReadLog())
+
+  def testCommandsDontReadTheSession(self):
+    self._WriteFakeAdbWithSession()
+    adb = self._CreateAdb()
+    # Only the command's own input is redirected, not the rest of the script.
+    self.assertEqual("[]", adb._Shell('read line; echo "[$line]"')[1])
+    self.assertEqual("ok", adb._Shell("echo ok # comment")[1])
+    self.assertEqual(["features", "shell -T"], self._ReadLog())
+
+  def testFallsBackWithoutShellV2(self):
+    self._WriteFakeAdbWithSession(features="cmd")
+    adb = self._CreateAdb()
+    _, stdout, stderr, _ = adb._Shell("printf out; echo err >&2")
+    self.assertEqual("out", stdout)
+    self.assertEqual("err", stderr)
+    self.assertEqual(["features", "shell printf out; echo err >&2"],
+                     self._ReadLog())
+
+  def testFallsBackOnTimeout(self):
+    self._WriteFakeAdb(
+        '[ "$1" = features ] && echo shell_v2 && exit 0',
+        '[ "$1 $2" = "shell -T" ] && exec sleep 60',
+        '[ "$1" = shell ] && shift && exec sh -c "$*"')
+    adb = self._CreateAdb()
+    with mock.patch.object(incremental_install, "_SHELL_SESSION_TIMEOUT_SECS",
+                           0.5):
+      self.assertEqual("ok", adb._Shell("echo ok")[1])
+      self.assertEqual("ok", adb._Shell("echo ok")[1])
+    self.assertEqual(["features", "shell -T", "shell echo ok", "shell echo ok"],
+                     self._ReadLog())
+
+  def testReportsExitCode(self):
+    self._WriteFakeAdbWithSession()
+    adb = self._CreateAdb()
+    with self.assertRaises(incremental_install.AdbError) as cm:
+      adb._Shell("echo failed; false")
+    self.assertEqual(1, cm.exception.returncode)
+    self.assertEqual("failed", cm.exception.stdout)
+    # The session survives failed commands.
+    self.assertEqual("ok", adb._Shell("echo ok")[1])
+
+  def testDeviceNotFound(self):
+    self._WriteFakeAdb("echo 'error: device not found' >&2", "exit 1")
+    adb = self._CreateAdb()
+    with self.assertRaises(incremental_install.DeviceNotFoundError):
+      adb.GetAbi()
+
+
 if __name__ == "__main__":
   unittest.main()
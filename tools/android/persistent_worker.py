@@ -0,0 +1,282 @@
+# Lint as: python2, python3
+# pylint: disable=g-direct-third-party-import
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Runs the Android Python tools as Bazel persistent workers.
+
+Usage:
+  persistent_worker.py <tool> --persistent_worker
+  persistent_worker.py <tool> <tool arguments>...
+
+With --persistent_worker, reads WorkRequests from stdin and writes
+WorkResponses to stdout, using Bazel's length-delimited protobuf worker
+protocol, and runs the tool's main function in-process for each request. This
+saves starting an interpreter and importing the tool's dependencies for every
+action. Otherwise, runs the tool once with the given arguments.
+
+A worker process hosts a single tool, because several tools define absl flags
+of the same name.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import importlib
+import sys
+import traceback
+
+# Do not edit this line. Copybara replaces it with PY2 migration helper.
+from absl import flags
+import six
+
+# Tools that can be run by the worker, mapped to whether they parse their
+# arguments with absl flags. Their main functions take argv.
+TOOLS = {
+    "aar_embedded_jars_extractor": True,
+    "aar_native_libs_zip_creator": True,
+    "aar_resources_extractor": True,
+    "build_incremental_dexmanifest": False,
+    "build_split_manifest": True,
+    "resource_extractor": False,
+    "stubify_manifest": True,
+}
+
+USAGE = """Usage: persistent_worker.py <tool> --persistent_worker
+       persistent_worker.py <tool> <tool arguments>...
+Tools: """ + ", ".join(sorted(TOOLS))
+
+# Wire types of protobuf fields.
+_VARINT = 0
+_FIXED64 = 1
+_LENGTH_DELIMITED = 2
+_FIXED32 = 5
+
+# Field numbers of WorkRequest and WorkResponse, see
+# src/main/protobuf/worker_protocol.proto.
+_REQUEST_ARGUMENTS = 1
+_REQUEST_ID = 3
+_RESPONSE_EXIT_CODE = 1
+_RESPONSE_OUTPUT = 2
+_RESPONSE_REQUEST_ID = 3
+
+
+class ProtocolError(Exception):
+  """Raised when a WorkRequest can't be read."""
+
+
+def _DecodeVarint(data, pos):
+  """Decodes the varint at data[pos:] and returns (value, next pos)."""
+  result = 0
+  shift = 0
+  while True:
+    if pos >= len(data):
+      raise ProtocolError("Truncated varint")
+    byte = six.indexbytes(data, pos)
+    pos += 1
+    result |= (byte & 0x7f) << shift
+    if not byte & 0x80:
+      return result, pos
+    shift += 7
+
+
+def _EncodeVarint(value):
+  """Encodes a varint. Negative values are encoded as 64 bit integers."""
+  if value < 0:
+    value += 1 << 64
+  encoded = bytearray()
+  while True:
+    byte = value & 0x7f
+    value >>= 7
+    if value:
+      encoded.append(byte | 0x80)
+    else:
+      encoded.append(byte)
+      return bytes(encoded)
+
+
+def _ToInt32(value):
+  """Converts a decoded varint to an int32."""
+  value &= 0xffffffff
+  return value - (1 << 32) if value & 0x80000000 else value
+
+
+def ParseWorkRequest(data):
+  """Parses a serialized WorkRequest.
+
+  Args:
+    data: The serialized WorkRequest, without its length prefix.
+
+  Returns:
+    (arguments, request id). Inputs are ignored.
+
+  Raises:
+    ProtocolError: data isn't a valid WorkRequest.
+  """
+  arguments = []
+  request_id = 0
+  pos = 0
+  while pos < len(data):
+    key, pos = _DecodeVarint(data, pos)
+    field, wire_type = key >> 3, key & 0x7
+    if wire_type == _VARINT:
+      value, pos = _DecodeVarint(data, pos)
+      if field == _REQUEST_ID:
+        request_id = _ToInt32(value)
+    elif wire_type == _LENGTH_DELIMITED:
+      length, pos = _DecodeVarint(data, pos)
+      if pos + length > len(data):
+        raise ProtocolError("Truncated field %d" % field)
+      if field == _REQUEST_ARGUMENTS:
+        arguments.append(data[pos:pos + length].decode("utf-8"))
+      pos += length
+    elif wire_type == _FIXED64:
+      pos += 8
+    elif wire_type == _FIXED32:
+      pos += 4
+    else:
+      raise ProtocolError("Unsupported wire type %d" % wire_type)
+  return arguments, request_id
+
+
+def SerializeWorkResponse(exit_code, output, request_id):
+  """Serializes a WorkResponse, without a length prefix."""
+  data = b""
+  if exit_code:
+    data += _EncodeVarint(_RESPONSE_EXIT_CODE << 3 | _VARINT)
+    data += _EncodeVarint(exit_code)
+  if output:
+    output = six.ensure_binary(output, "utf-8")
+    data += _EncodeVarint(_RESPONSE_OUTPUT << 3 | _LENGTH_DELIMITED)
+    data += _EncodeVarint(len(output)) + output
+  if request_id:
+    data += _EncodeVarint(_RESPONSE_REQUEST_ID << 3 | _VARINT)
+    data += _EncodeVarint(request_id)
+  return data
+
+
+def ReadWorkRequest(stream):
+  """Reads a length-delimited WorkRequest from a binary stream.
+
+  Args:
+    stream: The stream to read from.
+
+  Returns:
+    (arguments, request id), or None if the stream is at its end.
+
+  Raises:
+    ProtocolError: The stream doesn't contain a valid WorkRequest.
+  """
+  prefix = b""
+  while True:
+    byte = stream.read(1)
+    if not byte:
+      if prefix:
+        raise ProtocolError("Truncated length prefix")
+      return None
+    prefix += byte
+    if not six.indexbytes(byte, 0) & 0x80:
+      break
+  length, _ = _DecodeVarint(prefix, 0)
+  data = stream.read(length)
+  if len(data) != length:
+    raise ProtocolError("Truncated WorkRequest")
+  return ParseWorkRequest(data)
+
+
+def WriteWorkResponse(stream, exit_code, output, request_id):
+  """Writes a length-delimited WorkResponse to a binary stream."""
+  data = SerializeWorkResponse(exit_code, output, request_id)
+  stream.write(_EncodeVarint(len(data)) + data)
+  stream.flush()
+
+
+def _ExitCode(code):
+  """Returns the exit code for the argument of sys.exit()."""
+  if code is None:
+    return 0
+  if isinstance(code, int):
+    return code
+  print(code)
+  return 1
+
+
+def RunTool(tool, arguments):
+  """Runs a tool's main function in-process.
+
+  Args:
+    tool: The name of the tool, a key of TOOLS.
+    arguments: The tool's arguments, without the program name.
+
+  Returns:
+    (exit code, everything the tool printed).
+  """
+  module = importlib.import_module("tools.android." + tool)
+  output = six.StringIO()
+  old_stdout, old_stderr = sys.stdout, sys.stderr
+  sys.stdout = sys.stderr = output
+  try:
+    argv = [tool] + list(arguments)
+    if TOOLS[tool]:
+      # Forget the flags of the previous request.
+      flags.FLAGS.unparse_flags()
+      argv = flags.FLAGS(argv)
+    module.main(argv)
+    exit_code = 0
+  except flags.Error as e:
+    print("%s: %s" % (tool, e))
+    exit_code = 1
+  except SystemExit as e:
+    exit_code = _ExitCode(e.code)
+  except Exception:  # pylint: disable=broad-except
+    traceback.print_exc()
+    exit_code = 1
+  finally:
+    sys.stdout, sys.stderr = old_stdout, old_stderr
+  return exit_code, output.getvalue()
+
+
+def RunWorker(tool, stdin, stdout):
+  """Serves WorkRequests for a tool until stdin is closed.
+
+  Args:
+    tool: The name of the tool, a key of TOOLS.
+    stdin: Binary stream to read WorkRequests from.
+    stdout: Binary stream to write WorkResponses to.
+  """
+  while True:
+    request = ReadWorkRequest(stdin)
+    if request is None:
+      return
+    arguments, request_id = request
+    exit_code, output = RunTool(tool, arguments)
+    WriteWorkResponse(stdout, exit_code, output, request_id)
+
+
+def main(argv):
+  if len(argv) < 2 or argv[1] not in TOOLS:
+    print(USAGE)
+    sys.exit(1)
+  tool = argv[1]
+  if argv[2:] == ["--persistent_worker"]:
+    RunWorker(tool, getattr(sys.stdin, "buffer", sys.stdin),
+              getattr(sys.stdout, "buffer", sys.stdout))
+  else:
+    exit_code, output = RunTool(tool, argv[2:])
+    sys.stdout.write(output)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -0,0 +1,128 @@
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for persistent_worker."""
+
+import io
+import os
+import unittest
+import zipfile
+
+from tools.android import persistent_worker
+
+
+def _Request(arguments, request_id=0):
+  """Returns a length-delimited WorkRequest, serialized by hand."""
+  data = b""
+  for argument in arguments:
+    argument = argument.encode("utf-8")
+    data += b"\x0a" + bytearray([len(argument)]) + argument
+  # An input, which the worker ignores.
+  data += b"\x12\x03\x0a\x01a"
+  if request_id:
+    data += b"\x18" + bytearray([request_id])
+  return bytes(bytearray([len(data)])) + data
+
+
+def _Responses(stream):
+  """Parses the length-delimited WorkResponses written to a stream."""
+  data = stream.getvalue()
+  responses = []
+  pos = 0
+  while pos < len(data):
+    length, pos = persistent_worker._DecodeVarint(data, pos)
+    response = {}
+    end = pos + length
+    while pos < end:
+      key, pos = persistent_worker._DecodeVarint(data, pos)
+      if key & 0x7 == 2:
+        length, pos = persistent_worker._DecodeVarint(data, pos)
+        response[key >> 3] = data[pos:pos + length].decode("utf-8")
+        pos += length
+      else:
+        response[key >> 3], pos = persistent_worker._DecodeVarint(data, pos)
+    responses.append(response)
+  return responses
+
+
+class PersistentWorkerTest(unittest.TestCase):
+  """Unit tests for persistent_worker.py."""
+
+  def setUp(self):
+    os.chdir(os.environ["TEST_TMPDIR"])
+
+  def testParseWorkRequest(self):
+    self.assertEqual(
+        (["--foo", "bar"], 7),
+        persistent_worker.ReadWorkRequest(
+            io.BytesIO(_Request(["--foo", "bar"], 7))))
+    self.assertIsNone(persistent_worker.ReadWorkRequest(io.BytesIO()))
+
+  def testTruncatedWorkRequest(self):
+    with self.assertRaises(persistent_worker.ProtocolError):
+      persistent_worker.ReadWorkRequest(io.BytesIO(_Request(["foo"])[:-1]))
+
+  def testSerializeWorkResponse(self):
+    self.assertEqual(b"", persistent_worker.SerializeWorkResponse(0, "", 0))
+    self.assertEqual(b"\x08\x01\x12\x02ok\x18\x96\x01",
+                     persistent_worker.SerializeWorkResponse(1, "ok", 150))
+
+  def testRunsRequestsInProcess(self):
+    with zipfile.ZipFile("input.jar", "w") as input_jar:
+      input_jar.writestr("a/b", "resource")
+      input_jar.writestr("Foo.class", "class")
+    stdin = io.BytesIO(
+        _Request(["input.jar", "output1.zip"], 1) +
+        _Request(["input.jar"], 2) +
+        _Request(["input.jar", "output2.zip"], 3))
+    stdout = io.BytesIO()
+
+    persistent_worker.RunWorker("resource_extractor", stdin, stdout)
+
+    responses = _Responses(stdout)
+    self.assertEqual(3, len(responses))
+    self.assertEqual({3: 1}, responses[0])
+    self.assertEqual(1, responses[1][1])
+    self.assertIn("Usage", responses[1][2])
+    self.assertEqual({3: 3}, responses[2])
+    for output in ("output1.zip", "output2.zip"):
+      with zipfile.ZipFile(output, "r") as output_zip:
+        self.assertEqual(["a/b"], output_zip.namelist())
+
+  def testResetsFlagsBetweenRequests(self):
+    with zipfile.ZipFile("input.aar", "w") as aar:
+      aar.writestr("jni/x86/lib.so", "x86 lib")
+    stdin = io.BytesIO(
+        _Request(["--input_aar=input.aar", "--cpu=x86",
+                  "--output_zip=libs1.zip"]) +
+        _Request(["--input_aar=input.aar", "--output_zip=libs2.zip"]) +
+        _Request(["--input_aar=input.aar", "--cpu=arm64-v8a",
+                  "--output_zip=libs3.zip"]))
+    stdout = io.BytesIO()
+
+    persistent_worker.RunWorker("aar_native_libs_zip_creator", stdin, stdout)
+
+    responses = _Responses(stdout)
+    self.assertEqual({}, responses[0])
+    with zipfile.ZipFile("libs1.zip", "r") as libs:
+      self.assertEqual(["lib/x86/lib.so"], libs.namelist())
+    # --cpu is required, and not remembered from the previous request.
+    self.assertEqual(1, responses[1][1])
+    self.assertIn("cpu", responses[1][2])
+    self.assertEqual(1, responses[2][1])
+    self.assertIn("missing native libs", responses[2][2])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -16,7 +16,8 @@
 
 The input jar will be opened as a zip file, and its entries will be copied into
 a new zip file, excepting any which are suspected not to be resources
- (e.g., Java class files, etc).
+ (e.g., Java class files, etc). Entries are copied in their compressed form,
+without decompressing and recompressing them.
 
 Usage:
   python resource_extractor.py <input jar> <output zip>
@@ -24,6 +25,10 @@ Usage:
 
 from __future__ import print_function
 
+import copy
+import os
+import re
+import struct
 import sys
 import zipfile
 
@@ -63,6 +68,30 @@ EXCLUDED_DIRECTORIES = (
 )
 
 
+def _Alternatives(strings):
+  return '|'.join(re.escape(string) for string in strings)
+
+
+# Matches the lowercased paths of entries that aren't resources, in one pass.
+_EXCLUDED_PATH = re.compile(
+    # Excluded extensions.
+    '(?:%s)$' % _Alternatives(EXCLUDED_EXTENSIONS) +
+    # Hidden files and excluded filenames.
+    r'|(?:^|/)(?:\.[^/]*|%s)$' % _Alternatives(EXCLUDED_FILENAMES) +
+    # Files in excluded directories, but allow META-INF/services at the root
+    # to support ServiceLoader.
+    '|^(?!meta-inf/services/)(?:.*/)?(?:%s)/' %
+    _Alternatives(EXCLUDED_DIRECTORIES))
+
+# General purpose bit flags of zip entries.
+_FLAG_ENCRYPTED = 0x1
+_FLAG_DATA_DESCRIPTOR = 0x8
+
+_LOCAL_FILE_HEADER_SIGNATURE = b'PK\x03\x04'
+
+_COPY_BUFFER_SIZE = 1 << 16
+
+
 def IsValidPath(path):
   """Checks if the provided path describes a resource.
 
@@ -72,27 +101,64 @@ def IsValidPath(path):
   Returns:
     True if the path is a resource.
   """
-  path = path.lower()
-  if any(path.endswith(extension) for extension in EXCLUDED_EXTENSIONS):
-    return False
+  return not _EXCLUDED_PATH.search(path.lower())
+
 
-  segments = path.split('/')
-  filename = segments[-1]
-  if filename.startswith('.') or filename in EXCLUDED_FILENAMES:
-    return False
+def CopyEntry(input_zip, info, output_zip):
+  """Copies an entry between zip files without recompressing it.
 
-  dirs = segments[:-1]
-  # allow META-INF/services at the root to support ServiceLoader
-  if dirs[:2] == ['meta-inf', 'services']:
-    return True
+  The compressed data is copied as is, so the entry keeps its compression
+  method, CRC and metadata.
 
-  return not any(dir in EXCLUDED_DIRECTORIES for dir in dirs)
+  Args:
+    input_zip: the zip file to copy from, open for reading
+    info: the ZipInfo of the entry in input_zip
+    output_zip: the zip file to copy to, open for writing
+
+  Raises:
+    zipfile.BadZipfile: the entry's local file header is corrupt.
+  """
+  if info.flag_bits & _FLAG_ENCRYPTED:
+    # Let zipfile deal with encryption.
+    output_zip.writestr(info, input_zip.read(info))
+    return
+
+  src = input_zip.fp
+  src.seek(info.header_offset)
+  header = src.read(zipfile.sizeFileHeader)
+  if (len(header) != zipfile.sizeFileHeader or
+      header[:4] != _LOCAL_FILE_HEADER_SIGNATURE):
+    raise zipfile.BadZipfile('Bad local file header for %s' % info.filename)
+  filename_length, extra_length = struct.unpack('<HH', header[26:30])
+  src.seek(filename_length + extra_length, os.SEEK_CUR)
+
+  # The central directory has the sizes and CRC, so the copy's local header can
+  # include them instead of being followed by a data descriptor.
+  out_info = copy.copy(info)
+  out_info.flag_bits &= ~_FLAG_DATA_DESCRIPTOR
+  dest = output_zip.fp
+  out_info.header_offset = dest.tell()
+  dest.write(out_info.FileHeader())
+  remaining = info.compress_size
+  while remaining > 0:
+    data = src.read(min(remaining, _COPY_BUFFER_SIZE))
+    if not data:
+      raise zipfile.BadZipfile('Truncated data for %s' % info.filename)
+    dest.write(data)
+    remaining -= len(data)
+
+  output_zip.filelist.append(out_info)
+  output_zip.NameToInfo[out_info.filename] = out_info
+  output_zip._didModify = True  # pylint: disable=protected-access
+  if hasattr(output_zip, 'start_dir'):
+    # Python 3 writes the central directory at start_dir.
+    output_zip.start_dir = dest.tell()
 
 
 def ExtractResources(input_jar, output_zip):
-  for path in input_jar.namelist():
-    if IsValidPath(path):
-      output_zip.writestr(input_jar.getinfo(path), input_jar.read(path))
+  for info in input_jar.infolist():
+    if IsValidPath(info.filename):
+      CopyEntry(input_jar, info, output_zip)
 
 
 def main(argv):
@@ -76,6 +76,28 @@ class ResourceExtractorTest(unittest.TestCase):
     resource_extractor.ExtractResources(input_jar, output_zip)
     self.assertEqual((1982, 1, 1, 0, 0, 0), output_zip.getinfo("a").date_time)
 
+  def testEntriesAreCopiedWithoutRecompression(self):
+    input_jar = zipfile.ZipFile(io.BytesIO(), "w")
+    input_jar.writestr("stored", "stored content")
+    input_jar.writestr(zipfile.ZipInfo("deflated"), "deflated content " * 100,
+                       zipfile.ZIP_DEFLATED)
+    input_jar.writestr("Foo.class", "class")
+    output = io.BytesIO()
+    output_zip = zipfile.ZipFile(output, "w")
+    resource_extractor.ExtractResources(input_jar, output_zip)
+    output_zip.close()
+
+    output_zip = zipfile.ZipFile(output, "r")
+    self.assertIsNone(output_zip.testzip())
+    self.assertEqual(["stored", "deflated"], output_zip.namelist())
+    self.assertEqual(b"stored content", output_zip.read("stored"))
+    self.assertEqual(b"deflated content " * 100, output_zip.read("deflated"))
+    for name in output_zip.namelist():
+      self.assertEqual(input_jar.getinfo(name).compress_type,
+                       output_zip.getinfo(name).compress_type)
+      self.assertEqual(input_jar.getinfo(name).compress_size,
+                       output_zip.getinfo(name).compress_size)
+
 
 if __name__ == "__main__":
   unittest.main()
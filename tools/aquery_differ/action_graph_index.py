@@ -0,0 +1,585 @@
+# Lint as: python2, python3
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Fingerprint index over the actions of an ActionGraphContainer.
+
+Each action is reduced once to a digest of its command line and, if inputs are
+compared, an order-independent digest of its flattened inputs, keyed by its
+output files. Actions with equal digests on both sides of a diff are skipped
+without looking at them again; only mismatching actions are loaded in full and
+diffed.
+
+Binary containers can be indexed in a streaming fashion: an
+ActionGraphContainer only consists of repeated message fields, which are
+encoded on the wire as a sequence of length-delimited records. Any sequence of
+whole records is thus a valid container too, so the file is parsed in chunks of
+records. A first pass reads the artifacts, path fragments and dep sets, and a
+second pass digests the actions chunk by chunk. Only the fingerprints and record
+locations of the actions are kept afterwards; the full action is later parsed
+again by seeking back to its record.
+
+An index can be saved to disk and loaded again, so that a baseline graph is
+hashed once and reused against many other graphs.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import collections
+import hashlib
+import itertools
+import json
+import os
+import struct
+
+from google.protobuf import text_format
+from src.main.protobuf import analysis_v2_pb2
+from tools.aquery_differ.resolvers.dep_set_resolver import DepSetResolver
+from tools.aquery_differ.resolvers.path_fragment_resolver import PathFragmentResolver
+
+# Field numbers of ActionGraphContainer, see analysis_v2.proto.
+_ARTIFACTS_FIELD = 1
+_ACTIONS_FIELD = 2
+_DEP_SET_OF_FILES_FIELD = 4
+_PATH_FRAGMENTS_FIELD = 8
+_METADATA_FIELDS = (_ARTIFACTS_FIELD, _DEP_SET_OF_FILES_FIELD,
+                    _PATH_FRAGMENTS_FIELD)
+
+_WIRETYPE_VARINT = 0
+_WIRETYPE_FIXED64 = 1
+_WIRETYPE_LENGTH_DELIMITED = 2
+_WIRETYPE_FIXED32 = 5
+
+_UINT64_MASK = (1 << 64) - 1
+
+# Size of the chunks containers are read in when streaming.
+_CHUNK_SIZE = 1 << 20
+
+_INDEX_MAGIC = b"aquery_differ_index_v3\n"
+_INDEX_ENTRIES_HEADER = struct.Struct("<II")
+_INDEX_ENTRY = struct.Struct("<32sQQQ")
+
+# Fingerprints and location of a single action.
+#   cmdline_digest: digest of the action's arguments.
+#   inputs_digest: order-independent digest of the flattened input paths, or
+#     None if the index was created without inputs.
+#   location: (offset, size) of the serialized Action record for streamed
+#     indexes, the index of the action in the container otherwise.
+ActionEntry = collections.namedtuple(
+    "ActionEntry", ["cmdline_digest", "inputs_digest", "location"])
+
+
+def read_container(path, input_type):
+  """Parses a whole ActionGraphContainer in "proto" or "textproto" format."""
+  action_graph_container = analysis_v2_pb2.ActionGraphContainer()
+  if input_type == "proto":
+    with open(path, "rb") as f:
+      action_graph_container.ParseFromString(f.read())
+  else:
+    with open(path, "r") as f:
+      text_format.Merge(f.read(), action_graph_container)
+  return action_graph_container
+
+
+def _decode_varint(buf, pos):
+  """Decodes the base 128 varint at buf[pos:].
+
+  Args:
+    buf: the bytearray to decode from.
+    pos: the position of the varint in buf.
+
+  Returns:
+    (value, position after the varint), or (None, pos) if buf ends before the
+    varint does.
+  """
+  result = 0
+  shift = 0
+  end = len(buf)
+  start = pos
+  while pos < end:
+    b = buf[pos]
+    pos += 1
+    result |= (b & 0x7f) << shift
+    if not b & 0x80:
+      return result, pos
+    shift += 7
+    if shift >= 64:
+      raise ValueError("Malformed varint in action graph container.")
+  return None, start
+
+
+def iter_containers(f, fields=None):
+  """Parses a serialized container in chunks of whole records.
+
+  Only the record headers are decoded in Python. The requested records of each
+  chunk of about _CHUNK_SIZE bytes are parsed together as a container.
+
+  Args:
+    f: a binary file object positioned at the start of the container.
+    fields: the field numbers of the records to parse, or None for all.
+
+  Yields:
+    Tuples of (container, action locations). The container holds the requested
+    records of a chunk, and action locations lists the (offset, size) of the
+    payload of each of its actions in the file.
+
+  Raises:
+    ValueError: the file isn't a valid serialized container.
+  """
+  buf = b""
+  # The offset of buf in the file.
+  buf_offset = f.tell()
+  while True:
+    chunk = f.read(_CHUNK_SIZE)
+    if not chunk:
+      if buf:
+        raise ValueError("Truncated record in action graph container.")
+      return
+    buf += chunk
+    # Indexing a bytearray yields ints on both Python 2 and 3.
+    view = bytearray(buf)
+    end = len(view)
+    pos = 0
+    # (start, end) of the runs of consecutive requested records.
+    runs = []
+    action_locations = []
+    while pos < end:
+      record_start = pos
+      # Most tags fit in one byte and most sizes in one or two.
+      tag = view[pos]
+      if tag & 0x80:
+        tag, pos = _decode_varint(view, pos)
+        if tag is None:
+          break
+      else:
+        pos += 1
+      wire_type = tag & 0x7
+      if wire_type == _WIRETYPE_LENGTH_DELIMITED:
+        if pos < end and not view[pos] & 0x80:
+          size = view[pos]
+          pos += 1
+        elif pos + 1 < end and not view[pos + 1] & 0x80:
+          size = (view[pos] & 0x7f) | (view[pos + 1] << 7)
+          pos += 2
+        else:
+          size, pos = _decode_varint(view, pos)
+          if size is None:
+            pos = record_start
+            break
+        if pos + size > end:
+          pos = record_start
+          break
+        field_number = tag >> 3
+        if fields is None or field_number in fields:
+          if runs and runs[-1][1] == record_start:
+            runs[-1][1] = pos + size
+          else:
+            runs.append([record_start, pos + size])
+          if field_number == _ACTIONS_FIELD:
+            action_locations.append((buf_offset + pos, size))
+        pos += size
+      elif wire_type == _WIRETYPE_VARINT:
+        value, pos = _decode_varint(view, pos)
+        if value is None:
+          pos = record_start
+          break
+      elif wire_type in (_WIRETYPE_FIXED64, _WIRETYPE_FIXED32):
+        pos += 8 if wire_type == _WIRETYPE_FIXED64 else 4
+        if pos > end:
+          pos = record_start
+          break
+      else:
+        raise ValueError("Unsupported wire type %d in action graph container." %
+                         wire_type)
+    if runs:
+      container = analysis_v2_pb2.ActionGraphContainer()
+      if len(runs) == 1 and runs[0] == [0, end]:
+        container.ParseFromString(buf)
+      else:
+        container.ParseFromString(b"".join(
+            buf[run_start:run_end] for run_start, run_end in runs))
+      yield container, action_locations
+    # Keep the incomplete record at the end of the chunk, if any.
+    buf = buf[pos:]
+    buf_offset += pos
+
+
+def _cmdline_digest(arguments):
+  # Arguments can't contain NUL characters, so hashing them joined by NUL and
+  # prefixed by their count is unambiguous.
+  joined = u"%d\0" % len(arguments) + u"\0".join(arguments)
+  return hashlib.sha256(joined.encode("utf-8")).digest()
+
+
+def _path_hash(path):
+  return struct.unpack("<Q",
+                       hashlib.sha256(path.encode("utf-8")).digest()[:8])[0]
+
+
+class _ArtifactPaths(object):
+  """Artifact id -> path mapping that resolves paths on every lookup.
+
+  Paths aren't kept, since most artifacts are only looked up once or twice;
+  their shared prefixes are memoized by the PathFragmentResolver.
+
+  Like path fragments, artifacts of a parsed container are looked up by
+  position and only copied into a dict if their ids aren't sequential.
+  """
+
+  def __init__(self, artifacts, artifact_to_path_fragment,
+               path_fragment_resolver):
+    self._artifacts = artifacts
+    self._artifact_to_path_fragment = artifact_to_path_fragment
+    self._path_fragment_resolver = path_fragment_resolver
+
+  def __getitem__(self, artifact_id):
+    if self._artifact_to_path_fragment is None:
+      if 0 < artifact_id <= len(self._artifacts):
+        artifact = self._artifacts[artifact_id - 1]
+        if artifact.id == artifact_id:
+          return self._path_fragment_resolver.resolve(artifact.path_fragment_id)
+      self._artifact_to_path_fragment = {
+          artifact.id: artifact.path_fragment_id
+          for artifact in self._artifacts
+      }
+      self._artifacts = None
+    return self._path_fragment_resolver.resolve(
+        self._artifact_to_path_fragment[artifact_id])
+
+
+class _ActionGraphMetadata(object):
+  """The artifacts, path fragments and dep sets of an action graph."""
+
+  def __init__(self, artifacts, artifact_to_path_fragment, path_fragments,
+               dep_set_of_files):
+    self.artifact_id_to_path = _ArtifactPaths(
+        artifacts, artifact_to_path_fragment,
+        PathFragmentResolver(path_fragments))
+    # Dep sets are only needed to compare inputs, so they're copied lazily.
+    self._dep_set_of_files = dep_set_of_files
+    self._dep_set_resolver = None
+    self._dep_set_digests = {}
+
+  @classmethod
+  def from_container(cls, action_graph_container):
+    return cls(action_graph_container.artifacts, None,
+               action_graph_container.path_fragments,
+               action_graph_container.dep_set_of_files)
+
+  @classmethod
+  def from_containers(cls, containers):
+    """Builds the metadata from the chunks yielded by iter_containers."""
+    artifact_to_path_fragment = {}
+    chunks = []
+    for container, _ in containers:
+      for artifact in container.artifacts:
+        artifact_to_path_fragment[artifact.id] = artifact.path_fragment_id
+      chunks.append(container)
+    # The resolvers copy what they need, after which the chunks are released.
+    # Only chunks with dep sets are kept until the dep sets are needed.
+    return cls(
+        None,
+        artifact_to_path_fragment,
+        itertools.chain.from_iterable(
+            chunk.path_fragments for chunk in chunks),
+        itertools.chain.from_iterable([
+            chunk.dep_set_of_files
+            for chunk in chunks
+            if len(chunk.dep_set_of_files)
+        ]))
+
+  def output_files(self, output_ids):
+    """Returns the sorted, space-separated paths of the given outputs."""
+    if len(output_ids) == 1:
+      return self.artifact_id_to_path[output_ids[0]]
+    return " ".join(
+        sorted([self.artifact_id_to_path[output_id]
+                for output_id in output_ids]))
+
+  def _get_dep_set_resolver(self):
+    if self._dep_set_resolver is None:
+      self._dep_set_resolver = DepSetResolver(self._dep_set_of_files,
+                                              self.artifact_id_to_path)
+      self._dep_set_of_files = None
+    return self._dep_set_resolver
+
+  def inputs_digest(self, input_dep_set_ids):
+    digest = 0
+    for dep_set_id in input_dep_set_ids:
+      digest += self._dep_set_digest(dep_set_id)
+    return digest & _UINT64_MASK
+
+  def _dep_set_digest(self, dep_set_id):
+    """Returns an order-independent digest of a dep set's flattened paths.
+
+    The digest is the sum of the hashes of all paths reachable from the dep
+    set, counted once per path to them. Equal digests thus imply equal
+    flattened inputs, while unequal digests may still flatten to the same
+    inputs. It is computed bottom-up without recursion and memoized per dep
+    set.
+
+    Args:
+      dep_set_id: id of the dep set to digest.
+
+    Returns:
+      A 64 bit int.
+    """
+    id_to_dep_set = self._get_dep_set_resolver().id_to_dep_set
+    stack = [dep_set_id]
+    while stack:
+      current = stack[-1]
+      if current in self._dep_set_digests:
+        stack.pop()
+        continue
+      direct_artifact_ids, transitive_dep_set_ids = id_to_dep_set[current]
+      missing = [
+          t for t in transitive_dep_set_ids if t not in self._dep_set_digests
+      ]
+      if missing:
+        stack.extend(missing)
+        continue
+      digest = 0
+      for artifact_id in direct_artifact_ids:
+        digest += _path_hash(self.artifact_id_to_path[artifact_id])
+      for transitive_id in transitive_dep_set_ids:
+        digest += self._dep_set_digests[transitive_id]
+      self._dep_set_digests[current] = digest & _UINT64_MASK
+      stack.pop()
+    return self._dep_set_digests[dep_set_id]
+
+  def resolve_inputs(self, action):
+    """Returns the sorted, flattened input paths of an action."""
+    return sorted(
+        self._get_dep_set_resolver().resolve_ids(action.input_dep_set_ids))
+
+
+class ActionGraphIndex(object):
+  """Fingerprints of the actions of a graph, keyed by their output files.
+
+  Use index_container, index_file or load_index to create instances.
+  """
+
+  def __init__(self, actions, path, input_type, streamed, inputs,
+               container=None, metadata=None):
+    # An OrderedDict {output files: ActionEntry}, in action order.
+    self.actions = actions
+    # Whether the entries have inputs digests.
+    self.inputs = inputs
+    self._path = path
+    self._input_type = input_type
+    self._streamed = streamed
+    self._container = container
+    self._metadata = metadata
+
+  def __getstate__(self):
+    # Indexes are returned by the worker processes of aquery_differ_v2 --jobs.
+    # Only the entries are sent back, packed like in saved indexes, which is
+    # much faster than pickling them one by one. The container and metadata
+    # are read again from the file if mismatching actions need to be loaded.
+    if self._path is None:
+      raise ValueError("Only indexes of files can be pickled.")
+    return (_pack_entries(self.actions, self._streamed), self._path,
+            self._input_type, self._streamed, self.inputs)
+
+  def __setstate__(self, state):
+    data, path, input_type, streamed, inputs = state
+    self.__init__(
+        _unpack_entries(data, streamed, inputs), path, input_type, streamed,
+        inputs)
+
+  def _get_container(self):
+    if self._container is None:
+      self._container = read_container(self._path, self._input_type)
+    return self._container
+
+  def _get_metadata(self):
+    if self._metadata is None:
+      if self._streamed:
+        with open(self._path, "rb") as f:
+          self._metadata = _ActionGraphMetadata.from_containers(
+              iter_containers(f, _METADATA_FIELDS))
+      else:
+        self._metadata = _ActionGraphMetadata.from_container(
+            self._get_container())
+    return self._metadata
+
+  def load_action(self, output_files):
+    """Returns the full action that generates the given output files."""
+    location = self.actions[output_files].location
+    if not self._streamed:
+      return self._get_container().actions[location]
+    offset, size = location
+    with open(self._path, "rb") as f:
+      f.seek(offset)
+      data = f.read(size)
+    action = analysis_v2_pb2.Action()
+    action.ParseFromString(data)
+    return action
+
+  def resolve_inputs(self, action):
+    """Returns the sorted, flattened input paths of an action."""
+    return self._get_metadata().resolve_inputs(action)
+
+  def save(self, index_path):
+    """Writes this index to index_path, see load_index."""
+    stat = os.stat(self._path)
+    header = {
+        "source": os.path.abspath(self._path),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "input_type": self._input_type,
+        "streamed": self._streamed,
+        "inputs": self.inputs,
+    }
+    with open(index_path, "wb") as f:
+      f.write(_INDEX_MAGIC)
+      f.write(json.dumps(header, sort_keys=True).encode("utf-8"))
+      f.write(b"\n")
+      f.write(_pack_entries(self.actions, self._streamed))
+
+
+def _pack_entries(actions, streamed):
+  """Serializes the entries of an index, see _unpack_entries.
+
+  The layout is the number of entries and the size of their keys, the keys
+  separated by NUL characters, which paths can't contain, then the fixed size
+  entries.
+
+  Args:
+    actions: the {output files: ActionEntry} of an index.
+    streamed: whether the index is streamed, see ActionEntry.location.
+
+  Returns:
+    The serialized entries.
+  """
+  keys = u"\0".join(actions).encode("utf-8")
+  parts = [_INDEX_ENTRIES_HEADER.pack(len(actions), len(keys)), keys]
+  for entry in actions.values():
+    if streamed:
+      offset, size = entry.location
+    else:
+      offset, size = entry.location, 0
+    parts.append(
+        _INDEX_ENTRY.pack(entry.cmdline_digest, entry.inputs_digest or 0,
+                          offset, size))
+  return b"".join(parts)
+
+
+def _unpack_entries(data, streamed, inputs):
+  """Deserializes the entries of an index written by _pack_entries."""
+  count, keys_size = _INDEX_ENTRIES_HEADER.unpack_from(data)
+  actions = collections.OrderedDict()
+  if not count:
+    return actions
+  pos = _INDEX_ENTRIES_HEADER.size
+  keys = data[pos:pos + keys_size].decode("utf-8").split(u"\0")
+  pos += keys_size
+  unpack_from = _INDEX_ENTRY.unpack_from
+  entry_size = _INDEX_ENTRY.size
+  for i, key in enumerate(keys):
+    cmdline_digest, inputs_digest, offset, size = unpack_from(
+        data, pos + i * entry_size)
+    actions[key] = ActionEntry(cmdline_digest,
+                               inputs_digest if inputs else None,
+                               (offset, size) if streamed else offset)
+  return actions
+
+
+def index_container(action_graph_container,
+                    path=None,
+                    input_type="proto",
+                    inputs=True):
+  """Indexes an already parsed ActionGraphContainer.
+
+  Args:
+    action_graph_container: the full action graph container object.
+    path: the file the container was read from, if any. Required to save the
+      index.
+    input_type: the format of that file, "proto" or "textproto".
+    inputs: whether to digest the inputs of the actions. Flattening and hashing
+      inputs is only needed to compare them.
+
+  Returns:
+    An ActionGraphIndex.
+  """
+  metadata = _ActionGraphMetadata.from_container(action_graph_container)
+  actions = collections.OrderedDict()
+  for i, action in enumerate(action_graph_container.actions):
+    actions[metadata.output_files(action.output_ids)] = ActionEntry(
+        _cmdline_digest(action.arguments),
+        metadata.inputs_digest(action.input_dep_set_ids) if inputs else None, i)
+  return ActionGraphIndex(actions, path, input_type, False, inputs,
+                          action_graph_container, metadata)
+
+
+def index_file(path, inputs=True):
+  """Indexes a binary ActionGraphContainer file record by record.
+
+  The artifacts, path fragments and dep sets are read in a first pass, then
+  the actions are digested one at a time in a second pass. Only the action
+  entries are kept once indexing is done; the rest of the graph is read again
+  if inputs of mismatching actions need to be compared.
+
+  Args:
+    path: path of a binary ActionGraphContainer file.
+    inputs: whether to digest the inputs of the actions. If not, dep sets
+      aren't read at all.
+
+  Returns:
+    An ActionGraphIndex.
+  """
+  with open(path, "rb") as f:
+    metadata = _ActionGraphMetadata.from_containers(
+        iter_containers(
+            f, _METADATA_FIELDS if inputs else
+            (_ARTIFACTS_FIELD, _PATH_FRAGMENTS_FIELD)))
+
+  entries = collections.OrderedDict()
+  with open(path, "rb") as f:
+    for container, action_locations in iter_containers(f, (_ACTIONS_FIELD,)):
+      for action, location in zip(container.actions, action_locations):
+        entries[metadata.output_files(action.output_ids)] = ActionEntry(
+            _cmdline_digest(action.arguments),
+            metadata.inputs_digest(action.input_dep_set_ids)
+            if inputs else None, location)
+  return ActionGraphIndex(entries, path, "proto", True, inputs)
+
+
+def load_index(index_path, path, inputs=True):
+  """Loads an index written by ActionGraphIndex.save.
+
+  Args:
+    index_path: the saved index.
+    path: the action graph file the index is expected to describe.
+    inputs: whether the index must have inputs digests.
+
+  Returns:
+    The ActionGraphIndex, or None if the index doesn't exist, was created
+    from a different or since modified file, or lacks inputs digests.
+  """
+  if not os.path.exists(index_path):
+    return None
+  with open(index_path, "rb") as f:
+    if f.read(len(_INDEX_MAGIC)) != _INDEX_MAGIC:
+      return None
+    header = json.loads(f.readline().decode("utf-8"))
+    stat = os.stat(path)
+    if (header["source"] != os.path.abspath(path) or
+        header["size"] != stat.st_size or header["mtime"] != stat.st_mtime or
+        (inputs and not header["inputs"])):
+      return None
+    streamed = header["streamed"]
+    actions = _unpack_entries(f.read(), streamed, header["inputs"])
+  return ActionGraphIndex(actions, path, header["input_type"], streamed,
+                          header["inputs"])
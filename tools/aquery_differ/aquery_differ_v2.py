@@ -35,23 +35,38 @@ bazel run //tools/aquery_differ:aquery_differ_v2 -- \
 --input_type=textproto \
 --attrs=cmdline \
 --attrs=inputs
+
+Each action is first reduced to fingerprints of its command line and, with
+--attrs=inputs, of its inputs, and only actions whose fingerprints differ are
+diffed.
+For multi-GB binary aquery outputs, pass --streaming to index the inputs record
+by record instead of parsing them as a whole. Pass --jobs=N to index both
+inputs and render the diffs in parallel processes. Pass --before_index=<path>
+to save the fingerprints of --before and reuse them in later runs against other
+--after outputs.
+
+Pass --output=json to print one JSON record per changed action instead of
+unified diffs, or --output=summary to only print the number of changed actions
+per mnemonic.
 """
 
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
+import collections
 import difflib
+import functools
+import json
+import multiprocessing
 import os
 import sys
 
 # Do not edit this line. Copybara replaces it with PY2 migration helper.
+from concurrent import futures
 from absl import app
 from absl import flags
 from six.moves import map
-from google.protobuf import text_format
-from src.main.protobuf import analysis_v2_pb2
-from tools.aquery_differ.resolvers.dep_set_resolver import DepSetResolver
-from tools.aquery_differ.resolvers.path_fragment_resolver import PathFragmentResolver
+from tools.aquery_differ import action_graph_index
 
 flags.DEFINE_string("before", None, "Aquery output before the change")
 flags.DEFINE_string("after", None, "Aquery output after the change")
@@ -60,6 +75,24 @@ flags.DEFINE_enum(
     "The format of the aquery proto input. One of 'proto' and 'textproto.")
 flags.DEFINE_multi_enum("attrs", ["cmdline"], ["inputs", "cmdline"],
                         "Attributes of the actions to be compared.")
+flags.DEFINE_bool(
+    "streaming", False,
+    "Read the binary proto inputs record by record and keep only action "
+    "fingerprints in memory. Requires --input_type=proto.")
+flags.DEFINE_integer(
+    "jobs", 1,
+    "Number of processes used to index the inputs and render the diffs, at "
+    "most the number of available CPUs. The output is the same regardless of "
+    "this value.", lower_bound=1)
+flags.DEFINE_string(
+    "before_index", None,
+    "Fingerprint index of the --before aquery output. It's reused if it was "
+    "created from the same --before file, and written otherwise.")
+flags.DEFINE_enum(
+    "output", "text", ["text", "json", "summary"],
+    "The output format. 'text' prints unified diffs, 'json' prints one JSON "
+    "record per line for each changed action and 'summary' prints the number "
+    "of changed actions per mnemonic as JSON.")
 flags.mark_flag_as_required("before")
 flags.mark_flag_as_required("after")
 
@@ -68,6 +101,10 @@ CYAN = "\033[36m%s\033[0m"
 RED = "\033[31m%s\033[0m"
 GREEN = "\033[32m%s\033[0m"
 
+# The difference in one attribute of the actions generating output_files.
+_AttrDiff = collections.namedtuple(
+    "_AttrDiff", ["output_files", "attr", "mnemonic", "before_val", "after_val"])
+
 
 def _colorize(line):
   """Add color to the input string."""
@@ -89,159 +126,328 @@ def _colorize(line):
   return line
 
 
-def _print_diff(output_files, before_val, after_val, attr, before_file,
-                after_file):
-  diff = "\n".join(
+def _render_diff(before_file, after_file, diff):
+  """Renders an _AttrDiff as a unified diff."""
+  diff_lines = "\n".join(
       map(_colorize, [
-          s.strip("\n") for s in difflib.unified_diff(before_val, after_val,
-                                                      before_file, after_file)
+          s.strip("\n") for s in difflib.unified_diff(
+              diff.before_val, diff.after_val, before_file, after_file)
       ]))
-  print(("[%s]\n"
-         "Difference in the action that generates the following output(s):"
-         "\n\t%s\n%s\n") % (attr, "\n\t".join(output_files.split()), diff))
-
-
-def _map_artifact_id_to_path(artifacts, path_fragments):
-  path_fragment_resolver = PathFragmentResolver(path_fragments)
-  return {
-      artifact.id: path_fragment_resolver.resolve(artifact.path_fragment_id)
-      for artifact in artifacts
-  }
-
-
-def _map_action_index_to_output_files(actions, artifacts):
-  """Constructs a map from action index to output files.
+  return (("[%s]\n"
+           "Difference in the action that generates the following output(s):"
+           "\n\t%s\n%s\n") %
+          (diff.attr, "\n\t".join(diff.output_files.split()), diff_lines))
+
+
+def _changed_values(diff):
+  """Returns the (removed, added) values of an _AttrDiff."""
+  if diff.attr == "inputs":
+    # Inputs are sorted and unique, so a set difference is exact.
+    before_inputs = set(diff.before_val)
+    after_inputs = set(diff.after_val)
+    return ([i for i in diff.before_val if i not in after_inputs],
+            [i for i in diff.after_val if i not in before_inputs])
+
+  removed = []
+  added = []
+  matcher = difflib.SequenceMatcher(
+      None, diff.before_val, diff.after_val, autojunk=False)
+  for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+    if tag in ("replace", "delete"):
+      removed.extend(diff.before_val[i1:i2])
+    if tag in ("replace", "insert"):
+      added.extend(diff.after_val[j1:j2])
+  return (removed, added)
+
+
+def _render_record(diff):
+  """Renders an _AttrDiff as a single line JSON record."""
+  removed, added = _changed_values(diff)
+  return json.dumps(
+      {
+          "output_files": diff.output_files.split(),
+          "mnemonic": diff.mnemonic,
+          "change": "modified",
+          "attr": diff.attr,
+          "removed": removed,
+          "added": added,
+      },
+      sort_keys=True)
+
+
+class _RecordWriter(object):
+  """Writes lines to stdout in large chunks rather than one at a time."""
+
+  def __init__(self, buffer_size=1 << 20):
+    self._buffer_size = buffer_size
+    self._lines = []
+    self._size = 0
+
+  def write(self, line):
+    self._lines.append(line)
+    self._size += len(line) + 1
+    if self._size >= self._buffer_size:
+      self.flush()
+
+  def flush(self):
+    if self._lines:
+      sys.stdout.write("\n".join(self._lines) + "\n")
+      self._lines = []
+      self._size = 0
+    sys.stdout.flush()
+
+
+def _map_ordered(func, items, executor=None, jobs=1):
+  """Maps func over items, on executor if set, preserving the item order."""
+  if executor is None:
+    return map(func, items)
+  chunksize = max(1, len(items) // (16 * jobs))
+  return executor.map(func, items, chunksize=chunksize)
+
+
+def _print_output_files_diff(output_files_before, output_files_after):
+  """Prints the output files that only one side has actions for.
 
   Args:
-    actions: a list of actions from the action graph container
-    artifacts: a map {artifact_id: artifact path}
+    output_files_before: a sorted list of output files strings that only the
+      aquery output before the change has actions for
+    output_files_after: a sorted list of output files strings that only the
+      aquery output after the change has actions for
 
   Returns:
-    A map from action index (in action graph container) to a string of
-    concatenated output artifacts paths.
+    True iff a difference was found.
   """
-  action_index_to_output_files = {}
-  for i, action in enumerate(actions):
-    output_files = " ".join(
-        sorted([artifacts[output_id] for output_id in action.output_ids]))
-    action_index_to_output_files[i] = output_files
-  return action_index_to_output_files
+  found_difference = False
+  if output_files_before:
+    print(("Aquery output 'before' change contains an action that generates "
+           "the following outputs that aquery output 'after' change doesn't:"
+           "\n%s\n") % "\n".join(output_files_before))
+    found_difference = True
+  if output_files_after:
+    print(("Aquery output 'after' change contains an action that generates "
+           "the following outputs that aquery output 'before' change doesn't:"
+           "\n%s\n") % "\n".join(output_files_after))
+    found_difference = True
+  return found_difference
+
 
+def _collect_diffs(before, after, attrs):
+  """Finds the attribute differences between two indexed action graphs.
 
-# output files -> input artifacts
-def _map_output_files_to_input_artifacts(action_graph_container,
-                                         artifact_id_to_path,
-                                         action_index_to_output_files):
-  """Constructs a map from output files to input artifacts.
+  Only actions whose fingerprints differ are loaded and compared in full.
 
   Args:
-    action_graph_container: the full action graph container object
-    artifact_id_to_path: a map {artifact_id: artifact path}
-    action_index_to_output_files: a map from action index (in action graph
-      container) to a string of concatenated output artifacts paths.
+    before: the ActionGraphIndex before the change.
+    after: the ActionGraphIndex after the change.
+    attrs: the attributes of the actions to compare.
 
   Returns:
-    A map from output files (string of concatenated output artifacts paths) to a
-    list of input artifacts.
+    A list of _AttrDiff, the cmdline diffs first, each in action order.
   """
-  actions = action_graph_container.actions
-  dep_set_of_files = action_graph_container.dep_set_of_files
-  id_to_dep_set = {dep_set.id: dep_set for dep_set in dep_set_of_files}
-  dep_set_resolver = DepSetResolver(dep_set_of_files, artifact_id_to_path)
-
-  output_files_to_input_artifacts = {}
-  for i, action in enumerate(actions):
-    input_artifacts = []
-
-    for dep_set_id in action.input_dep_set_ids:
-      input_artifacts.extend(
-          dep_set_resolver.resolve(id_to_dep_set[dep_set_id]))
+  cmdline_changed = []
+  inputs_changed = []
+  for output_files, before_entry in before.actions.items():
+    after_entry = after.actions.get(output_files, None)
+    if after_entry is None:
+      continue
+    if after_entry.cmdline_digest != before_entry.cmdline_digest:
+      cmdline_changed.append(output_files)
+    if after_entry.inputs_digest != before_entry.inputs_digest:
+      inputs_changed.append(output_files)
+
+  diffs = []
+  if "cmdline" in attrs:
+    for output_files in cmdline_changed:
+      before_action = before.load_action(output_files)
+      arguments = list(before_action.arguments)
+      after_arguments = list(after.load_action(output_files).arguments)
+      if after_arguments and arguments != after_arguments:
+        diffs.append(
+            _AttrDiff(output_files, "cmdline", before_action.mnemonic,
+                      arguments, after_arguments))
 
-    output_files_to_input_artifacts[action_index_to_output_files[i]] = list(
-        sorted(input_artifacts))
+  if "inputs" in attrs:
+    for output_files in inputs_changed:
+      before_action = before.load_action(output_files)
+      before_inputs = before.resolve_inputs(before_action)
+      after_inputs = after.resolve_inputs(after.load_action(output_files))
+      if after_inputs and before_inputs != after_inputs:
+        diffs.append(
+            _AttrDiff(output_files, "inputs", before_action.mnemonic,
+                      before_inputs, after_inputs))
 
-  return output_files_to_input_artifacts
+  return diffs
 
 
-# output files -> command line
-def _map_output_files_to_command_line(actions, action_index_to_output_files):
-  """Constructs a map from output files to command line.
+def _diff_indexes(before,
+                  after,
+                  attrs,
+                  before_file,
+                  after_file,
+                  executor=None,
+                  jobs=1,
+                  output="text"):
+  """Prints the differences between two indexed action graphs.
 
   Args:
-    actions: a list of actions from the action graph container
-    action_index_to_output_files: a map from action index (in action graph
-      container) to a string of concatenated output artifacts paths.
-
-  Returns:
-    A map from output files (string of concatenated output artifacts paths)
-    to the command line (a list of arguments).
+    before: the ActionGraphIndex before the change.
+    after: the ActionGraphIndex after the change.
+    attrs: the attributes of the actions to compare.
+    before_file: the name of the aquery output before the change.
+    after_file: the name of the aquery output after the change.
+    executor: if set, the diffs are rendered on this executor.
+    jobs: the number of workers of the executor.
+    output: the output format, see the --output flag.
   """
-  output_files_to_command_line = {}
-  for i, action in enumerate(actions):
-    output_files_to_command_line[
-        action_index_to_output_files[i]] = action.arguments
-  return output_files_to_command_line
-
-
-def _aquery_diff(before_proto, after_proto, attrs, before_file, after_file):
+  # There's a 1-to-1 mapping between action and outputs
+  only_before = sorted(
+      output_files for output_files in before.actions
+      if output_files not in after.actions)
+  only_after = sorted(
+      output_files for output_files in after.actions
+      if output_files not in before.actions)
+  diffs = _collect_diffs(before, after, attrs)
+
+  if output == "text":
+    found_difference = _print_output_files_diff(only_before, only_after)
+    for diff in _map_ordered(
+        functools.partial(_render_diff, before_file, after_file), diffs,
+        executor, jobs):
+      print(diff)
+    if not found_difference and not diffs:
+      print("No difference")
+    return
+
+  removed = [(output_files, before.load_action(output_files).mnemonic)
+             for output_files in only_before]
+  added = [(output_files, after.load_action(output_files).mnemonic)
+           for output_files in only_after]
+
+  if output == "json":
+    writer = _RecordWriter()
+    for change, actions in (("removed", removed), ("added", added)):
+      for output_files, mnemonic in actions:
+        writer.write(
+            json.dumps({
+                "output_files": output_files.split(),
+                "mnemonic": mnemonic,
+                "change": change,
+            },
+                       sort_keys=True))
+    for record in _map_ordered(_render_record, diffs, executor, jobs):
+      writer.write(record)
+    writer.flush()
+    return
+
+  per_mnemonic = collections.defaultdict(collections.Counter)
+  for change, actions in (("removed", removed), ("added", added)):
+    for _, mnemonic in actions:
+      per_mnemonic[mnemonic][change] += 1
+  for diff in diffs:
+    per_mnemonic[diff.mnemonic][diff.attr] += 1
+  total = collections.Counter()
+  for counts in per_mnemonic.values():
+    total.update(counts)
+  print(
+      json.dumps(
+          {
+              "actions_before": len(before.actions),
+              "actions_after": len(after.actions),
+              "changed_actions": len(set(diff.output_files for diff in diffs)),
+              "total": dict(total),
+              "mnemonics": {
+                  mnemonic: dict(counts)
+                  for mnemonic, counts in per_mnemonic.items()
+              },
+          },
+          indent=2,
+          sort_keys=True))
+
+
+def _aquery_diff(before_proto,
+                 after_proto,
+                 attrs,
+                 before_file,
+                 after_file,
+                 output="text"):
   """Returns differences between command lines that generate same outputs."""
-  found_difference = False
-  artifacts_before = _map_artifact_id_to_path(before_proto.artifacts,
-                                              before_proto.path_fragments)
-  artifacts_after = _map_artifact_id_to_path(after_proto.artifacts,
-                                             after_proto.path_fragments)
-
-  action_to_output_files_before = _map_action_index_to_output_files(
-      before_proto.actions, artifacts_before)
-  action_to_output_files_after = _map_action_index_to_output_files(
-      after_proto.actions, artifacts_after)
+  inputs = "inputs" in attrs
+  _diff_indexes(
+      action_graph_index.index_container(before_proto, inputs=inputs),
+      action_graph_index.index_container(after_proto, inputs=inputs),
+      attrs,
+      before_file,
+      after_file,
+      output=output)
+
+
+def _available_cpus():
+  """Returns the number of CPUs this process may run on."""
+  if hasattr(os, "sched_getaffinity"):
+    return len(os.sched_getaffinity(0))
+  return multiprocessing.cpu_count()
+
+
+def _index_file(path, input_type, streaming, index_path=None, inputs=True):
+  """Indexes an aquery output, reusing or writing index_path if set."""
+  if index_path:
+    index = action_graph_index.load_index(index_path, path, inputs)
+    if index is not None:
+      return index
+
+  if streaming:
+    index = action_graph_index.index_file(path, inputs)
+  else:
+    index = action_graph_index.index_container(
+        action_graph_index.read_container(path, input_type), path, input_type,
+        inputs)
 
-  # There's a 1-to-1 mapping between action and outputs
-  output_files_before = set(action_to_output_files_before.values())
-  output_files_after = set(action_to_output_files_after.values())
+  if index_path:
+    index.save(index_path)
+  return index
 
-  before_after_diff = output_files_before - output_files_after
-  after_before_diff = output_files_after - output_files_before
 
-  if before_after_diff:
-    print(("Aquery output 'before' change contains an action that generates "
-           "the following outputs that aquery output 'after' change doesn't:"
-           "\n%s\n") % "\n".join(before_after_diff))
-    found_difference = True
-  if after_before_diff:
-    print(("Aquery output 'after' change contains an action that generates "
-           "the following outputs that aquery output 'before' change doesn't:"
-           "\n%s\n") % "\n".join(after_before_diff))
-    found_difference = True
+def _aquery_diff_files(before_file,
+                       after_file,
+                       input_type,
+                       attrs,
+                       streaming=False,
+                       jobs=1,
+                       before_index=None,
+                       output="text"):
+  """Like _aquery_diff, but reads and indexes the aquery outputs itself.
 
-  if "cmdline" in attrs:
-    output_to_command_line_before = _map_output_files_to_command_line(
-        before_proto.actions, action_to_output_files_before)
-    output_to_command_line_after = _map_output_files_to_command_line(
-        after_proto.actions, action_to_output_files_after)
-    for output_files in output_to_command_line_before:
-      arguments = output_to_command_line_before[output_files]
-      after_arguments = output_to_command_line_after.get(output_files, None)
-      if after_arguments and arguments != after_arguments:
-        _print_diff(output_files, arguments, after_arguments, "cmdline",
-                    before_file, after_file)
-        found_difference = True
-
-  if "inputs" in attrs:
-    output_to_input_files_before = _map_output_files_to_input_artifacts(
-        before_proto, artifacts_before, action_to_output_files_before)
-    output_to_input_files_after = _map_output_files_to_input_artifacts(
-        after_proto, artifacts_after, action_to_output_files_after)
-    for output_files in output_to_input_files_before:
-      before_inputs = output_to_input_files_before[output_files]
-      after_inputs = output_to_input_files_after.get(output_files, None)
-      if after_inputs and before_inputs != after_inputs:
-        _print_diff(output_files, before_inputs, after_inputs, "inputs",
-                    before_file, after_file)
-        found_difference = True
-
-  if not found_difference:
-    print("No difference")
+  Args:
+    before_file: path of the aquery output before the change.
+    after_file: path of the aquery output after the change.
+    input_type: the format of both files, "proto" or "textproto".
+    attrs: the attributes of the actions to compare.
+    streaming: whether to index binary protos record by record.
+    jobs: number of processes used to index the files and render the diffs,
+      capped to the number of available CPUs.
+    before_index: path of the saved fingerprint index of before_file, if any.
+    output: the output format, see the --output flag.
+  """
+  jobs = min(jobs, _available_cpus())
+  inputs = "inputs" in attrs
+  if jobs == 1:
+    _diff_indexes(
+        _index_file(before_file, input_type, streaming, before_index, inputs),
+        _index_file(after_file, input_type, streaming, inputs=inputs),
+        attrs,
+        before_file,
+        after_file,
+        output=output)
+    return
+
+  with futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+    # Only one index is sent back by a worker, the other file is indexed in
+    # this process meanwhile.
+    before = executor.submit(_index_file, before_file, input_type, streaming,
+                             before_index, inputs)
+    after = _index_file(after_file, input_type, streaming, inputs=inputs)
+    _diff_indexes(before.result(), after, attrs, before_file, after_file,
+                  executor, jobs, output)
 
 
 def to_absolute_path(path):
@@ -260,23 +466,17 @@ def main(unused_argv):
   after_file = to_absolute_path(flags.FLAGS.after)
   input_type = flags.FLAGS.input_type
   attrs = flags.FLAGS.attrs
+  streaming = flags.FLAGS.streaming
 
-  before_proto = analysis_v2_pb2.ActionGraphContainer()
-  after_proto = analysis_v2_pb2.ActionGraphContainer()
-  if input_type == "proto":
-    with open(before_file, "rb") as f:
-      before_proto.ParseFromString(f.read())
-    with open(after_file, "rb") as f:
-      after_proto.ParseFromString(f.read())
-  else:
-    with open(before_file, "r") as f:
-      before_text = f.read()
-      text_format.Merge(before_text, before_proto)
-    with open(after_file, "r") as f:
-      after_text = f.read()
-      text_format.Merge(after_text, after_proto)
-
-  _aquery_diff(before_proto, after_proto, attrs, before_file, after_file)
+  if streaming and input_type != "proto":
+    raise app.UsageError("--streaming requires --input_type=proto")
+
+  before_index = flags.FLAGS.before_index
+  if before_index:
+    before_index = to_absolute_path(before_index)
+
+  _aquery_diff_files(before_file, after_file, input_type, attrs, streaming,
+                     flags.FLAGS.jobs, before_index, flags.FLAGS.output)
 
 
 if __name__ == "__main__":
@@ -14,13 +14,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import os
+import pickle
+import tempfile
 import unittest
 # Do not edit this line. Copybara replaces it with PY2 migration helper.
 from third_party.py import mock
 import six
 from src.main.protobuf import analysis_v2_pb2
+from tools.aquery_differ import action_graph_index
 from tools.aquery_differ import aquery_differ_v2 as aquery_differ
+from tools.aquery_differ.resolvers.path_fragment_resolver import PathFragmentResolver
 if six.PY2:
   from cStringIO import StringIO
 else:
@@ -50,6 +55,9 @@ def make_aquery_output(action_objs, artifact_objs, path_fragment_objs):
     if "input_dep_set_ids" in action_obj:
       action.input_dep_set_ids.extend(action_obj["input_dep_set_ids"])
 
+    if "mnemonic" in action_obj:
+      action.mnemonic = action_obj["mnemonic"]
+
   return action_graph
 
 
@@ -67,6 +75,13 @@ def make_aquery_output_with_dep_set(action_objs, artifact_objs,
   return action_graph
 
 
+def write_aquery_output(action_graph):
+  fd, path = tempfile.mkstemp(dir=os.environ.get("TEST_TMPDIR"))
+  with os.fdopen(fd, "wb") as f:
+    f.write(action_graph.SerializeToString())
+  return path
+
+
 class CmdLineDifferTest(unittest.TestCase):
 
   def test_no_difference(self):
@@ -467,6 +482,565 @@ class CmdLineDifferTest(unittest.TestCase):
       aquery_differ._aquery_diff(first, second, attrs, "before", "after")
       self.assertIn(expected_error_one, mock_stdout.getvalue())
 
+  def test_deeply_nested_inputs(self):
+    depth = 5000
+    dep_set_objs = [{
+        "id": 1,
+        "transitive_dep_set_ids": [],
+        "direct_artifact_ids": [1]
+    }]
+    for i in range(2, depth + 1):
+      dep_set_objs.append({
+          "id": i,
+          "transitive_dep_set_ids": [i - 1],
+          "direct_artifact_ids": [1, 2]
+      })
+    path_fragment_objs = [
+        {
+            "id": 1,
+            "label": "root"
+        },
+        {
+            "id": 2,
+            "label": "foo",
+            "parent_id": 1
+        },
+        {
+            "id": 3,
+            "label": "bar",
+            "parent_id": 1
+        },
+        {
+            "id": 4,
+            "label": "out",
+            "parent_id": 1
+        },
+    ]
+    artifact_objs = [{
+        "id": 1,
+        "path_fragment_id": 2
+    }, {
+        "id": 2,
+        "path_fragment_id": 3
+    }, {
+        "id": 3,
+        "path_fragment_id": 4
+    }]
+    first = make_aquery_output_with_dep_set(
+        action_objs=[{
+            "arguments": [],
+            "output_ids": [3],
+            "input_dep_set_ids": [depth]
+        }],
+        artifact_objs=artifact_objs,
+        path_fragment_objs=path_fragment_objs,
+        dep_set_objs=dep_set_objs)
+    second = make_aquery_output_with_dep_set(
+        action_objs=[{
+            "arguments": [],
+            "output_ids": [3],
+            "input_dep_set_ids": [1]
+        }],
+        artifact_objs=artifact_objs,
+        path_fragment_objs=path_fragment_objs,
+        dep_set_objs=dep_set_objs)
+
+    foo_path = os.path.join("root", "foo")
+    bar_path = os.path.join("root", "bar")
+    expected_error = "\n".join([
+        "Difference in the action that generates the following output(s):",
+        "\t{}".format(os.path.join("root", "out")), "--- before", "+++ after",
+        "@@ -1,2 +1 @@", "-{}".format(bar_path), " {}".format(foo_path), "\n"
+    ])
+    attrs = ["inputs"]
+
+    mock_stdout = StringIO()
+    with mock.patch("sys.stdout", mock_stdout):
+      aquery_differ._aquery_diff(first, second, attrs, "before", "after")
+      self.assertIn(expected_error, mock_stdout.getvalue())
+
+
+class PathFragmentResolverTest(unittest.TestCase):
+
+  def _resolve_unmemoized(self, path_fragments, path_fragment_id):
+    id_to_path_fragment = {
+        path_fragment.id: path_fragment for path_fragment in path_fragments
+    }
+    exec_path_tokens = []
+    while path_fragment_id:
+      path_fragment = id_to_path_fragment[path_fragment_id]
+      exec_path_tokens.append(path_fragment.label)
+      path_fragment_id = path_fragment.parent_id
+    return os.path.join(*reversed(exec_path_tokens))
+
+  def test_shared_prefixes_match_unmemoized_paths(self):
+    # bazel-out/k8-fastbuild/bin is a prefix of all other fragments.
+    path_fragment_objs = [
+        ("bazel-out", 0),
+        ("k8-fastbuild", 1),
+        ("bin", 2),
+        ("foo", 3),
+        ("a.o", 4),
+        ("b.o", 4),
+        ("bar", 3),
+        ("c.o", 7),
+        ("external", 0),
+    ]
+    path_fragments = []
+    for i, (label, parent_id) in enumerate(path_fragment_objs):
+      path_fragment = analysis_v2_pb2.PathFragment()
+      path_fragment.id = i + 1
+      path_fragment.label = label
+      path_fragment.parent_id = parent_id
+      path_fragments.append(path_fragment)
+
+    resolver = PathFragmentResolver(path_fragments)
+    # Resolve leaves first, so that their prefixes are resolved from the memo
+    # when the inner fragments are looked up, then everything again.
+    ids = [6, 5, 8, 4, 7, 3, 9, 2, 1]
+    for path_fragment_id in ids + ids:
+      self.assertEqual(
+          resolver.resolve(path_fragment_id),
+          self._resolve_unmemoized(path_fragments, path_fragment_id))
+    self.assertEqual(
+        resolver.resolve(5), os.path.join("bazel-out", "k8-fastbuild", "bin",
+                                          "foo", "a.o"))
+
+  def test_non_sequential_ids(self):
+    path_fragments = []
+    for path_fragment_id, label, parent_id in ((3, "bin", 2),
+                                               (1, "bazel-out", 0),
+                                               (2, "k8-fastbuild", 1)):
+      path_fragment = analysis_v2_pb2.PathFragment()
+      path_fragment.id = path_fragment_id
+      path_fragment.label = label
+      path_fragment.parent_id = parent_id
+      path_fragments.append(path_fragment)
+
+    expected = os.path.join("bazel-out", "k8-fastbuild", "bin")
+    self.assertEqual(PathFragmentResolver(path_fragments).resolve(3), expected)
+    self.assertEqual(
+        PathFragmentResolver(iter(path_fragments)).resolve(3), expected)
+
+  def test_unknown_path_fragment(self):
+    path_fragment = analysis_v2_pb2.PathFragment()
+    path_fragment.id = 1
+    path_fragment.label = "foo"
+    path_fragment.parent_id = 2
+    with self.assertRaises(ValueError):
+      PathFragmentResolver([path_fragment]).resolve(1)
+
+
+class FileDifferTest(unittest.TestCase):
+
+  def _make_graph(self, arguments, input_dep_set_ids, dep_set_objs):
+    return make_aquery_output_with_dep_set(
+        action_objs=[
+            {
+                "arguments": arguments,
+                "output_ids": [1],
+                "input_dep_set_ids": input_dep_set_ids
+            },
+            {
+                "arguments": ["-c"],
+                "output_ids": [2],
+                "input_dep_set_ids": [1]
+            },
+        ],
+        artifact_objs=[{
+            "id": 1,
+            "path_fragment_id": 2
+        }, {
+            "id": 2,
+            "path_fragment_id": 3
+        }, {
+            "id": 3,
+            "path_fragment_id": 4
+        }],
+        path_fragment_objs=[
+            {
+                "id": 1,
+                "label": "root"
+            },
+            {
+                "id": 2,
+                "label": "foo",
+                "parent_id": 1
+            },
+            {
+                "id": 3,
+                "label": "bar",
+                "parent_id": 1
+            },
+            {
+                "id": 4,
+                "label": "baz",
+                "parent_id": 1
+            },
+        ],
+        dep_set_objs=dep_set_objs)
+
+  def _diff(self, first, second, attrs, streaming, jobs=1, before_index=None):
+    mock_stdout = StringIO()
+    before_file = write_aquery_output(first)
+    after_file = write_aquery_output(second)
+    with mock.patch("sys.stdout", mock_stdout):
+      aquery_differ._aquery_diff_files(before_file, after_file, "proto", attrs,
+                                       streaming, jobs, before_index)
+    return mock_stdout.getvalue().replace(before_file, "before").replace(
+        after_file, "after")
+
+  def test_no_difference(self):
+    dep_sets = [{
+        "id": 1,
+        "transitive_dep_set_ids": [],
+        "direct_artifact_ids": [3]
+    }]
+    graph = self._make_graph(["-a"], [1], dep_sets)
+    self.assertEqual(
+        self._diff(graph, graph, ["cmdline", "inputs"], streaming=True),
+        "No difference\n")
+
+  def test_same_inputs_different_dep_set_structure(self):
+    first = self._make_graph(["-a"], [2], [{
+        "id": 1,
+        "transitive_dep_set_ids": [],
+        "direct_artifact_ids": [3]
+    }, {
+        "id": 2,
+        "transitive_dep_set_ids": [1],
+        "direct_artifact_ids": [2]
+    }])
+    second = self._make_graph(["-a"], [1, 2], [{
+        "id": 1,
+        "transitive_dep_set_ids": [],
+        "direct_artifact_ids": [3]
+    }, {
+        "id": 2,
+        "transitive_dep_set_ids": [],
+        "direct_artifact_ids": [2]
+    }])
+    self.assertEqual(
+        self._diff(first, second, ["inputs"], streaming=True),
+        "No difference\n")
+
+  def test_matches_non_streaming_output(self):
+    dep_sets = [{
+        "id": 1,
+        "transitive_dep_set_ids": [],
+        "direct_artifact_ids": [3]
+    }, {
+        "id": 2,
+        "transitive_dep_set_ids": [1],
+        "direct_artifact_ids": [2]
+    }]
+    first = self._make_graph(["-a", "-b"], [2], dep_sets)
+    second = self._make_graph(["-a", "-d"], [1], dep_sets)
+    attrs = ["cmdline", "inputs"]
+    streaming_output = self._diff(first, second, attrs, streaming=True)
+    self.assertIn("+-d", streaming_output)
+    self.assertIn("-{}".format(os.path.join("root", "bar")), streaming_output)
+    self.assertEqual(streaming_output,
+                     self._diff(first, second, attrs, streaming=False))
+
+  def test_non_sequential_artifact_ids(self):
+    dep_sets = [{
+        "id": 1,
+        "transitive_dep_set_ids": [],
+        "direct_artifact_ids": [3]
+    }]
+    graph = self._make_graph(["-a"], [1], dep_sets)
+    shuffled = analysis_v2_pb2.ActionGraphContainer()
+    shuffled.CopyFrom(graph)
+    del shuffled.artifacts[:]
+    shuffled.artifacts.extend(reversed(graph.artifacts))
+    self.assertEqual(
+        action_graph_index.index_container(shuffled).actions,
+        action_graph_index.index_container(graph).actions)
+
+  def test_streaming_records_across_chunks(self):
+    dep_sets = [{
+        "id": 1,
+        "transitive_dep_set_ids": [],
+        "direct_artifact_ids": [3]
+    }, {
+        "id": 2,
+        "transitive_dep_set_ids": [1],
+        "direct_artifact_ids": [2]
+    }]
+    first = self._make_graph(["-a", "-b" * 200], [2], dep_sets)
+    second = self._make_graph(["-a", "-d"], [1], dep_sets)
+    attrs = ["cmdline", "inputs"]
+    expected = self._diff(first, second, attrs, streaming=False)
+    # Chunks smaller than most records, and than the two byte length of the
+    # first action.
+    for chunk_size in (1, 7, 64):
+      with mock.patch.object(action_graph_index, "_CHUNK_SIZE", chunk_size):
+        self.assertEqual(expected,
+                         self._diff(first, second, attrs, streaming=True))
+
+  def test_streaming_truncated_file(self):
+    graph = self._make_graph(["-a"], [1], [{
+        "id": 1,
+        "transitive_dep_set_ids": [],
+        "direct_artifact_ids": [3]
+    }])
+    path = write_aquery_output(graph)
+    with open(path, "rb") as f:
+      data = f.read()
+    with open(path, "wb") as f:
+      f.write(data[:-1])
+    with self.assertRaises(ValueError):
+      action_graph_index.index_file(path)
+
+  def test_parallel_matches_serial_output(self):
+    dep_sets = [{
+        "id": 1,
+        "transitive_dep_set_ids": [],
+        "direct_artifact_ids": [3]
+    }, {
+        "id": 2,
+        "transitive_dep_set_ids": [1],
+        "direct_artifact_ids": [2]
+    }]
+    first = self._make_graph(["-a", "-b"], [2], dep_sets)
+    second = self._make_graph(["-a", "-d"], [1], dep_sets)
+    attrs = ["cmdline", "inputs"]
+    serial_output = self._diff(first, second, attrs, streaming=False)
+    with mock.patch.object(aquery_differ, "_available_cpus", return_value=2):
+      self.assertEqual(
+          serial_output,
+          self._diff(first, second, attrs, streaming=False, jobs=2))
+      self.assertEqual(
+          serial_output,
+          self._diff(first, second, attrs, streaming=True, jobs=2))
+
+  def test_pickled_index_matches(self):
+    dep_sets = [{
+        "id": 1,
+        "transitive_dep_set_ids": [],
+        "direct_artifact_ids": [3]
+    }]
+    first = self._make_graph(["-a", "-b"], [1], dep_sets)
+    path = write_aquery_output(first)
+    for streaming in (False, True):
+      if streaming:
+        index = action_graph_index.index_file(path)
+      else:
+        index = action_graph_index.index_container(first, path)
+      unpickled = pickle.loads(pickle.dumps(index))
+      self.assertEqual(unpickled.actions, index.actions)
+      for output_files in index.actions:
+        self.assertEqual(
+            unpickled.load_action(output_files).arguments,
+            index.load_action(output_files).arguments)
+
+  def test_saved_before_index(self):
+    dep_sets = [{
+        "id": 1,
+        "transitive_dep_set_ids": [],
+        "direct_artifact_ids": [3]
+    }, {
+        "id": 2,
+        "transitive_dep_set_ids": [1],
+        "direct_artifact_ids": [2]
+    }]
+    first = self._make_graph(["-a", "-b"], [2], dep_sets)
+    second = self._make_graph(["-a", "-d"], [1], dep_sets)
+    before_file = write_aquery_output(first)
+    after_file = write_aquery_output(second)
+    index_path = before_file + ".index"
+
+    for streaming in (False, True):
+      aquery_differ._index_file(before_file, "proto", streaming,
+                                index_path)
+      index = action_graph_index.load_index(index_path, before_file)
+      self.assertIsNotNone(index)
+      self.assertEqual(
+          list(index.actions.keys()),
+          [os.path.join("root", "foo"),
+           os.path.join("root", "bar")])
+      self.assertIsNone(action_graph_index.load_index(index_path, after_file))
+
+      mock_stdout = StringIO()
+      with mock.patch("sys.stdout", mock_stdout):
+        aquery_differ._diff_indexes(
+            index, aquery_differ._index_file(after_file, "proto", streaming),
+            ["cmdline", "inputs"], "before", "after")
+      self.assertEqual(
+          mock_stdout.getvalue(),
+          self._diff(first, second, ["cmdline", "inputs"], streaming=False))
+
+  def test_inputs_are_only_digested_when_compared(self):
+    dep_sets = [{
+        "id": 1,
+        "transitive_dep_set_ids": [],
+        "direct_artifact_ids": [3]
+    }, {
+        "id": 2,
+        "transitive_dep_set_ids": [1],
+        "direct_artifact_ids": [2]
+    }]
+    first = self._make_graph(["-a", "-b"], [2], dep_sets)
+    second = self._make_graph(["-a", "-d"], [1], dep_sets)
+    expected = self._diff(first, second, ["cmdline"], streaming=False)
+    self.assertIn("+-d", expected)
+    self.assertNotIn("[inputs]", expected)
+
+    before_file = write_aquery_output(first)
+    index_path = before_file + ".index"
+    with mock.patch.object(action_graph_index._ActionGraphMetadata,
+                           "inputs_digest") as inputs_digest:
+      for streaming in (False, True):
+        self.assertEqual(expected,
+                         self._diff(first, second, ["cmdline"], streaming))
+        index = aquery_differ._index_file(
+            before_file, "proto", streaming, index_path, inputs=False)
+        self.assertIsNone(index.actions[os.path.join("root",
+                                                     "foo")].inputs_digest)
+      inputs_digest.assert_not_called()
+    # An index without inputs digests can't be used to compare inputs.
+    self.assertIsNotNone(
+        action_graph_index.load_index(index_path, before_file, inputs=False))
+    self.assertIsNone(action_graph_index.load_index(index_path, before_file))
+
+  def test_identical_actions_are_not_loaded(self):
+    graph = self._make_graph(["-a"], [1], [{
+        "id": 1,
+        "transitive_dep_set_ids": [],
+        "direct_artifact_ids": [3]
+    }])
+    before = action_graph_index.index_container(graph)
+    after = action_graph_index.index_container(graph)
+    with mock.patch.object(
+        action_graph_index.ActionGraphIndex, "load_action") as load_action:
+      mock_stdout = StringIO()
+      with mock.patch("sys.stdout", mock_stdout):
+        aquery_differ._diff_indexes(before, after, ["cmdline", "inputs"],
+                                    "before", "after")
+      self.assertEqual(mock_stdout.getvalue(), "No difference\n")
+      load_action.assert_not_called()
+
+
+class OutputFormatTest(unittest.TestCase):
+
+  def setUp(self):
+    super(OutputFormatTest, self).setUp()
+    path_fragment_objs = [
+        {
+            "id": 1,
+            "label": "root"
+        },
+        {
+            "id": 2,
+            "label": "foo",
+            "parent_id": 1
+        },
+        {
+            "id": 3,
+            "label": "bar",
+            "parent_id": 1
+        },
+        {
+            "id": 4,
+            "label": "baz",
+            "parent_id": 1
+        },
+    ]
+    artifact_objs = [{
+        "id": 1,
+        "path_fragment_id": 2
+    }, {
+        "id": 2,
+        "path_fragment_id": 3
+    }, {
+        "id": 3,
+        "path_fragment_id": 4
+    }]
+    self.first = make_aquery_output(
+        action_objs=[
+            {
+                "arguments": ["cc", "-a", "-b"],
+                "output_ids": [1],
+                "mnemonic": "CppCompile"
+            },
+            {
+                "arguments": ["javac"],
+                "output_ids": [2],
+                "mnemonic": "Javac"
+            },
+        ],
+        artifact_objs=artifact_objs,
+        path_fragment_objs=path_fragment_objs)
+    self.second = make_aquery_output(
+        action_objs=[
+            {
+                "arguments": ["cc", "-a", "-c"],
+                "output_ids": [1],
+                "mnemonic": "CppCompile"
+            },
+            {
+                "arguments": ["cp"],
+                "output_ids": [3],
+                "mnemonic": "Copy"
+            },
+        ],
+        artifact_objs=artifact_objs,
+        path_fragment_objs=path_fragment_objs)
+
+  def _diff(self, output):
+    mock_stdout = StringIO()
+    with mock.patch("sys.stdout", mock_stdout):
+      aquery_differ._aquery_diff(self.first, self.second, ["cmdline"],
+                                 "before", "after", output)
+    return mock_stdout.getvalue()
+
+  def test_json_output(self):
+    records = [json.loads(line) for line in self._diff("json").splitlines()]
+    self.assertEqual(records, [
+        {
+            "output_files": [os.path.join("root", "bar")],
+            "mnemonic": "Javac",
+            "change": "removed",
+        },
+        {
+            "output_files": [os.path.join("root", "baz")],
+            "mnemonic": "Copy",
+            "change": "added",
+        },
+        {
+            "output_files": [os.path.join("root", "foo")],
+            "mnemonic": "CppCompile",
+            "change": "modified",
+            "attr": "cmdline",
+            "removed": ["-b"],
+            "added": ["-c"],
+        },
+    ])
+
+  def test_summary_output(self):
+    summary = json.loads(self._diff("summary"))
+    self.assertEqual(summary["actions_before"], 2)
+    self.assertEqual(summary["actions_after"], 2)
+    self.assertEqual(summary["changed_actions"], 1)
+    self.assertEqual(summary["total"], {
+        "added": 1,
+        "removed": 1,
+        "cmdline": 1
+    })
+    self.assertEqual(
+        summary["mnemonics"], {
+            "CppCompile": {
+                "cmdline": 1
+            },
+            "Javac": {
+                "removed": 1
+            },
+            "Copy": {
+                "added": 1
+            },
+        })
+
 
 if __name__ == "__main__":
   unittest.main()
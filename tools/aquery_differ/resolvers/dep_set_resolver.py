@@ -12,38 +12,77 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """Contains resolvers for different attributes of Action in aquery output."""
-import copy
 
 
 class DepSetResolver(object):
-  """Utility class to resolve the dependency nested set."""
+  """Utility class to resolve the dependency nested set.
+
+  Dep sets are stored structurally, as tuples of direct artifact ids and
+  transitive dep set ids. They are only flattened when requested, without
+  materializing the contents of intermediate dep sets, so memory stays linear
+  in the size of the graph regardless of how deeply sets are nested.
+  """
 
   def __init__(self, dep_set_of_files, artifact_id_to_path):
-    self.dep_set_to_artifact_ids = {}
-    self.id_to_dep_set = {dep_set.id: dep_set for dep_set in dep_set_of_files}
+    self.id_to_dep_set = {
+        dep_set.id: (tuple(dep_set.direct_artifact_ids),
+                     tuple(dep_set.transitive_dep_set_ids))
+        for dep_set in dep_set_of_files
+    }
     self.artifact_id_to_path = artifact_id_to_path
 
-  def resolve(self, dep_set):
-    """Given a dep set, return the flattened list of input artifact ids.
+  def flatten(self, dep_set_ids):
+    """Returns the artifact ids of the given dep sets, without duplicates.
+
+    Artifacts are listed in pre-order: the direct artifacts of a dep set come
+    before those of its transitive dep sets. Each dep set is visited at most
+    once, and no recursion is used, so arbitrarily deep sets are supported.
 
     Args:
-      dep_set: the dep set object to be resolved.
+      dep_set_ids: the ids of the dep sets to flatten.
 
     Returns:
-      The flattened list of input artifact ids.
+      The flattened list of artifact ids.
     """
-    if dep_set.id in self.dep_set_to_artifact_ids:
-      return self.dep_set_to_artifact_ids[dep_set.id]
+    artifact_ids = []
+    seen_artifact_ids = set()
+    visited = set()
+    stack = list(reversed(dep_set_ids))
+    while stack:
+      dep_set_id = stack.pop()
+      if dep_set_id in visited:
+        continue
+      visited.add(dep_set_id)
+      direct_artifact_ids, transitive_dep_set_ids = self.id_to_dep_set[
+          dep_set_id]
+      for artifact_id in direct_artifact_ids:
+        if artifact_id not in seen_artifact_ids:
+          seen_artifact_ids.add(artifact_id)
+          artifact_ids.append(artifact_id)
+      stack.extend(reversed(transitive_dep_set_ids))
+    return artifact_ids
+
+  def resolve_ids(self, dep_set_ids):
+    """Given dep set ids, return the flattened list of input artifact paths.
+
+    Args:
+      dep_set_ids: the ids of the dep sets to be resolved.
 
-    artifact_ids = copy.copy([
+    Returns:
+      The flattened list of input artifact paths, without duplicates.
+    """
+    return [
         self.artifact_id_to_path[artifact_id]
-        for artifact_id in dep_set.direct_artifact_ids
-    ])
+        for artifact_id in self.flatten(dep_set_ids)
+    ]
 
-    for transitive_dep_set_id in dep_set.transitive_dep_set_ids:
-      artifact_ids.extend(
-          self.resolve(self.id_to_dep_set[transitive_dep_set_id]))
+  def resolve(self, dep_set):
+    """Given a dep set, return the flattened list of input artifact paths.
 
-    self.dep_set_to_artifact_ids[dep_set.id] = artifact_ids
+    Args:
+      dep_set: the dep set object to be resolved.
 
-    return self.dep_set_to_artifact_ids[dep_set.id]
+    Returns:
+      The flattened list of input artifact paths, without duplicates.
+    """
+    return self.resolve_ids([dep_set.id])
@@ -16,13 +16,47 @@ import os
 
 
 class PathFragmentResolver(object):
-  """Utility class to resolve path fragments."""
+  """Utility class to resolve path fragments.
+
+  The resolved paths of fragments that are the parent of other fragments are
+  memoized, so shared prefixes such as "bazel-out/k8-fastbuild/bin" are only
+  joined once. Leaf paths, usually one per artifact, aren't kept. Resolving
+  every fragment of a graph is linear in the number of fragments.
+
+  Bazel assigns path fragment ids sequentially from 1. If path_fragments is a
+  sequence, such as the repeated field of a parsed container, fragments are
+  looked up by position and only copied into a dict if their ids don't match
+  their positions.
+  """
 
   def __init__(self, path_fragments):
-    self._id_to_path_fragment = {
-        path_fragment.id: path_fragment for path_fragment in path_fragments
+    if hasattr(path_fragments, '__getitem__'):
+      self._path_fragments = path_fragments
+      self._id_to_path_fragment = None
+    else:
+      self._path_fragments = None
+      self._id_to_path_fragment = self._by_id(path_fragments)
+    self._id_to_path = {}
+
+  def _by_id(self, path_fragments):
+    return {
+        path_fragment.id: (path_fragment.label, path_fragment.parent_id)
+        for path_fragment in path_fragments
     }
 
+  def _get(self, path_fragment_id):
+    """Returns the (label, parent id) of a path fragment."""
+    if self._id_to_path_fragment is None:
+      if 0 < path_fragment_id <= len(self._path_fragments):
+        path_fragment = self._path_fragments[path_fragment_id - 1]
+        if path_fragment.id == path_fragment_id:
+          return path_fragment.label, path_fragment.parent_id
+      self._id_to_path_fragment = self._by_id(self._path_fragments)
+      self._path_fragments = None
+    if path_fragment_id not in self._id_to_path_fragment:
+      raise ValueError('Path Fragment id not found.')
+    return self._id_to_path_fragment[path_fragment_id]
+
   def resolve(self, path_fragment_id):
     """Given a path_fragment_id, return the full path.
 
@@ -32,14 +66,24 @@ class PathFragmentResolver(object):
     Returns:
       The string representing the full exec path.
     """
-    exec_path_tokens = []
+    if path_fragment_id in self._id_to_path:
+      return self._id_to_path[path_fragment_id]
+
+    # Walk up to the closest ancestor that's already resolved, then resolve
+    # the fragments on the way back down. All of them but the first are
+    # parents, and are memoized.
+    unresolved = []
     curr_id = path_fragment_id
-    while curr_id:
-      if curr_id not in self._id_to_path_fragment:
-        raise ValueError('Path Fragment id not found.')
+    while curr_id and curr_id not in self._id_to_path:
+      label, parent_id = self._get(curr_id)
+      unresolved.append((curr_id, label))
+      curr_id = parent_id
 
-      entry = self._id_to_path_fragment[curr_id]
-      exec_path_tokens.append(entry.label)
-      curr_id = entry.parent_id
+    path = self._id_to_path.get(curr_id)
+    for i in range(len(unresolved) - 1, -1, -1):
+      fragment_id, label = unresolved[i]
+      path = label if path is None else os.path.join(path, label)
+      if i:
+        self._id_to_path[fragment_id] = path
 
-    return os.path.join(*reversed(exec_path_tokens))
+    return path
@@ -0,0 +1,73 @@
+# Lint as: python3
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Analysis that ranks targets by how many identical clones they have."""
+from typing import Tuple
+
+# Do not edit this line. Copybara replaces it with PY2 migration helper.
+from dataclasses import dataclass
+
+from tools.ctexplain.analyses.graph_index import GraphIndex
+from tools.ctexplain.types import ConfiguredTarget
+
+
+@dataclass(frozen=True)
+class _ClonedTarget():
+  """A target with configured targets that trimming would merge."""
+  label: str
+  # Number of configured targets for this label.
+  configured_targets: int
+  # Number of configured targets that have the same trimmed configuration as
+  # another configured target of this label. Trimming would remove these.
+  clones: int
+
+
+def analyze(cts: Tuple[ConfiguredTarget, ...]) -> Tuple[_ClonedTarget, ...]:
+  """Runs the analysis on a build's configured targets.
+
+  Args:
+    cts: The build's configured targets.
+
+  Returns:
+    Targets with clones, most cloned first.
+  """
+  cloned = []
+  for label, groups in GraphIndex(cts).repeated_targets():
+    configured_targets = sum(len(group) for group in groups.values())
+    clones = configured_targets - len(groups)
+    if clones:
+      cloned.append(_ClonedTarget(label, configured_targets, clones))
+  cloned.sort(key=lambda target: (-target.clones, target.label))
+  return tuple(cloned)
+
+
+def report(result: Tuple[_ClonedTarget, ...], max_rows: int = 20) -> None:
+  """Reports analysis results to the user.
+
+  Args:
+    result: the analysis result
+    max_rows: maximum number of targets to show
+  """
+  if not result:
+    print("\nNo targets have behavior-identical configured targets.\n")
+    return
+  total_clones = sum(target.clones for target in result)
+  print(f"\nTargets with clones: {len(result)} ({total_clones} clones total)")
+  print("Clones (configured targets)  Target")
+  for target in result[:max_rows]:
+    counts = f"{target.clones} ({target.configured_targets})"
+    print(f"{counts:<28} {target.label}")
+  if len(result) > max_rows:
+    print(f"... and {len(result) - max_rows} more")
+  print()
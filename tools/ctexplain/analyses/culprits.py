@@ -0,0 +1,101 @@
+# Lint as: python3
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Analysis that finds the flags that unnecessarily fork configured targets."""
+from typing import Dict
+from typing import FrozenSet
+from typing import Tuple
+
+# Do not edit this line. Copybara replaces it with PY2 migration helper.
+from dataclasses import dataclass
+
+from tools.ctexplain.analyses.graph_index import diff_options
+from tools.ctexplain.analyses.graph_index import GraphIndex
+from tools.ctexplain.types import ConfiguredTarget
+
+
+@dataclass(frozen=True)
+class _Culprit():
+  """An option that creates clones."""
+  # "<FragmentOptions>.<option>". For example: "CoreOptions.compilation_mode".
+  option: str
+  # Number of clones this option contributes to. A clone whose configuration
+  # differs from its original in several options counts toward each of them.
+  clones: int
+  # Number of targets with such clones.
+  targets: int
+
+
+def analyze(cts: Tuple[ConfiguredTarget, ...]) -> Tuple[_Culprit, ...]:
+  """Runs the analysis on a build's configured targets.
+
+  Each set of configured targets with the same label and trimmed configuration
+  is compared against its first member. Options whose values differ are ones
+  the target doesn't need but that still fork it. Options are diffed once per
+  pair of distinct configurations, so this is linear in the number of
+  configured targets.
+
+  Args:
+    cts: The build's configured targets.
+
+  Returns:
+    Culprit options, worst first.
+  """
+  diff_cache: Dict[Tuple[str, str], FrozenSet[str]] = {}
+  clones: Dict[str, int] = {}
+  targets: Dict[str, int] = {}
+  for _, groups in GraphIndex(cts).repeated_targets():
+    target_culprits = set()
+    for group in groups.values():
+      original = group[0]
+      for clone in group[1:]:
+        if clone.config_hash == original.config_hash:
+          continue
+        pair = (original.config_hash, clone.config_hash)
+        diffs = diff_cache.get(pair)
+        if diffs is None:
+          diffs = diff_options(original.config, clone.config)
+          diff_cache[pair] = diffs
+        for option in diffs:
+          clones[option] = clones.get(option, 0) + 1
+        target_culprits.update(diffs)
+    for option in target_culprits:
+      targets[option] = targets.get(option, 0) + 1
+
+  culprits = [
+      _Culprit(option, count, targets[option])
+      for option, count in clones.items()
+  ]
+  culprits.sort(key=lambda culprit: (-culprit.clones, culprit.option))
+  return tuple(culprits)
+
+
+def report(result: Tuple[_Culprit, ...], max_rows: int = 20) -> None:
+  """Reports analysis results to the user.
+
+  Args:
+    result: the analysis result
+    max_rows: maximum number of options to show
+  """
+  if not result:
+    print("\nNo flags unnecessarily fork configured targets.\n")
+    return
+  print("\nFlags that fork configured targets that don't need them:")
+  print("Clones (targets)  Option")
+  for culprit in result[:max_rows]:
+    counts = f"{culprit.clones} ({culprit.targets})"
+    print(f"{counts:<17} {culprit.option}")
+  if len(result) > max_rows:
+    print(f"... and {len(result) - max_rows} more")
+  print()
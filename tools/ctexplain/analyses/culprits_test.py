@@ -0,0 +1,31 @@
+# Lint as: python3
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for culprits.py."""
+import unittest
+
+from tools.ctexplain.analyses import culprits
+from tools.ctexplain.analyses.testing_util import make_build
+
+
+class CulpritsTest(unittest.TestCase):
+
+  def testAnalysis(self):
+    res = culprits.analyze(make_build())
+    self.assertEqual([(c.option, c.clones, c.targets) for c in res],
+                     [('BarOptions.bar', 2, 2)])
+
+
+if __name__ == '__main__':
+  unittest.main()
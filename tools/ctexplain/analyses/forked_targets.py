@@ -0,0 +1,71 @@
+# Lint as: python3
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Analysis that ranks targets by how many configured targets they create."""
+from typing import Tuple
+
+# Do not edit this line. Copybara replaces it with PY2 migration helper.
+from dataclasses import dataclass
+
+from tools.ctexplain.analyses.graph_index import GraphIndex
+from tools.ctexplain.types import ConfiguredTarget
+
+
+@dataclass(frozen=True)
+class _ForkedTarget():
+  """A target with multiple configured targets."""
+  label: str
+  # Number of configured targets for this label.
+  configured_targets: int
+  # Number of those that behave differently: the number of distinct trimmed
+  # configurations. The rest are clones.
+  unique_configured_targets: int
+
+
+def analyze(cts: Tuple[ConfiguredTarget, ...]) -> Tuple[_ForkedTarget, ...]:
+  """Runs the analysis on a build's configured targets.
+
+  Args:
+    cts: The build's configured targets.
+
+  Returns:
+    Targets with multiple configured targets, most forked first.
+  """
+  forked = [
+      _ForkedTarget(label, sum(len(group) for group in groups.values()),
+                    len(groups))
+      for label, groups in GraphIndex(cts).repeated_targets()
+  ]
+  forked.sort(key=lambda target: (-target.configured_targets, target.label))
+  return tuple(forked)
+
+
+def report(result: Tuple[_ForkedTarget, ...], max_rows: int = 20) -> None:
+  """Reports analysis results to the user.
+
+  Args:
+    result: the analysis result
+    max_rows: maximum number of targets to show
+  """
+  if not result:
+    print("\nNo targets have multiple configured targets.\n")
+    return
+  print(f"\nTargets with multiple configured targets: {len(result)}")
+  print("Configured targets (unique)  Target")
+  for target in result[:max_rows]:
+    counts = f"{target.configured_targets} ({target.unique_configured_targets})"
+    print(f"{counts:<28} {target.label}")
+  if len(result) > max_rows:
+    print(f"... and {len(result) - max_rows} more")
+  print()
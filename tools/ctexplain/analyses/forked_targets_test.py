@@ -0,0 +1,32 @@
+# Lint as: python3
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for forked_targets.py."""
+import unittest
+
+from tools.ctexplain.analyses import forked_targets
+from tools.ctexplain.analyses.testing_util import make_build
+
+
+class ForkedTargetsTest(unittest.TestCase):
+
+  def testAnalysis(self):
+    res = forked_targets.analyze(make_build())
+    self.assertEqual([(t.label, t.configured_targets,
+                       t.unique_configured_targets) for t in res],
+                     [('//foo', 3, 2), ('//bar', 2, 1), ('//baz', 2, 2)])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,175 @@
+# Lint as: python3
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Indexed view of a build graph that trimming analyses share.
+
+A configured target's "trimmed configuration" is the subset of its
+configuration's option values that the configured target and its transitive
+dependencies actually require. Configured targets with the same label and the
+same trimmed configuration behave identically: they're clones that
+configuration trimming would merge.
+
+Real builds have far fewer distinct (configuration, required fragments) pairs
+than configured targets, so trimmed configurations are computed once per pair.
+That makes indexing linear in the number of configured targets.
+"""
+from typing import Dict
+from typing import FrozenSet
+from typing import Iterable
+from typing import List
+from typing import Mapping
+from typing import Tuple
+
+from tools.ctexplain.types import Configuration
+from tools.ctexplain.types import ConfiguredTarget
+from tools.ctexplain.types import HostConfiguration
+
+# A trimmed configuration: ((FragmentOptions name, ((option, value), ...)), ...)
+# with all entries sorted. For example:
+# (("CoreOptions", (("cpu", "x86"),)), ("PlatformOptions", ...)).
+TrimmedConfig = Tuple[Tuple[str, Tuple[Tuple[str, str], ...]], ...]
+
+# Options entry of Starlark flag and --define values. cquery reports them as
+# required fragments by flag label or "--define:<name>", which are the keys of
+# this entry.
+_USER_DEFINED = "user-defined"
+
+
+def trim(ct: ConfiguredTarget) -> TrimmedConfig:
+  """Returns the option values of a configured target's required fragments.
+
+  Required Starlark flags and --define values are kept as well, out of the
+  configuration's user-defined options.
+
+  Args:
+    ct: The configured target.
+
+  Returns:
+    The configured target's trimmed configuration.
+  """
+  config = ct.config
+  if isinstance(config, HostConfiguration):
+    # We don't read the host config's options, so we can't tell what it shares
+    # with other configs. Don't let it merge with anything.
+    return (("<host>", (("config_hash", ct.config_hash),)),)
+  if config is None or not config.options or not ct.transitive_fragments:
+    return ()
+  fragments = config.fragments or {}
+  user_defined = config.options.get(_USER_DEFINED, {})
+  options_classes = set()
+  user_defined_options = []
+  for name in ct.transitive_fragments:
+    # cquery reports both fragments and the FragmentOptions they require.
+    if name in config.options and name != _USER_DEFINED:
+      options_classes.add(name)
+    elif name in user_defined:
+      user_defined_options.append((name, user_defined[name]))
+    options_classes.update(fragments.get(name, ()))
+  trimmed = [
+      (options_class, tuple(sorted(config.options[options_class].items())))
+      for options_class in options_classes
+      if options_class in config.options
+  ]
+  if user_defined_options:
+    trimmed.append((_USER_DEFINED, tuple(sorted(user_defined_options))))
+  return tuple(sorted(trimmed))
+
+
+def diff_options(config1: Configuration,
+                 config2: Configuration) -> FrozenSet[str]:
+  """Returns the options that have different values in two configurations.
+
+  Args:
+    config1: The first configuration.
+    config2: The second configuration.
+
+  Returns:
+    Names of differing options, as "<FragmentOptions>.<option>". An option
+    that's only set in one configuration counts as different.
+  """
+  diffs = set()
+  for options_class in set(config1.options) | set(config2.options):
+    options1 = config1.options.get(options_class, {})
+    options2 = config2.options.get(options_class, {})
+    for option in set(options1) | set(options2):
+      if options1.get(option) != options2.get(option):
+        diffs.add(f"{options_class}.{option}")
+  return frozenset(diffs)
+
+
+class GraphIndex():
+  """Groups a build's configured targets by label and trimmed configuration.
+
+  Trimmed configurations are interned as integer ids, so comparing them is
+  cheap regardless of how many options they have.
+  """
+
+  def __init__(self, cts: Iterable[ConfiguredTarget]):
+    """Indexes configured targets.
+
+    Args:
+      cts: The build's configured targets.
+    """
+    # Interned trimmed configurations. trimmed_configs[i] has id i.
+    self.trimmed_configs: List[TrimmedConfig] = []
+    self._trimmed_config_ids: Dict[TrimmedConfig, int] = {}
+    # Maps (config hash, transitive fragments) -> trimmed config id.
+    self._pair_to_id: Dict[Tuple[str, Tuple[str, ...]], int] = {}
+    # Maps label -> trimmed config id -> configured targets with both.
+    self.by_label: Dict[str, Dict[int, List[ConfiguredTarget]]] = {}
+    self.configured_targets = 0
+
+    for ct in cts:
+      self.by_label.setdefault(ct.label, {}).setdefault(
+          self.trimmed_config_id(ct), []).append(ct)
+      self.configured_targets += 1
+
+  def intern(self, trimmed_config: TrimmedConfig) -> int:
+    """Returns the id of a trimmed configuration, assigning one if needed."""
+    trimmed_id = self._trimmed_config_ids.get(trimmed_config)
+    if trimmed_id is None:
+      trimmed_id = len(self.trimmed_configs)
+      self._trimmed_config_ids[trimmed_config] = trimmed_id
+      self.trimmed_configs.append(trimmed_config)
+    return trimmed_id
+
+  def trimmed_config_id(self, ct: ConfiguredTarget) -> int:
+    """Returns the id of a configured target's trimmed configuration.
+
+    Trimming is only computed once per (configuration, required fragments)
+    pair. Config hashes are derived from the configurations' options, so this
+    also holds across builds.
+
+    Args:
+      ct: The configured target. It isn't added to the index.
+
+    Returns:
+      The trimmed configuration's id.
+    """
+    pair = (ct.config_hash, ct.transitive_fragments)
+    trimmed_id = self._pair_to_id.get(pair)
+    if trimmed_id is None:
+      trimmed_id = self.intern(trim(ct))
+      self._pair_to_id[pair] = trimmed_id
+    return trimmed_id
+
+  def repeated_targets(
+      self) -> Iterable[Tuple[str, Mapping[int, List[ConfiguredTarget]]]]:
+    """Yields (label, {trimmed config id: configured targets}) for each label.
+
+    Only labels with more than one configured target are included.
+    """
+    for label, groups in self.by_label.items():
+      if len(groups) > 1 or len(next(iter(groups.values()))) > 1:
+        yield (label, groups)
@@ -0,0 +1,103 @@
+# Lint as: python3
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for graph_index.py."""
+import unittest
+
+from tools.ctexplain.analyses.graph_index import diff_options
+from tools.ctexplain.analyses.graph_index import GraphIndex
+from tools.ctexplain.analyses.graph_index import trim
+from tools.ctexplain.analyses.testing_util import make_config
+from tools.ctexplain.types import ConfiguredTarget
+from tools.ctexplain.types import HostConfiguration
+from tools.ctexplain.types import NullConfiguration
+
+
+class GraphIndexTest(unittest.TestCase):
+
+  def testTrimKeepsRequiredFragmentOptions(self):
+    ct = ConfiguredTarget('//foo', make_config('a', 'x'), 'hash1',
+                          ('FooConfiguration',))
+    self.assertEqual(trim(ct), (('FooOptions', (('foo', 'a'),)),))
+
+  def testTrimKeepsRequiredOptionsClasses(self):
+    ct = ConfiguredTarget('//foo', make_config('a', 'x'), 'hash1',
+                          ('BarOptions',))
+    self.assertEqual(trim(ct), (('BarOptions', (('bar', 'x'),)),))
+
+  def testTrimKeepsRequiredUserDefinedOptions(self):
+    flags = {'//f:flag': 'one', '--define:x': 'y'}
+    config1 = make_config('a', 'x', flags)
+    config2 = make_config('a', 'x', dict(flags, **{'//f:flag': 'two'}))
+    requires_flag = ('FooConfiguration', '//f:flag')
+    ct1 = ConfiguredTarget('//foo', config1, 'hash1', requires_flag)
+    ct2 = ConfiguredTarget('//foo', config2, 'hash2', requires_flag)
+    self.assertEqual(trim(ct1), (
+        ('FooOptions', (('foo', 'a'),)),
+        ('user-defined', (('//f:flag', 'one'),)),
+    ))
+    self.assertNotEqual(trim(ct1), trim(ct2))
+
+    requires_define = ('--define:x',)
+    self.assertEqual(
+        trim(ConfiguredTarget('//foo', config1, 'hash1', requires_define)),
+        trim(ConfiguredTarget('//foo', config2, 'hash2', requires_define)))
+
+  def testIndexSeparatesStarlarkFlagValues(self):
+    cts = [
+        ConfiguredTarget('//foo', make_config('a', 'x', {'//f:flag': value}),
+                         config_hash, ('//f:flag',))
+        for value, config_hash in (('one', 'hash1'), ('two', 'hash2'))
+    ]
+    index = GraphIndex(cts)
+    self.assertEqual(len(index.by_label['//foo']), 2)
+    self.assertEqual(list(index.repeated_targets()),
+                     [('//foo', index.by_label['//foo'])])
+
+  def testTrimSpecialConfigs(self):
+    null = ConfiguredTarget('//foo', NullConfiguration(), 'null', ())
+    host1 = ConfiguredTarget('//foo', HostConfiguration(), 'HOST1', ())
+    host2 = ConfiguredTarget('//foo', HostConfiguration(), 'HOST2', ())
+    self.assertEqual(trim(null), ())
+    self.assertNotEqual(trim(host1), trim(host2))
+
+  def testDiffOptions(self):
+    self.assertEqual(
+        diff_options(make_config('a', 'x'), make_config('a', 'y')),
+        frozenset({'BarOptions.bar'}))
+    self.assertEqual(
+        diff_options(make_config('a', 'x'), NullConfiguration()),
+        frozenset({'BarOptions.bar', 'FooOptions.foo'}))
+
+  def testIndex(self):
+    ct1 = ConfiguredTarget('//foo', make_config('a', 'x'), 'hash1',
+                           ('FooConfiguration',))
+    ct2 = ConfiguredTarget('//foo', make_config('a', 'y'), 'hash2',
+                           ('FooConfiguration',))
+    ct3 = ConfiguredTarget('//foo', make_config('b', 'x'), 'hash3',
+                           ('FooConfiguration',))
+    ct4 = ConfiguredTarget('//bar', make_config('a', 'x'), 'hash1', ())
+
+    index = GraphIndex((ct1, ct2, ct3, ct4))
+    self.assertEqual(4, index.configured_targets)
+    self.assertEqual(3, len(index.trimmed_configs))
+    self.assertEqual(
+        sorted(index.by_label['//foo'].values(), key=len),
+        [[ct3], [ct1, ct2]])
+    self.assertEqual([label for label, _ in index.repeated_targets()],
+                     ['//foo'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,153 @@
+# Lint as: python3
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Analysis that measures how much distinct builds could share under trimming.
+
+Two builds can share a configured target if both have the same label with the
+same trimmed configuration (see graph_index.py). This estimates how much total
+analysis work consolidating flag variants would save.
+"""
+from typing import Dict
+from typing import List
+from typing import Mapping
+from typing import Optional
+from typing import Tuple
+
+# Do not edit this line. Copybara replaces it with PY2 migration helper.
+from dataclasses import dataclass
+
+from tools.ctexplain.analyses.graph_index import GraphIndex
+from tools.ctexplain.types import ConfiguredTarget
+from tools.ctexplain.types import HostConfiguration
+
+
+@dataclass(frozen=True)
+class _BuildShareability():
+  """How much one build shares with the others."""
+  # The build's description, as passed to ctexplain.
+  build: str
+  # Number of configured targets in this build.
+  configured_targets: int
+  # Number of those that another build also has, after trimming.
+  shared: int
+  # The build this one shares the most with, or None if it shares nothing.
+  closest_build: Optional[str]
+  # Number of distinct trimmed configured targets shared with closest_build.
+  closest_build_overlap: int
+
+
+@dataclass(frozen=True)
+class _Shareability():
+  """Analysis result."""
+  # Sum of all builds' configured targets.
+  configured_targets: int
+  # Number of configured targets if all builds shared one trimmed graph.
+  shared_configured_targets: int
+  # Per-build results, in the order the builds were given.
+  builds: Tuple[_BuildShareability, ...]
+
+
+def analyze(
+    builds: Mapping[str, Tuple[ConfiguredTarget, ...]]) -> _Shareability:
+  """Runs the analysis on several builds' configured targets.
+
+  Every (label, trimmed configuration) key is interned into one index shared
+  by all builds, with trimmed configurations interned by a GraphIndex. Host
+  configured targets are never shared: we don't read the host configuration's
+  options, so can't tell if they match across builds.
+
+  Args:
+    builds: Maps each build's description to its configured targets.
+
+  Returns:
+    The analysis result.
+  """
+  descriptions = list(builds)
+  # Only used to intern trimmed configurations.
+  index = GraphIndex(())
+  key_ids: Dict[Tuple[str, int], int] = {}
+  # For each build: key id -> number of the build's configured targets with it.
+  build_keys: List[Dict[int, int]] = []
+  # For each key id: indexes of the builds that have it.
+  key_builds: List[List[int]] = []
+  configured_targets = 0
+  host_configured_targets = 0
+  for build_index, description in enumerate(descriptions):
+    keys: Dict[int, int] = {}
+    for ct in builds[description]:
+      configured_targets += 1
+      if isinstance(ct.config, HostConfiguration):
+        host_configured_targets += 1
+        continue
+      key_id = key_ids.setdefault((ct.label, index.trimmed_config_id(ct)),
+                                  len(key_ids))
+      count = keys.get(key_id)
+      if count is None:
+        keys[key_id] = 1
+        if key_id == len(key_builds):
+          key_builds.append([build_index])
+        else:
+          key_builds[key_id].append(build_index)
+      else:
+        keys[key_id] = count + 1
+    build_keys.append(keys)
+
+  overlaps: Dict[Tuple[int, int], int] = {}
+  for sharing_builds in key_builds:
+    for i, build1 in enumerate(sharing_builds):
+      for build2 in sharing_builds[i + 1:]:
+        overlaps[(build1, build2)] = overlaps.get((build1, build2), 0) + 1
+
+  results = []
+  for build_index, description in enumerate(descriptions):
+    keys = build_keys[build_index]
+    shared = sum(count for key_id, count in keys.items()
+                 if len(key_builds[key_id]) > 1)
+    closest_build = None
+    closest_build_overlap = 0
+    for other_index, other in enumerate(descriptions):
+      pair = tuple(sorted((build_index, other_index)))
+      overlap = overlaps.get(pair, 0)
+      if other_index != build_index and overlap > closest_build_overlap:
+        closest_build = other
+        closest_build_overlap = overlap
+    results.append(
+        _BuildShareability(description, len(builds[description]), shared,
+                           closest_build, closest_build_overlap))
+
+  return _Shareability(configured_targets,
+                       len(key_ids) + host_configured_targets, tuple(results))
+
+
+def report(result: _Shareability) -> None:
+  """Reports analysis results to the user.
+
+  Args:
+    result: the analysis result
+  """
+  savings = result.configured_targets - result.shared_configured_targets
+  print(f"""
+Builds: {len(result.builds)}
+Configured targets across all builds: {result.configured_targets}
+Configured targets with maximal sharing: {result.shared_configured_targets} \
+({savings} fewer)
+""")
+  for build in result.builds:
+    print(f"{build.build}:")
+    print(f"  Configured targets: {build.configured_targets} "
+          f"({build.shared} shareable with other builds)")
+    if build.closest_build is not None:
+      print(f"  Shares most with: {build.closest_build} "
+            f"({build.closest_build_overlap} configured targets)")
+  print()
@@ -0,0 +1,56 @@
+# Lint as: python3
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for shareability.py."""
+import unittest
+
+from tools.ctexplain.analyses import shareability
+from tools.ctexplain.analyses.testing_util import make_config
+from tools.ctexplain.types import ConfiguredTarget
+from tools.ctexplain.types import HostConfiguration
+
+
+class ShareabilityTest(unittest.TestCase):
+
+  def testAnalysis(self):
+    foo = ('FooConfiguration',)
+    bar = ('BarOptions',)
+    build1 = (
+        ConfiguredTarget('//foo', make_config('a', 'x'), 'hash1', foo),
+        ConfiguredTarget('//bar', make_config('a', 'x'), 'hash1', bar),
+        ConfiguredTarget('//h', HostConfiguration(), 'HOST', ()),
+    )
+    # --bar=y: //foo doesn't need it, so it's shareable with build1.
+    build2 = (
+        ConfiguredTarget('//foo', make_config('a', 'y'), 'hash2', foo),
+        ConfiguredTarget('//bar', make_config('a', 'y'), 'hash2', bar),
+        ConfiguredTarget('//h', HostConfiguration(), 'HOST', ()),
+    )
+    # --foo=b: nothing is shareable with build1.
+    build3 = (
+        ConfiguredTarget('//foo', make_config('b', 'x'), 'hash3', foo),
+    )
+
+    res = shareability.analyze({'b1': build1, 'b2': build2, 'b3': build3})
+    self.assertEqual(7, res.configured_targets)
+    # //foo (foo=a), //foo (foo=b), //bar (bar=x), //bar (bar=y), 2 x //h.
+    self.assertEqual(6, res.shared_configured_targets)
+    self.assertEqual(
+        [(b.build, b.configured_targets, b.shared, b.closest_build,
+          b.closest_build_overlap) for b in res.builds],
+        [('b1', 3, 1, 'b2', 1), ('b2', 3, 1, 'b1', 1), ('b3', 1, 0, None, 0)])
+
+
+if __name__ == '__main__':
+  unittest.main()
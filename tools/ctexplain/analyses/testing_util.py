@@ -0,0 +1,75 @@
+# Lint as: python3
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Fixtures shared by the analyses tests."""
+from typing import Mapping
+from typing import Optional
+from typing import Tuple
+
+# Do not edit this line. Copybara replaces it with PY2 migration helper.
+from frozendict import frozendict
+
+from tools.ctexplain.types import Configuration
+from tools.ctexplain.types import ConfiguredTarget
+from tools.ctexplain.types import NullConfiguration
+
+
+def make_config(foo: str,
+                bar: str,
+                user_defined: Optional[Mapping[str, str]] = None
+               ) -> Configuration:
+  """Returns a configuration with two options.
+
+  FooConfiguration requires FooOptions, which has option "foo". BarOptions,
+  which has option "bar", isn't required by any fragment.
+
+  Args:
+    foo: The value of FooOptions.foo.
+    bar: The value of BarOptions.bar.
+    user_defined: If set, the Starlark flag and --define values of the
+      configuration, keyed like Bazel reports them: by flag label or
+      "--define:<name>".
+
+  Returns:
+    The configuration.
+  """
+  options = {
+      'FooOptions': frozendict({'foo': foo}),
+      'BarOptions': frozendict({'bar': bar}),
+  }
+  if user_defined is not None:
+    options['user-defined'] = frozendict(user_defined)
+  return Configuration(
+      frozendict({'FooConfiguration': ('FooOptions',)}), frozendict(options))
+
+
+def make_build() -> Tuple[ConfiguredTarget, ...]:
+  """Returns the configured targets of a small build.
+
+  //foo and //bar require FooConfiguration, //baz only requires BarOptions.
+  Configs "hash1" and "hash2" only differ in BarOptions.bar, so //foo and //bar
+  each have a clone in them. Config "hash3" has a different FooOptions.foo.
+  """
+  foo = ('FooConfiguration',)
+  bar = ('BarOptions',)
+  return (
+      ConfiguredTarget('//foo', make_config('a', 'x'), 'hash1', foo),
+      ConfiguredTarget('//foo', make_config('a', 'y'), 'hash2', foo),
+      ConfiguredTarget('//foo', make_config('b', 'x'), 'hash3', foo),
+      ConfiguredTarget('//bar', make_config('a', 'x'), 'hash1', foo),
+      ConfiguredTarget('//bar', make_config('a', 'y'), 'hash2', foo),
+      ConfiguredTarget('//baz', make_config('a', 'x'), 'hash1', bar),
+      ConfiguredTarget('//baz', make_config('a', 'y'), 'hash2', bar),
+      ConfiguredTarget('//src', NullConfiguration(), 'null', ()),
+  )
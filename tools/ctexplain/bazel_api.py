@@ -19,9 +19,17 @@ There's no Python Bazel API so we invoke Bazel as a subprocess.
 import json
 import os
 import subprocess
+import sys
+import tempfile
+import threading
 from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
+from typing import Optional
 from typing import Tuple
+from typing import TypeVar
 # Do not edit this line. Copybara replaces it with PY2 migration helper.
 from frozendict import frozendict
 from tools.ctexplain.types import Configuration
@@ -29,6 +37,8 @@ from tools.ctexplain.types import ConfiguredTarget
 from tools.ctexplain.types import HostConfiguration
 from tools.ctexplain.types import NullConfiguration
 
+T = TypeVar("T")
+
 
 def run_bazel_in_client(args: List[str]) -> Tuple[int, List[str], List[str]]:
   """Calls bazel within the current workspace.
@@ -40,7 +50,7 @@ def run_bazel_in_client(args: List[str]) -> Tuple[int, List[str], List[str]]:
     args: the arguments to call Bazel with
 
   Returns:
-    Tuple of (return code, stdout, stderr)
+    Tuple of (return code, stdout lines, stderr lines)
   """
   result = subprocess.run(
       ["blaze"] + args,
@@ -49,7 +59,60 @@ def run_bazel_in_client(args: List[str]) -> Tuple[int, List[str], List[str]]:
       stderr=subprocess.PIPE,
       check=False)
   return (result.returncode, result.stdout.decode("utf-8").split(os.linesep),
-          result.stderr)
+          result.stderr.decode("utf-8", "replace").split(os.linesep))
+
+
+def stream_bazel_in_client(args: List[str]) -> Iterator[str]:
+  """Calls bazel within the current workspace and yields its stdout lines.
+
+  Lines are read from the subprocess pipe as Bazel writes them, so the full
+  output is never buffered.
+
+  Args:
+    args: the arguments to call Bazel with
+
+  Yields:
+    Lines of stdout, without line terminators.
+
+  Raises:
+    RuntimeError: If Bazel exits with a non-zero return code, after all of
+      stdout was yielded.
+  """
+  # stderr goes to a file: a pipe could fill up and block Bazel while we're
+  # still reading stdout.
+  with tempfile.TemporaryFile() as stderr:
+    with subprocess.Popen(["blaze"] + args,
+                          cwd=os.getcwd(),
+                          stdout=subprocess.PIPE,
+                          stderr=stderr) as process:
+      for line in process.stdout:
+        yield line.decode("utf-8").rstrip("\r\n")
+      returncode = process.wait()
+    if returncode != 0:
+      stderr.seek(0)
+      raise RuntimeError("invocation failed: " +
+                         stderr.read().decode("utf-8", "replace"))
+
+
+def _stream_from_run_bazel(
+    run_bazel: Callable[[List[str]], Tuple[int, List[str], List[str]]]
+) -> Callable[[List[str]], Iterator[str]]:
+  """Adapts a buffered Bazel invoker to the stream_bazel_in_client interface."""
+
+  def stream_bazel(args: List[str]) -> Iterator[str]:
+    (returncode, stdout, stderr) = run_bazel(args)
+    if returncode != 0:
+      raise RuntimeError("invocation failed: " + os.linesep.join(stderr))
+    return iter(stdout)
+
+  return stream_bazel
+
+
+def _with_startup_options(invoke_bazel: Callable[[List[str]], T],
+                          startup_options: Tuple[str, ...]
+                         ) -> Callable[[List[str]], T]:
+  """Wraps a Bazel invoker to pass startup options before the command."""
+  return lambda args: invoke_bazel(list(startup_options) + args)
 
 
 class BazelApi():
@@ -58,11 +121,41 @@ class BazelApi():
   def __init__(self,
                run_bazel: Callable[[List[str]],
                                    Tuple[int, List[str],
-                                         List[str]]] = run_bazel_in_client):
+                                         List[str]]] = run_bazel_in_client,
+               config_cache_dir: Optional[str] = None,
+               stream_bazel: Optional[Callable[[List[str]],
+                                               Iterator[str]]] = None,
+               startup_options: Tuple[str, ...] = ()):
+    """Creates an API instance.
+
+    Args:
+      run_bazel: Function that invokes Bazel with the given arguments.
+      config_cache_dir: If set, configurations read with get_configs are cached
+        as JSON files in this directory, keyed by config hash. Config hashes
+        are derived from the config's options, so entries never go stale.
+      stream_bazel: Function that invokes Bazel with the given arguments and
+        yields its stdout lines, see stream_bazel_in_client. Defaults to
+        stream_bazel_in_client for the default run_bazel, and to an adapter
+        over run_bazel otherwise.
+      startup_options: Bazel startup options to pass before every command. For
+        example, ("--output_base=/tmp/foo",) gives this API its own Bazel
+        server, so it can run concurrently with other instances.
+    """
+    if stream_bazel is None:
+      if run_bazel is run_bazel_in_client:
+        stream_bazel = stream_bazel_in_client
+      else:
+        stream_bazel = _stream_from_run_bazel(run_bazel)
+    if startup_options:
+      run_bazel = _with_startup_options(run_bazel, startup_options)
+      stream_bazel = _with_startup_options(stream_bazel, startup_options)
     self.run_bazel = run_bazel
+    self.stream_bazel = stream_bazel
+    self.config_cache_dir = config_cache_dir
 
   def cquery(self,
-             args: List[str]) -> Tuple[bool, str, Tuple[ConfiguredTarget, ...]]:
+             args: List[str]
+            ) -> Tuple[bool, List[str], Tuple[ConfiguredTarget, ...]]:
     """Calls cquery with the given arguments.
 
     Args:
@@ -70,9 +163,9 @@ class BazelApi():
 
     Returns:
       (success, stderr, cts), where success is True iff the query succeeded,
-      stderr contains the query's stderr (regardless of success value), and cts
-      is the configured targets found by the query if successful, empty
-      otherwise.
+      stderr contains the query's stderr lines (regardless of success value),
+      and cts is the configured targets found by the query if successful,
+      empty otherwise.
 
       ct order preserves cquery's output order. This is topologically sorted
       with duplicates removed. So no unique configured target appears twice and
@@ -83,15 +176,26 @@ class BazelApi():
     if returncode != 0:
       return (False, stderr, ())
 
-    cts = []
-    for line in stdout:
-      if not line.strip():
-        continue
-      ctinfo = _parse_cquery_result_line(line)
-      if ctinfo is not None:
-        cts.append(ctinfo)
+    return (True, stderr, tuple(_parse_cquery_result_lines(stdout)))
+
+  def iter_cquery(self, args: List[str]) -> Iterator[ConfiguredTarget]:
+    """Streams the configured targets of a cquery with the given arguments.
 
-    return (True, stderr, tuple(cts))
+    Unlike cquery, this parses Bazel's output line by line as it's produced,
+    so the raw output is never held in memory.
+
+    Args:
+      args: A list of cquery command-line arguments, one argument per entry.
+
+    Yields:
+      The configured targets found by the query, in cquery's output order.
+      See cquery. Configs aren't set: use get_configs for that.
+
+    Raises:
+      RuntimeError: If the query fails.
+    """
+    base_args = ["cquery", "--show_config_fragments=transitive"]
+    return _parse_cquery_result_lines(self.stream_bazel(base_args + args))
 
   def get_config(self, config_hash: str) -> Configuration:
     """Calls "bazel config" with the given config hash.
@@ -113,18 +217,149 @@ class BazelApi():
     base_args = ["config", "--output=json"]
     (returncode, stdout, stderr) = self.run_bazel(base_args + [config_hash])
     if returncode != 0:
-      raise ValueError("Could not get config: " + stderr)
-    config_json = json.loads(os.linesep.join(stdout))
-    fragments = frozendict({
-        _base_name(entry["name"]):
-        tuple(_base_name(clazz) for clazz in entry["fragmentOptions"])
-        for entry in config_json["fragments"]
-    })
-    options = frozendict({
-        _base_name(entry["name"]): frozendict(entry["options"])
-        for entry in config_json["fragmentOptions"]
-    })
-    return Configuration(fragments, options)
+      raise ValueError("Could not get config: " + os.linesep.join(stderr))
+    return _parse_config(json.loads(os.linesep.join(stdout)))
+
+  def get_configs(self,
+                  config_hashes: Iterable[str]) -> Dict[str, Configuration]:
+    """Gets the configurations for the given config hashes.
+
+    Configs in the config cache are read from there. All others are fetched
+    with a single "bazel config --dump_all" call rather than one "bazel config"
+    call per hash.
+
+    Args:
+      config_hashes: Config hashes as reported by "bazel cquery".
+
+    Returns:
+      A map from each config hash to its configuration.
+
+    Raises:
+      ValueError: On any parsing problems or if a config can't be found.
+    """
+    configs = {}
+    uncached_hashes = []
+    # dict.fromkeys removes duplicates while preserving order.
+    for config_hash in dict.fromkeys(config_hashes):
+      if config_hash == "HOST":
+        configs[config_hash] = HostConfiguration()
+      elif config_hash == "null":
+        configs[config_hash] = NullConfiguration()
+      else:
+        config_json = self._read_cached_config(config_hash)
+        if config_json is None:
+          uncached_hashes.append(config_hash)
+        else:
+          configs[config_hash] = _parse_config(config_json)
+    if not uncached_hashes:
+      return configs
+
+    base_args = ["config", "--dump_all", "--output=json"]
+    (returncode, stdout, stderr) = self.run_bazel(base_args)
+    if returncode != 0:
+      raise ValueError("Could not get configs: " + os.linesep.join(stderr))
+    all_configs_json = json.loads(os.linesep.join(stdout))
+    for config_hash in uncached_hashes:
+      # cquery reports shortened hashes, so match on prefixes like
+      # "bazel config <hash>" does.
+      matches = [
+          config_json for config_json in all_configs_json
+          if config_json["configHash"].startswith(config_hash)
+      ]
+      if len(matches) != 1:
+        raise ValueError(
+            f"Expected exactly one config for {config_hash}, found "
+            f"{len(matches)}")
+      self._write_cached_config(config_hash, matches[0])
+      configs[config_hash] = _parse_config(matches[0])
+    return configs
+
+  def _cached_config_path(self, config_hash: str) -> str:
+    return os.path.join(self.config_cache_dir, config_hash + ".json")
+
+  def _read_cached_config(self, config_hash: str):
+    """Returns the cached JSON for a config hash or None if not cached."""
+    if not self.config_cache_dir:
+      return None
+    try:
+      with open(self._cached_config_path(config_hash), "r") as f:
+        return json.load(f)
+    except (IOError, ValueError):
+      return None
+
+  def _write_cached_config(self, config_hash: str, config_json) -> None:
+    if not self.config_cache_dir:
+      return
+    os.makedirs(self.config_cache_dir, exist_ok=True)
+    # Write to a temporary file first so concurrent ctexplain runs and builds
+    # never read partially written entries.
+    path = self._cached_config_path(config_hash)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+      json.dump(config_json, f)
+    os.replace(tmp_path, path)
+
+  def get_output_base(self) -> str:
+    """Returns the output base of the current workspace.
+
+    Raises:
+      ValueError: If "bazel info" fails.
+    """
+    (returncode, stdout, stderr) = self.run_bazel(["info", "output_base"])
+    if returncode != 0:
+      raise ValueError("Could not get output base: " + os.linesep.join(stderr))
+    return stdout[0].strip()
+
+  def expunge(self) -> None:
+    """Deletes the output base and shuts down its Bazel server.
+
+    Raises:
+      ValueError: If "bazel clean --expunge" fails.
+    """
+    (returncode, _, stderr) = self.run_bazel(["clean", "--expunge"])
+    if returncode != 0:
+      raise ValueError("Could not expunge output base: " +
+                       os.linesep.join(stderr))
+
+
+def _parse_config(config_json) -> Configuration:
+  """Converts "bazel config --output=json" output to a Configuration."""
+  fragments = frozendict({
+      _base_name(entry["name"]):
+      tuple(_base_name(clazz) for clazz in entry["fragmentOptions"])
+      for entry in config_json["fragments"]
+  })
+  options = frozendict({
+      _base_name(entry["name"]): frozendict(entry["options"])
+      for entry in config_json["fragmentOptions"]
+  })
+  return Configuration(fragments, options)
+
+
+def _parse_cquery_result_lines(
+    lines: Iterable[str]) -> Iterator[ConfiguredTarget]:
+  """Parses cquery output lines into ConfiguredTargets.
+
+  Config hashes and fragment tuples are shared between all configured targets
+  that have the same ones, which saves a lot of memory on large graphs.
+
+  Args:
+    lines: cquery output lines.
+
+  Yields:
+    The parsed configured targets.
+  """
+  fragments_cache = {}
+  for line in lines:
+    if not line.strip():
+      continue
+    ct = _parse_cquery_result_line(line)
+    if ct is None:
+      continue
+    fragments = fragments_cache.setdefault(ct.transitive_fragments,
+                                           ct.transitive_fragments)
+    yield ConfiguredTarget(ct.label, None, sys.intern(ct.config_hash),
+                           fragments)
 
 
 # TODO(gregce): have cquery --output=jsonproto support --show_config_fragments
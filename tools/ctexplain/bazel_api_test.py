@@ -13,10 +13,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """Tests for bazel_api.py."""
+import json
 import os
+import subprocess
+import sys
+import tempfile
 import unittest
+from unittest import mock
 from src.test.py.bazel import test_base
 from tools.ctexplain.bazel_api import BazelApi
+from tools.ctexplain.bazel_api import run_bazel_in_client
 from tools.ctexplain.types import HostConfiguration
 from tools.ctexplain.types import NullConfiguration
 
@@ -152,6 +158,171 @@ class BazelApiTest(test_base.TestBase):
     self.assertDictEqual(user_defined_options._dict,
                          {'//testapp:my_flag': 'algo'})
 
+  def testGetConfigs(self):
+    self.ScratchFile('testapp/BUILD', [
+        'genrule(',
+        '    name = "g",',
+        '    srcs = [],',
+        '    cmd = "",',
+        '    outs = ["g.out"],',
+        '    tools = [":fg"])',
+        'filegroup(name = "fg", srcs = ["a.file"])',
+    ])
+    cts = self._bazel_api.cquery(['deps(//testapp:g)'])[2]
+    configs = self._bazel_api.get_configs(ct.config_hash for ct in cts)
+    self.assertSetEqual(set(configs.keys()), {ct.config_hash for ct in cts})
+    for ct in cts:
+      self.assertEqual(configs[ct.config_hash],
+                       self._bazel_api.get_config(ct.config_hash))
+
+  def testStartupOptions(self):
+    calls = []
+
+    def run_bazel(args):
+      calls.append(args)
+      return (0, ['//a:a (abcdef1) [FooConfiguration]'], [])
+
+    bazel_api = BazelApi(run_bazel, startup_options=('--output_base=/ob',))
+    list(bazel_api.iter_cquery(['//a:a']))
+    self.assertEqual(calls[0][:2], ['--output_base=/ob', 'cquery'])
+    bazel_api.get_output_base()
+    self.assertEqual(calls[1], ['--output_base=/ob', 'info', 'output_base'])
+    bazel_api.expunge()
+    self.assertEqual(calls[2], ['--output_base=/ob', 'clean', '--expunge'])
+
+
+class ConfigCacheTest(unittest.TestCase):
+
+  _CONFIG_JSON = {
+      'configHash': 'abcdef123456',
+      'fragments': [{
+          'name': 'a.b.PlatformConfiguration',
+          'fragmentOptions': ['a.b.PlatformOptions']
+      }],
+      'fragmentOptions': [{
+          'name': 'a.b.PlatformOptions',
+          'options': {
+              'platforms': '//foo'
+          }
+      }],
+  }
+
+  def setUp(self):
+    super().setUp()
+    self._calls = []
+    self._cache_dir = os.path.join(
+        tempfile.mkdtemp(dir=os.environ.get('TEST_TMPDIR')), 'configs')
+
+  def _run_bazel(self, args):
+    self._calls.append(args)
+    return (0, [json.dumps([self._CONFIG_JSON])], [])
+
+  def testGetConfigsFetchesAllConfigsOnce(self):
+    bazel_api = BazelApi(self._run_bazel)
+    configs = bazel_api.get_configs(['abcdef1', 'HOST', 'abcdef1', 'null'])
+    self.assertEqual(self._calls, [['config', '--dump_all', '--output=json']])
+    self.assertIsInstance(configs['HOST'], HostConfiguration)
+    self.assertIsInstance(configs['null'], NullConfiguration)
+    self.assertEqual(configs['abcdef1'].fragments['PlatformConfiguration'],
+                     ('PlatformOptions',))
+    self.assertEqual(configs['abcdef1'].options['PlatformOptions']['platforms'],
+                     '//foo')
+
+  def testGetConfigsUsesCache(self):
+    first = BazelApi(self._run_bazel, config_cache_dir=self._cache_dir)
+    configs = first.get_configs(['abcdef1'])
+    self.assertEqual(len(self._calls), 1)
+
+    second = BazelApi(self._run_bazel, config_cache_dir=self._cache_dir)
+    self.assertEqual(second.get_configs(['abcdef1']), configs)
+    self.assertEqual(len(self._calls), 1)
+
+  def testGetConfigsUnknownHash(self):
+    bazel_api = BazelApi(self._run_bazel)
+    with self.assertRaises(ValueError):
+      bazel_api.get_configs(['fedcba'])
+
+
+class CqueryStreamTest(unittest.TestCase):
+
+  def _stream_bazel(self, args):
+    self.assertEqual(args[:2], ['cquery', '--show_config_fragments=transitive'])
+    yield '//a:a (abcdef1) [FooConfiguration]'
+    yield ''
+    yield '//a:b (abcdef1) [FooConfiguration]'
+    yield '//a:c (null) []'
+
+  def testIterCqueryParsesLazily(self):
+    bazel_api = BazelApi(stream_bazel=self._stream_bazel)
+    cts = bazel_api.iter_cquery(['//a:all'])
+    first = next(cts)
+    self.assertEqual(first.label, '//a:a')
+    self.assertEqual(first.config_hash, 'abcdef1')
+    self.assertIsNone(first.config)
+    rest = list(cts)
+    self.assertEqual([ct.label for ct in rest], ['//a:b', '//a:c'])
+    # Equal fragment tuples are shared between configured targets.
+    self.assertIs(first.transitive_fragments, rest[0].transitive_fragments)
+    self.assertEqual(rest[1].transitive_fragments, ())
+
+  def testIterCqueryFailure(self):
+    bazel_api = BazelApi(lambda args: (1, [], ['no such target']))
+    with self.assertRaisesRegex(RuntimeError, 'no such target'):
+      list(bazel_api.iter_cquery(['//a:nope']))
+
+
+class FailedInvocationTest(unittest.TestCase):
+  """Tests failures with the return types of the production invoker."""
+
+  def _run(self, args, **kwargs):
+    del kwargs  # Unused.
+    return subprocess.CompletedProcess(
+        ['blaze'] + args, 2, stdout=b'',
+        stderr=b'ERROR: no such package\n\xff\n')
+
+  def testRunBazelInClientDecodesStderr(self):
+    with mock.patch.object(subprocess, 'run', self._run):
+      (returncode, _, stderr) = run_bazel_in_client(['info'])
+    self.assertEqual(returncode, 2)
+    self.assertIn('ERROR: no such package', stderr)
+
+  def testErrorsIncludeStderr(self):
+    bazel_api = BazelApi(run_bazel_in_client)
+    with mock.patch.object(subprocess, 'run', self._run):
+      with self.assertRaisesRegex(ValueError, 'no such package'):
+        bazel_api.get_output_base()
+      with self.assertRaisesRegex(ValueError, 'no such package'):
+        bazel_api.get_config('abcdef1')
+      with self.assertRaisesRegex(ValueError, 'no such package'):
+        bazel_api.get_configs(['abcdef1'])
+      self.assertFalse(bazel_api.cquery(['//a:a'])[0])
+
+  def testStreamingErrorsIncludeStderr(self):
+    def run_bazel(args):
+      # Not run_bazel_in_client itself, so BazelApi adapts it for streaming.
+      return run_bazel_in_client(args)
+
+    bazel_api = BazelApi(run_bazel)
+    with mock.patch.object(subprocess, 'run', self._run):
+      with self.assertRaisesRegex(RuntimeError, 'no such package'):
+        list(bazel_api.iter_cquery(['//a:a']))
+
+  def testStreamBazelInClientDecodesStderr(self):
+    popen = subprocess.Popen
+
+    def fake_popen(args, **kwargs):
+      del args  # Unused.
+      return popen([
+          sys.executable, '-c',
+          'import sys; sys.stderr.buffer.write(b"ERROR: no such package\\xff");'
+          'sys.exit(2)'
+      ], **kwargs)
+
+    bazel_api = BazelApi()
+    with mock.patch.object(subprocess, 'Popen', fake_popen):
+      with self.assertRaisesRegex(RuntimeError, 'no such package'):
+        list(bazel_api.iter_cquery(['//a:a']))
+
 
 if __name__ == '__main__':
   unittest.main()
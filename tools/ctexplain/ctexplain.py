@@ -35,7 +35,12 @@ Relevant terms in https://docs.bazel.build/versions/master/glossary.html:
 
 TODO(gregce): link to proper documentation for full details.
 """
+from concurrent import futures
+import hashlib
+import os
+import sys
 from typing import Callable
+from typing import Dict
 from typing import Tuple
 
 # Do not edit this line. Copybara replaces it with PY2 migration helper.
@@ -43,6 +48,10 @@ from absl import app
 from absl import flags
 from dataclasses import dataclass
 
+from tools.ctexplain.analyses import cloned_targets
+from tools.ctexplain.analyses import culprits
+from tools.ctexplain.analyses import forked_targets
+from tools.ctexplain.analyses import shareability
 # Do not edit this line. Copybara replaces it with PY2 migration helper..third_party.bazel.tools.ctexplain.analyses.summary as summary
 from tools.ctexplain.bazel_api import BazelApi
 # Do not edit this line. Copybara replaces it with PY2 migration helper..third_party.bazel.tools.ctexplain.lib as lib
@@ -70,13 +79,13 @@ available_analyses = [
     ),
     Analysis(
         "culprits",
-        lambda x: print("this analysis not yet implemented"),
+        lambda x: culprits.report(culprits.analyze(x)),
         "shows which flags unnecessarily fork configured targets. These\n"
         + "are conceptually mergeable."
     ),
     Analysis(
         "forked_targets",
-        lambda x: print("this analysis not yet implemented"),
+        lambda x: forked_targets.report(forked_targets.analyze(x)),
         "ranks targets by how many configured targets they\n"
         + "create. These may be legitimate forks (because they behave "
         + "differently with\n different flags) or identical clones that are "
@@ -84,7 +93,7 @@ available_analyses = [
     ),
     Analysis(
         "cloned_targets",
-        lambda x: print("this analysis not yet implemented"),
+        lambda x: cloned_targets.report(cloned_targets.analyze(x)),
         "ranks targets by how many behavior-identical configured\n targets "
         + "they produce. These are conceptually mergeable."
     )
@@ -117,9 +126,17 @@ flags.DEFINE_multi_string(
     "build", [],
     """command-line invocation of the build to analyze. For example:
 "//foo --define a=b". If listed multiple times, this is a "multi-build
-analysis" that measures how much distinct builds can share subgraphs""",
+analysis" that measures how much distinct builds can share subgraphs. Builds
+run concurrently (see --jobs), each with its own output base, which is deleted
+when the analysis is done. --analysis doesn't apply to multi-build analysis""",
     short_name="b")
 
+flags.DEFINE_integer(
+    "jobs", 2,
+    """maximum number of builds of a multi-build analysis to run concurrently.
+Each running build has its own Bazel server""",
+    lower_bound=1)
+
 
 # Core program logic:
 
@@ -139,18 +156,74 @@ def _get_build_flags(cmdline: str) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
   return (tuple(labels), tuple(build_flags))
 
 
+def _config_cache_dir(output_base: str) -> str:
+  """Where to cache configs so repeated runs don't fetch them again."""
+  return os.path.join(output_base, "ctexplain", "configs")
+
+
+def _analyze_builds(cmdlines: Tuple[str, ...],
+                    jobs: int) -> Tuple[Tuple[ConfiguredTarget, ...], ...]:
+  """Gets several build invocations' configured targets concurrently.
+
+  A Bazel server runs one command at a time, so each build gets its own output
+  base (and server) next to the workspace's. Every server holds a whole
+  analysis in memory, so at most jobs builds run at a time, and their output
+  bases are expunged once all builds are done. Configs are cached in the
+  workspace's output base, which the builds share.
+
+  Args:
+    cmdlines: Raw build invocation strings. See _get_build_flags.
+    jobs: Maximum number of builds to run concurrently.
+
+  Returns:
+    The configured targets of each build, in the same order.
+  """
+  output_base = BazelApi().get_output_base()
+  config_cache_dir = _config_cache_dir(output_base)
+  # Maps output base -> BazelApi of the builds that have started.
+  started: Dict[str, BazelApi] = {}
+
+  def analyze(cmdline: str) -> Tuple[ConfiguredTarget, ...]:
+    (labels, build_flags) = _get_build_flags(cmdline)
+    digest = hashlib.sha256(cmdline.encode("utf-8")).hexdigest()[:16]
+    build_output_base = f"{output_base}_ctexplain_{digest}"
+    bazel = BazelApi(
+        config_cache_dir=config_cache_dir,
+        startup_options=(f"--output_base={build_output_base}",))
+    started[build_output_base] = bazel
+    return lib.analyze_build(bazel, labels, build_flags)
+
+  try:
+    with futures.ThreadPoolExecutor(
+        max_workers=min(jobs, len(cmdlines))) as executor:
+      return tuple(executor.map(analyze, cmdlines))
+  finally:
+    for bazel in started.values():
+      try:
+        bazel.expunge()
+      except ValueError as e:
+        print(f"ctexplain: {e}", file=sys.stderr)
+
+
 def main(argv):
   del argv  # Satisfy py linter's "unused" warning.
   if not FLAGS.build:
     exit("ctexplain: build efficiency measurement tool. Add --help "
          + "for usage.")
   elif len(FLAGS.build) > 1:
-    exit("TODO(gregce): support multi-build shareability analysis")
+    with util.ProgressStep(
+        f"Collecting configured targets for {len(FLAGS.build)} builds"):
+      builds = _analyze_builds(tuple(FLAGS.build), FLAGS.jobs)
+    shareability.report(
+        shareability.analyze(dict(zip(FLAGS.build, builds))))
+    return
 
   (labels, build_flags) = _get_build_flags(FLAGS.build[0])
   build_desc = ",".join(labels)
+  bazel = BazelApi()
+  bazel.config_cache_dir = _config_cache_dir(bazel.get_output_base())
   with util.ProgressStep(f"Collecting configured targets for {build_desc}"):
-    cts = lib.analyze_build(BazelApi(), labels, build_flags)
+    cts = lib.analyze_build(bazel, labels, build_flags)
   for analysis in FLAGS.analysis:
     analyses[analysis].exec(cts)
 
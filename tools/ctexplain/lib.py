@@ -36,22 +36,13 @@ def analyze_build(bazel: bazel_api.BazelApi, labels: Tuple[str, ...],
   """
   cquery_args = [f'deps({",".join(labels)})']
   cquery_args.extend(build_flags)
-  (success, stderr, cts) = bazel.cquery(cquery_args)
-  if not success:
-    raise RuntimeError("invocation failed: " + stderr.decode("utf-8"))
-
-  # We have to do separate calls to "bazel config" to get the actual configs
-  # from their hashes.
-  hashes_to_configs = {}
-  cts_with_configs = []
-  for ct in cts:
-    # Don't use dict.setdefault because that unconditionally calls get_config
-    # as one of its parameters and that's an expensive operation to waste.
-    if ct.config_hash not in hashes_to_configs:
-      hashes_to_configs[ct.config_hash] = bazel.get_config(ct.config_hash)
-    config = hashes_to_configs[ct.config_hash]
-    cts_with_configs.append(
-        ConfiguredTarget(ct.label, config, ct.config_hash,
-                         ct.transitive_fragments))
-
-  return tuple(cts_with_configs)
+  cts = list(bazel.iter_cquery(cquery_args))
+
+  # cquery only reports config hashes. Get the actual configs for all of them
+  # at once, then attach them in place so we never hold two copies of the
+  # graph.
+  hashes_to_configs = bazel.get_configs(ct.config_hash for ct in cts)
+  for i, ct in enumerate(cts):
+    cts[i] = ConfiguredTarget(ct.label, hashes_to_configs[ct.config_hash],
+                              ct.config_hash, ct.transitive_fragments)
+  return tuple(cts)
@@ -23,18 +23,174 @@ files.
 
 import argparse
 import errno
+import hashlib
 import multiprocessing
 import os
-import Queue
 import re
 import shutil
 import subprocess
+import sys
 import tempfile
 import threading
 import zipfile
 
-_INCLUDE_RE = re.compile('#(include|import) "([^"]+)"')
+_INCLUDE_RE = re.compile(r'#(include|import) "([^"\n]+)"')
 _CONST_DATE_TIME = [1980, 1, 1, 0, 0, 0]
+# Maximum number of cached include sets. The least recently used ones are
+# evicted beyond that.
+_MAX_CACHED_INCLUDES = 20000
+# Maximum numbers of cached extracted source jars and J2ObjC translations.
+_MAX_CACHED_SRCJARS = 1000
+_MAX_CACHED_TRANSLATIONS = 1000
+# Name of the file listing the Java entries of a cached source jar.
+_SRCJAR_ENTRIES_FILENAME = 'SRCJAR_ENTRIES'
+# J2ObjC flags whose values are output paths.
+_J2OBJC_OUTPUT_FLAGS = frozenset(['-d', '--output-header-mapping'])
+
+
+def _ParallelMap(function, items, jobs=None):
+  """Applies a function to items on several threads.
+
+  Unlike multiprocessing.pool.ThreadPool, this doesn't wait for a handler thread
+  to notice that the pool is done, which takes up to 0.1s in Python 2.
+
+  Args:
+    function: The function to apply to each item.
+    items: The list of items.
+    jobs: The number of threads. Defaults to the number of CPUs.
+  Returns:
+    The list of results, in the order of items.
+  Raises:
+    The first exception raised by function, if any.
+  """
+  results = [None] * len(items)
+  errors = []
+  indexes = iter(xrange(len(items)))
+  lock = threading.Lock()
+
+  def Work():
+    while True:
+      with lock:
+        index = next(indexes, None)
+        if index is None or errors:
+          return
+      try:
+        results[index] = function(items[index])
+      except Exception:  # pylint: disable=broad-except
+        with lock:
+          errors.append(sys.exc_info())
+        return
+
+  threads = [threading.Thread(target=Work)
+             for _ in xrange(min(len(items),
+                                 jobs or multiprocessing.cpu_count()))]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  if errors:
+    raise errors[0][0], errors[0][1], errors[0][2]
+  return results
+
+
+def _TrimCacheRoot(cache_root, max_entries):
+  """Evicts the least recently used entries of a cache directory.
+
+  Entries are the files or directories directly in cache_root, and are used
+  when their modification time is updated.
+
+  Args:
+    cache_root: The cache directory.
+    max_entries: The maximum number of entries to keep.
+  Returns:
+    None.
+  """
+  try:
+    names = os.listdir(cache_root)
+  except OSError:
+    return
+  if len(names) <= max_entries:
+    return
+  entries = []
+  for name in names:
+    path = os.path.join(cache_root, name)
+    try:
+      entries.append((os.lstat(path).st_mtime, path))
+    except OSError:
+      # Another action evicted it already.
+      pass
+  entries.sort()
+  for _, path in entries[:len(entries) - max_entries]:
+    try:
+      if os.path.isdir(path):
+        shutil.rmtree(path)
+      else:
+        os.remove(path)
+    except OSError:
+      pass
+
+
+def _Touch(path):
+  """Marks a cache entry as recently used, see _TrimCacheRoot."""
+  try:
+    os.utime(path, None)
+  except OSError:
+    pass
+
+
+class ContentCache(object):
+  """A content-addressed cache of small values, kept in a directory.
+
+  Values are stored in one file per key, so actions running concurrently can
+  share the cache. The cache is only an optimization: failures to read or write
+  it are ignored.
+  """
+
+  def __init__(self, cache_dir, kind, max_entries):
+    """Creates a cache.
+
+    Args:
+      cache_dir: The cache directory.
+      kind: The name of the subdirectory for this kind of value.
+      max_entries: The maximum number of values to keep, see Trim.
+    """
+    self._dir = os.path.join(cache_dir, kind)
+    self._max_entries = max_entries
+    self._added = False
+
+  def Get(self, key):
+    """Returns the value for a key, or None if it isn't cached."""
+    path = os.path.join(self._dir, key)
+    try:
+      with open(path, 'rb') as f:
+        value = f.read()
+    except (IOError, OSError):
+      return None
+    _Touch(path)
+    return value
+
+  def Put(self, key, value):
+    """Caches a value for a key."""
+    tmp_path = None
+    try:
+      if not os.path.isdir(self._dir):
+        os.makedirs(self._dir)
+      fd, tmp_path = tempfile.mkstemp(dir=self._dir, prefix='.tmp')
+      with os.fdopen(fd, 'wb') as f:
+        f.write(value)
+      # Renaming is atomic, so readers never see partial values.
+      os.rename(tmp_path, os.path.join(self._dir, key))
+      self._added = True
+    except (IOError, OSError):
+      if tmp_path and os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+  def Trim(self):
+    """Evicts the least recently used values beyond the maximum, if any were
+    added."""
+    if self._added:
+      _TrimCacheRoot(self._dir, self._max_entries)
+      self._added = False
 
 
 def RunJ2ObjC(java, jvm_flags, j2objc, main_class, output_file_path,
@@ -80,12 +236,16 @@ def RunJ2ObjC(java, jvm_flags, j2objc, main_class, output_file_path,
 def WriteDepMappingFile(objc_files,
                         objc_file_root,
                         output_dependency_mapping_file,
-                        file_open=open):
+                        file_open=open,
+                        cache_dir=None):
   """Scans J2ObjC-translated files and outputs a dependency mapping file.
 
   The mapping file contains mappings between translated source files and their
   imported source files scanned from the import and include directives.
 
+  With a cache directory, the includes of each translated file are cached by
+  the digest of its contents, so unchanged files aren't scanned again.
+
   Args:
     objc_files: A list of ObjC files translated by J2ObjC.
     objc_file_root: The file path which represents a directory where the
@@ -94,73 +254,97 @@ def WriteDepMappingFile(objc_files,
         write to.
     file_open: Reference to the builtin open function so it may be
         overridden for testing.
+    cache_dir: The persistent directory to cache the includes of translated
+        files in. If None, every file is scanned.
   Raises:
     RuntimeError: If spawned threads throw errors during processing.
   Returns:
     None.
   """
-  dep_mapping = dict()
-  input_file_queue = Queue.Queue()
-  output_dep_mapping_queue = Queue.Queue()
-  error_message_queue = Queue.Queue()
-  for objc_file in objc_files:
-    input_file_queue.put(os.path.join(objc_file_root, objc_file))
-
-  for _ in xrange(multiprocessing.cpu_count()):
-    t = threading.Thread(target=_ReadDepMapping, args=(input_file_queue,
-                                                       output_dep_mapping_queue,
-                                                       error_message_queue,
-                                                       objc_file_root,
-                                                       file_open))
-    t.start()
+  cache = None
+  if cache_dir:
+    cache = ContentCache(cache_dir, 'includes', _MAX_CACHED_INCLUDES)
 
-  input_file_queue.join()
+  def ReadDepMapping(objc_file):
+    try:
+      return _ReadDepMapping(os.path.join(objc_file_root, objc_file),
+                             objc_file_root, cache, file_open)
+    except Exception as e:  # pylint: disable=broad-except
+      return str(e)
 
-  if not error_message_queue.empty():
-    error_messages = [error_message for error_message in
-                      error_message_queue.queue]
-    raise RuntimeError('\n'.join(error_messages))
+  results = _ParallelMap(ReadDepMapping, objc_files)
+  if cache:
+    cache.Trim()
 
-  while not output_dep_mapping_queue.empty():
-    entry_file, deps = output_dep_mapping_queue.get()
-    dep_mapping[entry_file] = deps
+  error_messages = [result for result in results if isinstance(result, str)]
+  if error_messages:
+    raise RuntimeError('\n'.join(error_messages))
 
+  dep_mapping = dict(results)
   with file_open(output_dependency_mapping_file, 'w') as f:
     for entry in sorted(dep_mapping):
       for dep in dep_mapping[entry]:
         f.write(entry + ':' + dep + '\n')
 
 
-def _ReadDepMapping(input_file_queue, output_dep_mapping_queue,
-                    error_message_queue, output_root, file_open=open):
-  while True:
-    try:
-      input_file = input_file_queue.get_nowait()
-    except Queue.Empty:
-      # No more work left in the queue.
-      return
+def _ScanIncludes(content, deps):
+  """Adds the files included by a translated file, without extension, to deps.
+
+  Include directives start a line. The regular expression isn't anchored with
+  ^ in MULTILINE mode, because then it can't skip ahead to the next '#', and
+  is slower than matching each line.
+
+  Args:
+    content: The contents of the translated file.
+    deps: The set to add the included files to.
+  Returns:
+    None.
+  """
+  for include in _INCLUDE_RE.finditer(content):
+    start = include.start()
+    if start == 0 or content[start - 1] == '\n':
+      deps.add(os.path.splitext(include.group(2))[0])
 
-    try:
-      deps = set()
-      input_file_name = os.path.splitext(input_file)[0]
-      entry = os.path.relpath(input_file_name, output_root)
-      for file_ext in ['.m', '.h']:
-        with file_open(input_file_name + file_ext, 'r') as f:
-          for line in f:
-            include = _INCLUDE_RE.match(line)
-            if include:
-              include_path = include.group(2)
-              dep = os.path.splitext(include_path)[0]
-              if dep != entry:
-                deps.add(dep)
-
-      output_dep_mapping_queue.put((entry, sorted(deps)))
-    except Exception as e:  # pylint: disable=broad-except
-      error_message_queue.put(str(e))
-    finally:
-      # We need to mark the task done to prevent blocking the main process
-      # indefinitely.
-      input_file_queue.task_done()
+
+def _ReadDepMapping(input_file, output_root, cache, file_open=open):
+  """Returns (entry, sorted deps) for a translated file.
+
+  Args:
+    input_file: The translated .m file, next to its .h file.
+    output_root: The directory the entry is relative to.
+    cache: The ContentCache of includes. May be None.
+    file_open: Reference to the builtin open function so it may be
+        overridden for testing.
+  Returns:
+    A tuple of the entry and its sorted deps.
+  """
+  input_file_name = os.path.splitext(input_file)[0]
+  entry = os.path.relpath(input_file_name, output_root)
+  contents = []
+  for file_ext in ['.m', '.h']:
+    with file_open(input_file_name + file_ext, 'rb') as f:
+      contents.append(f.read())
+
+  deps = set()
+  if cache is None:
+    for content in contents:
+      _ScanIncludes(content, deps)
+  else:
+    digest = hashlib.sha256()
+    for content in contents:
+      digest.update('%d:' % len(content))
+      digest.update(content)
+    key = digest.hexdigest()
+    includes = cache.Get(key)
+    if includes is None:
+      for content in contents:
+        _ScanIncludes(content, deps)
+      cache.Put(key, '\n'.join(sorted(deps)))
+    else:
+      deps.update(dep for dep in includes.split('\n') if dep)
+
+  deps.discard(entry)
+  return (entry, sorted(deps))
 
 
 def WriteArchiveSourceMappingFile(compiled_archive_file_path,
@@ -217,110 +401,361 @@ def _J2ObjcOutputObjcFiles(java_files):
   return [os.path.splitext(java_file)[0] + '.m' for java_file in java_files]
 
 
-def UnzipSourceJarSources(source_jars):
+def _FileDigest(path):
+  """Returns the SHA-256 digest of a file."""
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    while True:
+      data = f.read(65536)
+      if not data:
+        break
+      digest.update(data)
+  return digest.hexdigest()
+
+
+def _PathDigest(path):
+  """Returns the SHA-256 digest of a file, or of a directory's tree."""
+  if not os.path.isdir(path):
+    return _FileDigest(path)
+  digest = hashlib.sha256()
+  for dirpath, dirnames, filenames in os.walk(path):
+    dirnames.sort()
+    for filename in sorted(filenames):
+      file_path = os.path.join(dirpath, filename)
+      digest.update('%s:%s\n' % (os.path.relpath(file_path, path),
+                                 _FileDigest(file_path)))
+  return digest.hexdigest()
+
+
+def _WritableCacheRoot(cache_dir, kind):
+  """Returns the directory for a kind of cached directories, or None.
+
+  Args:
+    cache_dir: The cache directory. May be None.
+    kind: The name of the subdirectory for this kind of cached directories.
+  Returns:
+    The directory, or None if cache_dir is None or the directory can't be
+    written to, e.g. because the action is sandboxed.
+  """
+  if not cache_dir:
+    return None
+  cache_root = os.path.join(cache_dir, kind)
+  try:
+    if not os.path.isdir(cache_root):
+      os.makedirs(cache_root)
+  except OSError:
+    return None
+  return cache_root if os.access(cache_root, os.W_OK) else None
+
+
+def _CommitCachedDir(tmp_dir, cached_dir):
+  """Atomically moves a fully written directory to its place in a cache."""
+  try:
+    os.rename(tmp_dir, cached_dir)
+  except OSError:
+    # Another action cached the same content first.
+    shutil.rmtree(tmp_dir, True)
+    if not os.path.isdir(cached_dir):
+      raise
+
+
+def _LinkOrCopy(src, dest):
+  """Hard links src to dest, or copies it if it can't be linked."""
+  if os.path.lexists(dest):
+    os.remove(dest)
+  try:
+    os.link(src, dest)
+  except OSError:
+    shutil.copyfile(src, dest)
+
+
+def _UnzipSourceJar(source_jar, tmp_input_root):
+  """Extracts the Java sources of a source jar and returns their entries."""
+  zip_ref = zipfile.ZipFile(source_jar, 'r')
+  try:
+    # We only care about Java source files.
+    zip_entries = [
+        file_entry for file_entry in zip_ref.namelist()
+        if file_entry.endswith('.java')
+    ]
+    zip_ref.extractall(tmp_input_root, zip_entries)
+  finally:
+    zip_ref.close()
+  return zip_entries
+
+
+def _ExtractSourceJar(source_jar, cache_root):
+  """Extracts the Java sources of a source jar into a cache, unless cached.
+
+  Args:
+    source_jar: The source jar.
+    cache_root: The directory containing extracted jars, named by digest.
+  Returns:
+    A tuple of the directory containing the extracted sources and the list of
+    the jar's Java source entries.
+  """
+  jar_dir = os.path.join(cache_root, _FileDigest(source_jar))
+  entries_file = os.path.join(jar_dir, _SRCJAR_ENTRIES_FILENAME)
+  if os.path.isdir(jar_dir):
+    with open(entries_file, 'r') as f:
+      entries = f.read().splitlines()
+    _Touch(jar_dir)
+    return (jar_dir, entries)
+
+  tmp_dir = tempfile.mkdtemp(dir=cache_root)
+  zip_entries = _UnzipSourceJar(source_jar, tmp_dir)
+  with open(os.path.join(tmp_dir, _SRCJAR_ENTRIES_FILENAME), 'w') as f:
+    f.write(''.join(entry + '\n' for entry in zip_entries))
+  _CommitCachedDir(tmp_dir, jar_dir)
+  return (jar_dir, zip_entries)
+
+
+def UnzipSourceJarSources(source_jars, cache_dir=None):
   """Unzips the source jars containing Java source files.
 
+  With a persistent cache directory, the Java sources of each jar are extracted
+  in parallel into a cache keyed by the digest of the jar, unless they are
+  already there, and then linked into the temporary output root.
+
   Args:
     source_jars: The list of input Java source jars.
+    cache_dir: The persistent directory to cache extracted jars in. May be
+        None.
   Returns:
     A tuple of the temporary output root and a list of root-relative paths of
     unzipped Java files
   """
+  if not source_jars:
+    return None
+
+  tmp_input_root = tempfile.mkdtemp()
+  cache_root = _WritableCacheRoot(cache_dir, 'srcjars')
   srcjar_java_files = []
-  if source_jars:
-    tmp_input_root = tempfile.mkdtemp()
+  if not cache_root:
     for source_jar in source_jars:
-      zip_ref = zipfile.ZipFile(source_jar, 'r')
-      zip_entries = []
-
-      for file_entry in zip_ref.namelist():
-        # We only care about Java source files.
-        if file_entry.endswith('.java'):
-          zip_entries.append(file_entry)
+      srcjar_java_files.extend(_UnzipSourceJar(source_jar, tmp_input_root))
+    return (tmp_input_root, srcjar_java_files)
 
-      zip_ref.extractall(tmp_input_root, zip_entries)
-      zip_ref.close()
-      srcjar_java_files.extend(zip_entries)
+  extracted_jars = _ParallelMap(
+      lambda source_jar: _ExtractSourceJar(source_jar, cache_root),
+      source_jars)
+
+  # Link the sources in the order of the jars, so that later jars win, as if
+  # they had been extracted on top of each other.
+  for jar_dir, zip_entries in extracted_jars:
+    for dirpath, _, filenames in os.walk(jar_dir):
+      rel_dir = os.path.relpath(dirpath, jar_dir)
+      dest_dir = os.path.normpath(os.path.join(tmp_input_root, rel_dir))
+      if not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir)
+      for filename in filenames:
+        if dirpath == jar_dir and filename == _SRCJAR_ENTRIES_FILENAME:
+          continue
+        _LinkOrCopy(os.path.join(dirpath, filename),
+                    os.path.join(dest_dir, filename))
+    srcjar_java_files.extend(zip_entries)
+  _TrimCacheRoot(cache_root, _MAX_CACHED_SRCJARS)
+
+  return (tmp_input_root, srcjar_java_files)
+
+
+def _TranslationKey(java, jvm_flags, j2objc, main_class, j2objc_flags,
+                    source_paths, files_to_translate):
+  """Returns the digest of everything that determines a J2ObjC translation.
 
-    return (tmp_input_root, srcjar_java_files)
-  else:
+  Args:
+    java: The path of the Java executable.
+    jvm_flags: A comma-separated list of flags to pass to JVM.
+    j2objc: The deploy jar of J2ObjC.
+    main_class: The J2ObjC main class to invoke.
+    j2objc_flags: A list of flags to pass to J2ObjC transpiler.
+    source_paths: A list of directories that contain sources to translate.
+    files_to_translate: A list of relative paths (relative to source_paths) that
+        point to sources to translate.
+  Returns:
+    The digest.
+  """
+  digest = hashlib.sha256()
+
+  def Add(value):
+    digest.update('%d:%s' % (len(value), value))
+
+  execroot = os.getcwd()
+  for value in [execroot, java, jvm_flags, _FileDigest(j2objc), main_class]:
+    Add(value)
+  is_output = False
+  for flag in j2objc_flags:
+    if is_output:
+      # Where outputs are written doesn't matter.
+      Add('<output>')
+    else:
+      Add(flag)
+      # Flag values may name input files or directories, such as -classpath
+      # jars, -sourcepath directories and the --system module, whose contents
+      # matter as well.
+      for path in re.split('[:,=]', flag):
+        if (path and os.path.exists(path) and
+            os.path.abspath(path) != execroot):
+          Add(_PathDigest(path))
+    is_output = flag in _J2OBJC_OUTPUT_FLAGS
+  # The execroot is a source path as well, but is too large to digest. The
+  # sources of the action in it are the files to translate. Source paths other
+  # than the execroot are temporary, so only their contents count.
+  for file_to_translate in files_to_translate:
+    Add(file_to_translate)
+    for source_path in source_paths:
+      path = os.path.join(source_path, file_to_translate)
+      if os.path.isfile(path):
+        Add(_FileDigest(path))
+        break
+  return digest.hexdigest()
+
+
+def _HeaderMappingFile(j2objc_flags):
+  """Returns the header mapping file J2ObjC writes, or None."""
+  if '--output-header-mapping' not in j2objc_flags:
     return None
+  index = j2objc_flags.index('--output-header-mapping') + 1
+  if index >= len(j2objc_flags) or j2objc_flags[index] == os.devnull:
+    return None
+  return j2objc_flags[index]
 
 
-def RenameGenJarObjcFileRootInFileContent(tmp_objc_file_root,
-                                          j2objc_source_paths,
-                                          gen_src_jar, genjar_objc_files,
-                                          execute=subprocess.check_call):
-  """Renames references to temporary root inside ObjC sources from gen srcjar.
+def RestoreCachedTranslation(cache_dir, key, output_file_path,
+                             header_mapping_file):
+  """Restores the outputs of a cached J2ObjC translation.
 
   Args:
-    tmp_objc_file_root: The temporary output root containing ObjC sources.
-    j2objc_source_paths: The source paths used by J2ObjC.
-    gen_src_jar: The path of the gen srcjar.
-    genjar_objc_files: The list of ObjC sources translated from the gen srcjar.
-    execute: The function used to execute shell commands.
+    cache_dir: The cache directory. May be None.
+    key: The translation key, see _TranslationKey.
+    output_file_path: The output file directory, which must be empty.
+    header_mapping_file: Where J2ObjC writes the header mapping. May be None.
   Returns:
-    None.
+    The temporary root that contained the unzipped source jars during the
+    cached translation, which translated files may refer to, or None if the
+    translation isn't cached.
   """
-  if genjar_objc_files:
-    abs_genjar_objc_source_files = [
-        os.path.join(tmp_objc_file_root, genjar_objc_file)
-        for genjar_objc_file in genjar_objc_files
-    ]
-    abs_genjar_objc_header_files = [
-        os.path.join(tmp_objc_file_root,
-                     os.path.splitext(genjar_objc_file)[0] + '.h')
-        for genjar_objc_file in genjar_objc_files
-    ]
+  if not cache_dir:
+    return None
+  cached_dir = os.path.join(cache_dir, 'translations', key)
+  try:
+    with open(os.path.join(cached_dir, 'source_root'), 'r') as f:
+      source_root = f.read()
+  except (IOError, OSError):
+    return None
+  _Touch(cached_dir)
 
-    # We execute a command to change all references of the temporary Java root
-    # where we unzipped the gen srcjar sources, to the actual gen srcjar that
-    # contains the original Java sources.
-    cmd = [
-        'sed',
-        '-i',
-        '-e',
-        's|%s/|%s::|g' % (j2objc_source_paths[1], gen_src_jar)
-    ]
-    cmd.extend(abs_genjar_objc_source_files)
-    cmd.extend(abs_genjar_objc_header_files)
-    execute(cmd, stderr=subprocess.STDOUT)
+  os.rmdir(output_file_path)
+  try:
+    shutil.copytree(os.path.join(cached_dir, 'objc'), output_file_path)
+    if header_mapping_file:
+      shutil.copyfile(os.path.join(cached_dir, 'header_mapping'),
+                      header_mapping_file)
+  except (IOError, OSError, shutil.Error):
+    # Run J2ObjC after all.
+    shutil.rmtree(output_file_path, True)
+    os.mkdir(output_file_path)
+    return None
+  return source_root
 
 
-def MoveObjcFileToFinalOutputRoot(objc_files,
-                                  tmp_objc_file_root,
-                                  final_objc_file_root,
-                                  suffix,
-                                  os_module=os,
-                                  shutil_module=shutil):
-  """Moves ObjC files from temporary location to the final output location.
+def CacheTranslation(cache_dir, key, output_file_path, header_mapping_file,
+                     source_root):
+  """Caches the outputs of a J2ObjC translation.
+
+  Args:
+    cache_dir: The cache directory. May be None.
+    key: The translation key, see _TranslationKey.
+    output_file_path: The output file directory.
+    header_mapping_file: Where J2ObjC wrote the header mapping. May be None.
+    source_root: The temporary root containing the unzipped source jars. May
+        be None.
+  Returns:
+    None.
+  """
+  cache_root = _WritableCacheRoot(cache_dir, 'translations')
+  if not cache_root or os.path.isdir(os.path.join(cache_root, key)):
+    return
+  tmp_dir = tempfile.mkdtemp(dir=cache_root)
+  try:
+    shutil.copytree(output_file_path, os.path.join(tmp_dir, 'objc'))
+    if header_mapping_file:
+      shutil.copyfile(header_mapping_file,
+                      os.path.join(tmp_dir, 'header_mapping'))
+    with open(os.path.join(tmp_dir, 'source_root'), 'w') as f:
+      f.write(source_root or '')
+    _CommitCachedDir(tmp_dir, os.path.join(cache_root, key))
+  except (IOError, OSError, shutil.Error):
+    shutil.rmtree(tmp_dir, True)
+    return
+  _TrimCacheRoot(cache_root, _MAX_CACHED_TRANSLATIONS)
+
+
+def _ObjcFileMoves(objc_files, tmp_objc_file_root, final_objc_file_root,
+                   suffixes, rename_genjar_root):
+  """Returns the moves of ObjC files to a final output root.
 
   Args:
     objc_files: The list of objc files to move.
     tmp_objc_file_root: The temporary output root containing ObjC sources.
     final_objc_file_root: The final output root.
-    suffix: The suffix of the files to move.
-    os_module: The os python module.
-    shutil_module: The shutil python module.
+    suffixes: The suffixes of the files to move.
+    rename_genjar_root: Whether to rename references to the temporary root of
+        gen srcjar sources in the moved files.
   Returns:
-    None.
+    A list of (source path, destination path, rename_genjar_root).
   """
+  moves = []
   for objc_file in objc_files:
-    file_with_suffix = os_module.path.splitext(objc_file)[0] + suffix
-    dest_path = os_module.path.join(
-        final_objc_file_root, file_with_suffix)
-    dest_path_dir = os_module.path.dirname(dest_path)
+    for suffix in suffixes:
+      file_with_suffix = os.path.splitext(objc_file)[0] + suffix
+      moves.append((os.path.join(tmp_objc_file_root, file_with_suffix),
+                    os.path.join(final_objc_file_root, file_with_suffix),
+                    rename_genjar_root))
+  return moves
 
-    if not os_module.path.isdir(dest_path_dir):
+
+def MoveObjcFilesToFinalOutputRoots(moves, genjar_root, gen_src_jar):
+  """Moves ObjC files from temporary locations to their final locations.
+
+  Files are moved in parallel, and destination directories are created up
+  front. References to the temporary root where the gen srcjar was unzipped
+  are renamed to the gen srcjar, which contains the original Java sources, in
+  files that ask for it. Only files that contain such references are
+  rewritten, the others are just moved.
+
+  Args:
+    moves: A list of (source path, destination path, rename_genjar_root).
+    genjar_root: The temporary root containing sources unzipped from the gen
+        srcjar.
+    gen_src_jar: The path of the gen srcjar.
+  Returns:
+    None.
+  """
+  for dest_dir in sorted(set(os.path.dirname(dest) for _, dest, _ in moves)):
+    if not os.path.isdir(dest_dir):
       try:
-        os_module.makedirs(dest_path_dir)
+        os.makedirs(dest_dir)
       except OSError as e:
-        if e.errno != errno.EEXIST or not os_module.path.isdir(dest_path_dir):
+        if e.errno != errno.EEXIST or not os.path.isdir(dest_dir):
           raise
 
-    shutil_module.move(
-        os_module.path.join(tmp_objc_file_root, file_with_suffix),
-        dest_path)
+  old_root = '%s/' % genjar_root
+  new_root = '%s::' % gen_src_jar
+
+  def MoveObjcFile(move):
+    src, dest, rename_genjar_root = move
+    if rename_genjar_root:
+      with open(src, 'rb') as f:
+        content = f.read()
+      if old_root in content:
+        with open(dest, 'wb') as f:
+          f.write(content.replace(old_root, new_root))
+        os.remove(src)
+        return
+    shutil.move(src, dest)
+
+  _ParallelMap(MoveObjcFile, moves)
 
 
 def PostJ2ObjcFileProcessing(normal_objc_files, genjar_objc_files,
@@ -343,32 +778,17 @@ def PostJ2ObjcFileProcessing(normal_objc_files, genjar_objc_files,
   Returns:
     None.
   """
-  RenameGenJarObjcFileRootInFileContent(tmp_objc_file_root,
-                                        j2objc_source_paths,
-                                        gen_src_jar,
-                                        genjar_objc_files)
-  MoveObjcFileToFinalOutputRoot(normal_objc_files,
-                                tmp_objc_file_root,
-                                final_objc_file_root,
-                                '.m')
-  MoveObjcFileToFinalOutputRoot(normal_objc_files,
-                                tmp_objc_file_root,
-                                final_objc_file_root,
-                                '.h')
-
+  moves = _ObjcFileMoves(normal_objc_files, tmp_objc_file_root,
+                         final_objc_file_root, ['.m', '.h'], False)
   if output_gen_source_dir:
-    MoveObjcFileToFinalOutputRoot(
-        genjar_objc_files,
-        tmp_objc_file_root,
-        output_gen_source_dir,
-        '.m')
-
+    moves.extend(_ObjcFileMoves(genjar_objc_files, tmp_objc_file_root,
+                                output_gen_source_dir, ['.m'], True))
   if output_gen_header_dir:
-    MoveObjcFileToFinalOutputRoot(
-        genjar_objc_files,
-        tmp_objc_file_root,
-        output_gen_header_dir,
-        '.h')
+    moves.extend(_ObjcFileMoves(genjar_objc_files, tmp_objc_file_root,
+                                output_gen_header_dir, ['.h'], True))
+
+  genjar_root = j2objc_source_paths[1] if genjar_objc_files else None
+  MoveObjcFilesToFinalOutputRoots(moves, genjar_root, gen_src_jar)
 
 
 def GenerateJ2objcMappingFiles(normal_objc_files,
@@ -376,7 +796,8 @@ def GenerateJ2objcMappingFiles(normal_objc_files,
                                tmp_objc_file_root,
                                output_dependency_mapping_file,
                                output_archive_source_mapping_file,
-                               compiled_archive_file_path):
+                               compiled_archive_file_path,
+                               cache_dir=None):
   """Generates J2ObjC mapping files.
 
   Args:
@@ -387,12 +808,15 @@ def GenerateJ2objcMappingFiles(normal_objc_files,
         write to.
     output_archive_source_mapping_file: A path of the mapping file to write to.
     compiled_archive_file_path: The path of the archive file.
+    cache_dir: The persistent directory to cache intermediate results in. May
+        be None.
   Returns:
     None.
   """
   WriteDepMappingFile(normal_objc_files + genjar_objc_files,
                       tmp_objc_file_root,
-                      output_dependency_mapping_file)
+                      output_dependency_mapping_file,
+                      cache_dir=cache_dir)
 
   if output_archive_source_mapping_file:
     WriteArchiveSourceMappingFile(compiled_archive_file_path,
@@ -463,6 +887,22 @@ def main():
       required=False,
       help='The output directory of ObjC header files translated from the gen'
            ' srcjar')
+  parser.add_argument(
+      '--cache_dir',
+      required=False,
+      help='A persistent directory to cache intermediate results in, across '
+           'actions. It must be writable by the action, i.e. outside of any '
+           'sandbox. Nothing is cached by default.')
+  parser.add_argument(
+      '--cache_translations',
+      action='store_true',
+      help='Whether to cache the outputs of J2ObjC in --cache_dir, and skip '
+           'running J2ObjC when the same sources were translated with the same '
+           'flags before. The cache key includes the working directory, so '
+           'actions in per-action sandbox execroots never hit the cache. Other '
+           '.java files that J2ObjC can read through the execroot in its '
+           '-sourcepath are not part of the key, so this is only sound for '
+           'unsandboxed actions that declare all of their inputs.')
 
   args, pass_through_args = parser.parse_known_args()
   normal_java_files, j2objc_flags = _ParseArgs(pass_through_args)
@@ -478,7 +918,7 @@ def main():
   if args.src_jars:
     source_jars.extend(args.src_jars.split(','))
 
-  srcjar_source_tuple = UnzipSourceJarSources(source_jars)
+  srcjar_source_tuple = UnzipSourceJarSources(source_jars, args.cache_dir)
   if srcjar_source_tuple:
     j2objc_source_paths.append(srcjar_source_tuple[0])
     srcjar_java_files = srcjar_source_tuple[1]
@@ -494,14 +934,36 @@ def main():
   if '--output-header-mapping' not in j2objc_flags:
     j2objc_flags.extend(['--output-header-mapping', '/dev/null'])
 
-  RunJ2ObjC(args.java,
-            args.jvm_flags,
-            args.j2objc,
-            args.main_class,
-            tmp_objc_file_root,
-            j2objc_flags,
-            j2objc_source_paths,
-            normal_java_files + srcjar_java_files)
+  translation_key = None
+  cached_source_root = None
+  header_mapping_file = _HeaderMappingFile(j2objc_flags)
+  if args.cache_translations and args.cache_dir:
+    translation_key = _TranslationKey(args.java, args.jvm_flags, args.j2objc,
+                                      args.main_class, j2objc_flags,
+                                      j2objc_source_paths,
+                                      normal_java_files + srcjar_java_files)
+    cached_source_root = RestoreCachedTranslation(
+        args.cache_dir, translation_key, tmp_objc_file_root,
+        header_mapping_file)
+
+  if cached_source_root is not None:
+    # Translated files refer to the root the source jars were unzipped to
+    # when they were cached.
+    if srcjar_source_tuple:
+      j2objc_source_paths[1] = cached_source_root
+  else:
+    RunJ2ObjC(args.java,
+              args.jvm_flags,
+              args.j2objc,
+              args.main_class,
+              tmp_objc_file_root,
+              list(j2objc_flags),
+              j2objc_source_paths,
+              normal_java_files + srcjar_java_files)
+    if translation_key:
+      CacheTranslation(args.cache_dir, translation_key, tmp_objc_file_root,
+                       header_mapping_file,
+                       srcjar_source_tuple[0] if srcjar_source_tuple else None)
 
   # Calculate the relative paths of generated objc files.
   normal_objc_files = _J2ObjcOutputObjcFiles(normal_java_files)
@@ -513,7 +975,8 @@ def main():
                              tmp_objc_file_root,
                              args.output_dependency_mapping_file,
                              args.output_archive_source_mapping_file,
-                             args.compiled_archive_file_path)
+                             args.compiled_archive_file_path,
+                             args.cache_dir)
 
   # Post J2ObjC-run processing, involving file editing, zipping and moving
   # files to their final output locations.
@@ -0,0 +1,347 @@
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for j2objc_wrapper."""
+
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+import zipfile
+
+from third_party.py import mock
+from tools.j2objc import j2objc_wrapper
+
+# A fake J2ObjC, run as "java", which translates each Java file to a .m and
+# a .h file that mention where the Java file was found, and logs its runs.
+FAKE_JAVA = """#!%s
+import os
+import sys
+
+with open(sys.argv[-1][1:]) as f:
+  args = f.read().split(' ')
+with open(os.environ['FAKE_JAVA_LOG'], 'a') as f:
+  f.write('run\\n')
+out = args[args.index('-d') + 1]
+# The wrapper appends its source paths last.
+source_paths = args[len(args) - args[::-1].index('-sourcepath')].split(':')
+header_mapping = args[args.index('--output-header-mapping') + 1]
+sources = [arg for arg in args if arg.endswith('.java')]
+for source in sources:
+  source_path = [path for path in source_paths
+                 if os.path.exists(os.path.join(path, source))][-1]
+  base = os.path.join(out, source[:-len('.java')])
+  if not os.path.isdir(os.path.dirname(base)):
+    os.makedirs(os.path.dirname(base))
+  for ext in ['.m', '.h']:
+    with open(base + ext, 'w') as f:
+      f.write('// %%s/%%s\\n' %% (source_path, source))
+with open(header_mapping, 'w') as f:
+  f.write(''.join('%%s=%%s.h\\n' %% (source, source[:-len('.java')])
+                  for source in sources))
+""" % sys.executable
+
+
+class J2ObjcWrapperTestCase(unittest.TestCase):
+
+  def setUp(self):
+    super(J2ObjcWrapperTestCase, self).setUp()
+    self._dir = tempfile.mkdtemp(dir=os.environ.get('TEST_TMPDIR'))
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+    super(J2ObjcWrapperTestCase, self).tearDown()
+
+  def _Path(self, *parts):
+    return os.path.join(self._dir, *parts)
+
+  def _WriteFile(self, path, content):
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+      f.write(content)
+    return path
+
+  def _ReadFile(self, path):
+    with open(path, 'rb') as f:
+      return f.read()
+
+
+class WriteDepMappingFileTest(J2ObjcWrapperTestCase):
+
+  def setUp(self):
+    super(WriteDepMappingFileTest, self).setUp()
+    self._root = self._Path('objc')
+    self._WriteFile(os.path.join(self._root, 'a/A.m'),
+                    '#include "a/A.h"\n'
+                    '#include "J2ObjC_source.h"\n'
+                    '#import "b/B.h"\n'
+                    '  #import "indented.h"\n'
+                    '// #import "comment.h"\n'
+                    'x = 1; #import "not_a_directive.h"\n'
+                    '#pragma mark - #import "pragma.h"\n'
+                    '#import "unterminated.h\n'
+                    '#import "c/C.h"')
+    self._WriteFile(os.path.join(self._root, 'a/A.h'),
+                    '#include "J2ObjC_header.h"\n#import "b/B.h"\n')
+    self._WriteFile(os.path.join(self._root, 'b/B.m'), '#include "b/B.h"\n')
+    self._WriteFile(os.path.join(self._root, 'b/B.h'), '')
+
+  def _WriteDepMappingFile(self, name, cache_dir=None):
+    mapping_file = self._Path(name)
+    j2objc_wrapper.WriteDepMappingFile(['b/B.m', 'a/A.m'], self._root,
+                                       mapping_file, cache_dir=cache_dir)
+    return self._ReadFile(mapping_file)
+
+  def testMappingFile(self):
+    self.assertEqual('a/A:J2ObjC_header\n'
+                     'a/A:J2ObjC_source\n'
+                     'a/A:b/B\n'
+                     'a/A:c/C\n',
+                     self._WriteDepMappingFile('mapping'))
+
+  def testCacheDoesNotChangeMappingFile(self):
+    cache_dir = self._Path('cache')
+    uncached = self._WriteDepMappingFile('uncached')
+    cold = self._WriteDepMappingFile('cold', cache_dir)
+    self.assertEqual(2, len(os.listdir(os.path.join(cache_dir, 'includes'))))
+    warm = self._WriteDepMappingFile('warm', cache_dir)
+    self.assertEqual(uncached, cold)
+    self.assertEqual(uncached, warm)
+
+  def testChangedFileIsScannedAgain(self):
+    cache_dir = self._Path('cache')
+    self._WriteDepMappingFile('cold', cache_dir)
+    self._WriteFile(os.path.join(self._root, 'b/B.h'), '#import "d/D.h"\n')
+    self.assertEqual('a/A:J2ObjC_header\n'
+                     'a/A:J2ObjC_source\n'
+                     'a/A:b/B\n'
+                     'a/A:c/C\n'
+                     'b/B:d/D\n',
+                     self._WriteDepMappingFile('warm', cache_dir))
+
+
+class PostJ2ObjcFileProcessingTest(J2ObjcWrapperTestCase):
+
+  def setUp(self):
+    super(PostJ2ObjcFileProcessingTest, self).setUp()
+    self._tmp_root = self._Path('tmp_objc')
+    self._genjar_root = self._Path('tmp_srcjar')
+    self._gen_src_jar = 'pkg/gen.srcjar'
+    # A normal file that mentions the gen srcjar root isn't rewritten.
+    self._files = {
+        'com/google/deep/A.m': '// %s/com/google/deep/A.java\n\0\xff' %
+                               self._genjar_root,
+        'com/google/deep/A.h': '#import "J2ObjC_header.h"\n',
+        'g/G.m': '// %s/g/G.java\n// %s/g/Other.java\n' % (
+            self._genjar_root, self._genjar_root),
+        'g/G.h': '// line %s/g/G.java:1\n' % self._genjar_root,
+        'g/nested/H.m': '// %s-sibling/g/H.java\n\0\xff' % self._genjar_root,
+        'g/nested/H.h': '',
+    }
+    for name, content in self._files.items():
+      self._WriteFile(os.path.join(self._tmp_root, name), content)
+
+  def _PostProcess(self, output_gen_source_dir, output_gen_header_dir):
+    j2objc_wrapper.PostJ2ObjcFileProcessing(
+        ['com/google/deep/A.m'], ['g/G.m', 'g/nested/H.m'], self._tmp_root,
+        self._Path('objc'), [os.getcwd(), self._genjar_root],
+        self._gen_src_jar, output_gen_source_dir, output_gen_header_dir)
+
+  def testMovesAndRenamesFiles(self):
+    self._PostProcess(self._Path('gen_srcs'), self._Path('gen_hdrs'))
+
+    for name in ['com/google/deep/A.m', 'com/google/deep/A.h']:
+      self.assertEqual(self._files[name],
+                       self._ReadFile(self._Path('objc', name)))
+    self.assertEqual('// pkg/gen.srcjar::g/G.java\n'
+                     '// pkg/gen.srcjar::g/Other.java\n',
+                     self._ReadFile(self._Path('gen_srcs', 'g/G.m')))
+    self.assertEqual('// line pkg/gen.srcjar::g/G.java:1\n',
+                     self._ReadFile(self._Path('gen_hdrs', 'g/G.h')))
+    self.assertEqual(self._files['g/nested/H.m'],
+                     self._ReadFile(self._Path('gen_srcs', 'g/nested/H.m')))
+    self.assertEqual(self._files['g/nested/H.h'],
+                     self._ReadFile(self._Path('gen_hdrs', 'g/nested/H.h')))
+    for name in self._files:
+      self.assertFalse(os.path.exists(os.path.join(self._tmp_root, name)))
+
+  def testGenFilesAreOnlyMovedToGivenDirs(self):
+    self._PostProcess(None, self._Path('gen_hdrs'))
+
+    self.assertEqual(['G.h', 'nested'],
+                     sorted(os.listdir(self._Path('gen_hdrs', 'g'))))
+    self.assertFalse(os.path.exists(self._Path('objc', 'g')))
+    for name in ['g/G.m', 'g/nested/H.m']:
+      self.assertTrue(os.path.exists(os.path.join(self._tmp_root, name)))
+
+  def testWithoutGenFiles(self):
+    j2objc_wrapper.PostJ2ObjcFileProcessing(
+        ['com/google/deep/A.m'], [], self._tmp_root, self._Path('objc'),
+        [os.getcwd()], None, self._Path('gen_srcs'), self._Path('gen_hdrs'))
+    self.assertEqual(['A.h', 'A.m'], sorted(os.listdir(
+        self._Path('objc', 'com/google/deep'))))
+
+
+
+def _WriteJar(path, entries):
+  with zipfile.ZipFile(path, 'w') as jar:
+    for name, content in entries:
+      jar.writestr(name, content)
+  return path
+
+
+class UnzipSourceJarSourcesTest(J2ObjcWrapperTestCase):
+
+  def _Unzip(self, source_jars, cache_dir):
+    root, java_files = j2objc_wrapper.UnzipSourceJarSources(source_jars,
+                                                           cache_dir)
+    contents = {}
+    for java_file in java_files:
+      contents[java_file] = self._ReadFile(os.path.join(root, java_file))
+    return java_files, contents
+
+  def testLaterJarsWin(self):
+    first = _WriteJar(self._Path('first.srcjar'),
+                      [('a/A.java', 'first A'), ('a/B.java', 'first B'),
+                       ('META-INF/MANIFEST.MF', '')])
+    second = _WriteJar(self._Path('second.srcjar'), [('a/A.java', 'second A')])
+    for cache_dir in [None, self._Path('cache'), self._Path('cache')]:
+      java_files, contents = self._Unzip([first, second], cache_dir)
+      self.assertEqual(['a/A.java', 'a/B.java', 'a/A.java'], java_files)
+      self.assertEqual({'a/A.java': 'second A', 'a/B.java': 'first B'},
+                       contents)
+      java_files, contents = self._Unzip([second, first], cache_dir)
+      self.assertEqual({'a/A.java': 'first A', 'a/B.java': 'first B'},
+                       contents)
+    self.assertEqual(2, len(os.listdir(self._Path('cache', 'srcjars'))))
+
+  def testNoSourceJars(self):
+    self.assertIsNone(j2objc_wrapper.UnzipSourceJarSources([], None))
+
+
+class TranslationCacheTest(J2ObjcWrapperTestCase):
+
+  def setUp(self):
+    super(TranslationCacheTest, self).setUp()
+    self._cwd = os.getcwd()
+    os.makedirs(self._Path('execroot'))
+    os.chdir(self._Path('execroot'))
+    self._WriteFile('j2objc.jar', 'j2objc')
+    self._WriteFile('a/A.java', 'class A {}')
+    self._WriteFile('cp.jar', 'classpath')
+    self._WriteFile('sp/x/S.java', 'class S {}')
+    self._WriteFile('system/release', 'release')
+    self._WriteFile('boot.jar', 'boot')
+
+  def tearDown(self):
+    os.chdir(self._cwd)
+    super(TranslationCacheTest, self).tearDown()
+
+  def _WriteFile(self, path, content):
+    return super(TranslationCacheTest, self)._WriteFile(
+        os.path.abspath(path), content)
+
+  def _Key(self, out='out', header_mapping='header.mapping'):
+    flags = ['-classpath', 'cp.jar', '-sourcepath', 'sp', '--system', 'system',
+             '-Xbootclasspath:boot.jar', '-d', out, '--output-header-mapping',
+             header_mapping]
+    return j2objc_wrapper._TranslationKey(
+        'java', '-Xss4m', 'j2objc.jar', 'Main', flags, [os.getcwd()],
+        ['a/A.java'])
+
+  def testKeyDependsOnInputContents(self):
+    keys = set([self._Key()])
+    for path in ['a/A.java', 'cp.jar', 'sp/x/S.java', 'system/release',
+                 'boot.jar', 'j2objc.jar']:
+      self._WriteFile(path, 'changed')
+      keys.add(self._Key())
+    self.assertEqual(7, len(keys))
+
+  def testKeyDoesNotDependOnOutputs(self):
+    self.assertEqual(self._Key(), self._Key('other_out', 'other.mapping'))
+
+  def testKeyDependsOnWorkingDirectory(self):
+    key = self._Key()
+    shutil.copytree(os.getcwd(), self._Path('other_execroot'))
+    os.chdir(self._Path('other_execroot'))
+    self.assertNotEqual(key, self._Key())
+
+  def testRestoreCachedTranslation(self):
+    cache_dir = self._Path('cache')
+    out = self._Path('out')
+    self._WriteFile(os.path.join(out, 'a/A.m'), 'A.m')
+    self._WriteFile(os.path.join(out, 'a/A.h'), 'A.h')
+    self._WriteFile('header.mapping', 'a.A=a/A.h\n')
+    j2objc_wrapper.CacheTranslation(cache_dir, 'key', out, 'header.mapping',
+                                    '/tmp/srcjar_root')
+
+    restored = self._Path('restored')
+    os.mkdir(restored)
+    self.assertIsNone(j2objc_wrapper.RestoreCachedTranslation(
+        cache_dir, 'other_key', restored, 'restored.mapping'))
+    self.assertEqual([], os.listdir(restored))
+    self.assertIsNone(j2objc_wrapper.RestoreCachedTranslation(
+        None, 'key', restored, 'restored.mapping'))
+
+    self.assertEqual('/tmp/srcjar_root',
+                     j2objc_wrapper.RestoreCachedTranslation(
+                         cache_dir, 'key', restored, 'restored.mapping'))
+    self.assertEqual('A.m', self._ReadFile(os.path.join(restored, 'a/A.m')))
+    self.assertEqual('A.h', self._ReadFile(os.path.join(restored, 'a/A.h')))
+    self.assertEqual('a.A=a/A.h\n', self._ReadFile('restored.mapping'))
+
+  def _RunWrapper(self, name, cache_dir):
+    java = self._WriteFile(self._Path('java'), FAKE_JAVA)
+    os.chmod(java, os.stat(java).st_mode | stat.S_IEXEC)
+    _WriteJar('gen.srcjar', [('g/G.java', 'class G {}')])
+    out = self._Path(name)
+    os.mkdir(out)
+    argv = ['j2objc_wrapper', '--java', java, '--j2objc', 'j2objc.jar',
+            '--main_class', 'Main', '--objc_file_path', out + '/objc',
+            '--output_dependency_mapping_file', out + '/dep.mapping',
+            '--gen_src_jar', 'gen.srcjar',
+            '--output_gen_source_dir', out + '/gen_srcs',
+            '--output_gen_header_dir', out + '/gen_hdrs',
+            '--cache_dir', cache_dir, '--cache_translations',
+            '-classpath', 'cp.jar', '--output-header-mapping',
+            out + '/header.mapping', 'a/A.java']
+    with mock.patch.object(sys, 'argv', argv):
+      j2objc_wrapper.main()
+    return out
+
+  @mock.patch.dict(os.environ)
+  def testCachedTranslationRenamesGenSrcjarRoot(self):
+    os.environ['FAKE_JAVA_LOG'] = self._Path('java.log')
+    cache_dir = self._Path('cache')
+    first = self._RunWrapper('first', cache_dir)
+    second = self._RunWrapper('second', cache_dir)
+    # J2ObjC only ran once.
+    self.assertEqual('run\n', self._ReadFile(self._Path('java.log')))
+
+    for out in [first, second]:
+      self.assertEqual('// gen.srcjar::g/G.java\n',
+                       self._ReadFile(os.path.join(out, 'gen_srcs/g/G.m')))
+      self.assertEqual('// gen.srcjar::g/G.java\n',
+                       self._ReadFile(os.path.join(out, 'gen_hdrs/g/G.h')))
+      self.assertEqual('// %s/a/A.java\n' % os.getcwd(),
+                       self._ReadFile(os.path.join(out, 'objc/a/A.m')))
+      self.assertEqual('a/A.java=a/A.h\ng/G.java=g/G.h\n',
+                       self._ReadFile(os.path.join(out, 'header.mapping')))
+
+
+if __name__ == '__main__':
+  unittest.main()
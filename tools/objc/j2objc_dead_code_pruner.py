@@ -26,120 +26,287 @@ linking by:
 """
 
 import argparse
-from collections import OrderedDict
+import array
+import hashlib
+import itertools
+import mmap
 import multiprocessing
 import os
 import pipes  # swap to shlex once on Python 3
 import Queue
 import re
 import shutil
+import struct
 import subprocess
+import tempfile
 import threading
 
 PRUNED_SRC_CONTENT = 'static int DUMMY_unused __attribute__((unused,used)) = 0;'
 
+# Archive files, see https://en.wikipedia.org/wiki/Ar_(Unix).
+_AR_MAGIC = '!<arch>\n'
+# Name, timestamp, owner id, group id, mode, size and end of a member header.
+_AR_HEADER = struct.Struct('16s12s6s6s8s10s2s')
+_AR_HEADER_END = '`\n'
+# Offset of the size field in member headers.
+_AR_SIZE_OFFSET = 48
+# Member names that aren't object files: GNU symbol tables and long name table.
+_AR_GNU_SYMBOL_TABLES = {'/': 4, '/SYM64/': 8}
+_AR_GNU_NAME_TABLE = '//'
+# Matches the hash blaze appends to object file names in archives.
+_OBJECT_NAME_HASH_RE = re.compile(r'^(.*)_[0-9a-f]{32}(?:-[0-9]+)?$')
+
+# Header of serialized reachability graphs: magic, then the numbers of nodes,
+# edges and header mapping entries, and the lengths of the node and class name
+# blobs in bytes.
+_GRAPH_MAGIC = 'J2OBJCRG1'
+_GRAPH_HEADER = struct.Struct('<9s5I')
+
+
+class ReachabilityGraph(object):
+  """A dependency graph between translated files, indexed by integers.
+
+  Nodes are translated files, identified by their index in names. The direct
+  dependencies of node i are targets[offsets[i]:offsets[i + 1]]. header_mapping
+  maps Java class names to the nodes of their translated files.
+
+  Graphs can be saved to a binary file, which later actions memory-map instead
+  of parsing the mapping files again.
+  """
 
-def BuildReachabilityTree(dependency_mapping_files, file_open=open):
-  """Builds a reachability tree using entries from dependency mapping files.
+  def __init__(self, names, offsets, targets, header_mapping):
+    self.names = names
+    self.offsets = offsets
+    self.targets = targets
+    self.header_mapping = header_mapping
+    self._ids = None
+
+  @classmethod
+  def FromMappingFiles(cls, dependency_mapping_files, header_mapping_files,
+                       file_open=open):
+    """Builds a graph from J2ObjC-generated mapping files.
+
+    Args:
+      dependency_mapping_files: A comma separated list of J2ObjC-generated
+          dependency mapping files.
+      header_mapping_files: A comma separated list of J2ObjC-generated
+          header mapping files.
+      file_open: Reference to the builtin open function so it may be
+          overridden for testing.
+    Returns:
+      The graph.
+    """
+    names = []
+    ids = {}
+
+    def Id(name):
+      node = ids.get(name)
+      if node is None:
+        node = ids[name] = len(names)
+        names.append(name)
+      return node
+
+    deps = {}
+    if dependency_mapping_files:
+      for filename in dependency_mapping_files.split(','):
+        with file_open(filename, 'r') as f:
+          for line in f:
+            fields = line.strip().split(':', 2)
+            deps.setdefault(Id(fields[0]), []).append(Id(fields[1]))
+
+    header_mapping = {}
+    for header_mapping_file in header_mapping_files.split(','):
+      with file_open(header_mapping_file, 'r') as f:
+        for line in f:
+          fields = line.strip().split('=', 2)
+          header_mapping[fields[0]] = Id(os.path.splitext(fields[1])[0])
+
+    offsets = array.array('i', [0])
+    targets = array.array('i')
+    for node in xrange(len(names)):
+      targets.extend(deps.get(node, ()))
+      offsets.append(len(targets))
+    graph = cls(names, offsets, targets, header_mapping)
+    graph._ids = ids  # pylint: disable=protected-access
+    return graph
+
+  def Save(self, path):
+    """Atomically writes the graph to a file."""
+    class_names = list(self.header_mapping)
+    class_ids = array.array('i', [self.header_mapping[c] for c in class_names])
+    names_blob = '\n'.join(self.names)
+    classes_blob = '\n'.join(class_names)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        f.write(_GRAPH_HEADER.pack(_GRAPH_MAGIC, len(self.names),
+                                   len(self.targets), len(class_names),
+                                   len(names_blob), len(classes_blob)))
+        self.offsets.tofile(f)
+        self.targets.tofile(f)
+        class_ids.tofile(f)
+        f.write(names_blob)
+        f.write(classes_blob)
+      os.rename(tmp_path, path)
+    finally:
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+  @classmethod
+  def Load(cls, path):
+    """Reads a graph written by Save.
+
+    Args:
+      path: The file to read.
+    Returns:
+      The graph.
+    Raises:
+      ValueError: If the file isn't a serialized graph.
+    """
+    with open(path, 'rb') as f:
+      data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      if len(data) < _GRAPH_HEADER.size:
+        raise ValueError('%s is not a reachability graph' % path)
+      (magic, num_nodes, num_edges, num_classes, names_length,
+       classes_length) = _GRAPH_HEADER.unpack_from(data)
+      if magic != _GRAPH_MAGIC:
+        raise ValueError('%s is not a reachability graph' % path)
+      pos = _GRAPH_HEADER.size
+      arrays = []
+      for length in [num_nodes + 1, num_edges, num_classes]:
+        a = array.array('i')
+        end = pos + length * a.itemsize
+        a.fromstring(data[pos:end])
+        arrays.append(a)
+        pos = end
+      names_blob = data[pos:pos + names_length]
+      pos += names_length
+      classes_blob = data[pos:pos + classes_length]
+      if pos + classes_length != len(data):
+        raise ValueError('%s is truncated' % path)
+    finally:
+      data.close()
+    offsets, targets, class_ids = arrays
+    names = names_blob.split('\n') if num_nodes else []
+    class_names = classes_blob.split('\n') if num_classes else []
+    return cls(names, offsets, targets, dict(zip(class_names, class_ids)))
+
+  def ReachableFiles(self, entry_classes, extra_entry_files=()):
+    """Returns the translated files reachable from entry Java classes.
+
+    Args:
+      entry_classes: A comma separated list of Java entry classes.
+      extra_entry_files: More translated files to use as entry points, such as
+          the files with duplicated base names in an archive.
+    Returns:
+      A set of reachable translated files.
+    Raises:
+      Exception: If there is an entry class that is not being transpiled in
+          this j2objc_library.
+    """
+    frontier = []
+    for entry_class in entry_classes.split(','):
+      if entry_class not in self.header_mapping:
+        raise Exception(entry_class +
+                        ' is not in the transitive Java deps of included ' +
+                        'j2objc_library rules.')
+      frontier.append(self.header_mapping[entry_class])
+
+    reachable_files = set()
+    if extra_entry_files:
+      if self._ids is None:
+        self._ids = dict((name, node) for node, name in enumerate(self.names))
+      # Translated files going into the same static library archive with
+      # duplicated base names need to be entry files.
+      #
+      # This edge case is ignored because we currently cannot correctly
+      # perform dead code removal in this case. The object file entries in
+      # static library archives are named by the base names of the original
+      # source files. If two source files (e.g., foo/bar.m, bar/bar.m) go into
+      # the same archive and share the same base name (bar.m), their object
+      # file entries inside the archive will have the same name (bar.o). We
+      # cannot correctly handle this case because current archive tools (ar,
+      # ranlib, etc.) do not handle this case very well.
+      for extra_entry_file in extra_entry_files:
+        # J2ObjC protos are not analyzed for dead code stripping and therefore
+        # are not in the graph at all. They are reachable, but have no deps.
+        reachable_files.add(extra_entry_file)
+        if extra_entry_file in self._ids:
+          frontier.append(self._ids[extra_entry_file])
+
+    # Translated files from package-info.java are also entry files because
+    # they are needed to resolve ObjC class names with prefixes. Only those
+    # with dependencies are in the dependency mapping files.
+    offsets = self.offsets
+    for node, name in enumerate(self.names):
+      if name.endswith('package-info') and offsets[node + 1] > offsets[node]:
+        frontier.append(node)
+
+    reached = bytearray(len(self.names))
+    for node in frontier:
+      reached[node] = 1
+    targets = self.targets
+    while frontier:
+      next_frontier = []
+      for node in frontier:
+        for dep in targets[offsets[node]:offsets[node + 1]]:
+          if not reached[dep]:
+            reached[dep] = 1
+            next_frontier.append(dep)
+      frontier = next_frontier
+
+    reachable_files.update(itertools.compress(self.names, reached))
+    return reachable_files
+
+
+def LoadReachabilityGraph(dependency_mapping_files, header_mapping_files,
+                          cache_dir=None, file_open=open):
+  """Returns the reachability graph of mapping files, cached if possible.
+
+  Graphs are cached by the digest of the mapping files' contents, so actions
+  pruning against the same mapping files only parse them once.
 
   Args:
     dependency_mapping_files: A comma separated list of J2ObjC-generated
         dependency mapping files.
-    file_open: Reference to the builtin open function so it may be
-        overridden for testing.
-  Returns:
-    A dict mapping J2ObjC-generated source files to the corresponding direct
-    dependent source files.
-  """
-  return BuildArtifactSourceTree(dependency_mapping_files, file_open)
-
-
-def BuildHeaderMapping(header_mapping_files, file_open=open):
-  """Builds a mapping between Java classes and J2ObjC-translated header files.
-
-  Args:
     header_mapping_files: A comma separated list of J2ObjC-generated
         header mapping files.
+    cache_dir: The persistent directory to cache graphs in. May be None.
     file_open: Reference to the builtin open function so it may be
         overridden for testing.
   Returns:
-    An ordered dict mapping Java class names to corresponding J2ObjC-translated
-    source files.
+    The graph.
   """
-  header_mapping = OrderedDict()
-  for header_mapping_file in header_mapping_files.split(','):
-    with file_open(header_mapping_file, 'r') as f:
-      for line in f:
-        java_class_name = line.strip().split('=')[0]
-        transpiled_file_name = os.path.splitext(line.strip().split('=')[1])[0]
-        header_mapping[java_class_name] = transpiled_file_name
-  return header_mapping
-
-
-def BuildReachableFileSet(entry_classes, reachability_tree, header_mapping,
-                          archive_source_file_mapping=None):
-  """Builds a set of reachable translated files from entry Java classes.
+  if not cache_dir:
+    return ReachabilityGraph.FromMappingFiles(
+        dependency_mapping_files, header_mapping_files, file_open)
+
+  digest = hashlib.sha256()
+  for files in [dependency_mapping_files, header_mapping_files]:
+    digest.update('%d:' % len(files or ''))
+    for filename in (files or '').split(','):
+      if filename:
+        with file_open(filename, 'rb') as f:
+          content = f.read()
+        digest.update('%d:' % len(content))
+        digest.update(content)
+  graph_file = os.path.join(cache_dir, 'graphs', digest.hexdigest())
 
-  Args:
-    entry_classes: A comma separated list of Java entry classes.
-    reachability_tree: A dict mapping translated files to their direct
-        dependencies.
-    header_mapping: A dict mapping Java class names to translated source files.
-    archive_source_file_mapping: A dict mapping source files to the associated
-        archive file that contains them.
-  Returns:
-    A set of reachable translated files from the given list of entry classes.
-  Raises:
-    Exception: If there is an entry class that is not being transpiled in this
-        j2objc_library.
-  """
-  transpiled_entry_files = []
-  for entry_class in entry_classes.split(','):
-    if entry_class not in header_mapping:
-      raise Exception(entry_class +
-                      ' is not in the transitive Java deps of included ' +
-                      'j2objc_library rules.')
-    transpiled_entry_files.append(header_mapping[entry_class])
-
-  # Translated files going into the same static library archive with duplicated
-  # base names also need to be added to the set of entry files.
-  #
-  # This edge case is ignored because we currently cannot correctly perform
-  # dead code removal in this case. The object file entries in static library
-  # archives are named by the base names of the original source files. If two
-  # source files (e.g., foo/bar.m, bar/bar.m) go into the same archive and
-  # share the same base name (bar.m), their object file entries inside the
-  # archive will have the same name (bar.o). We cannot correctly handle this
-  # case because current archive tools (ar, ranlib, etc.) do not handle this
-  # case very well.
-  if archive_source_file_mapping:
-    transpiled_entry_files.extend(_DuplicatedFiles(archive_source_file_mapping))
-
-  # Translated files from package-info.java are also added to the entry files
-  # because they are needed to resolve ObjC class names with prefixes and these
-  # files may also have dependencies.
-  for transpiled_file in reachability_tree:
-    if transpiled_file.endswith('package-info'):
-      transpiled_entry_files.append(transpiled_file)
-
-  reachable_files = set()
-  for transpiled_entry_file in transpiled_entry_files:
-    reachable_files.add(transpiled_entry_file)
-    current_level_deps = []
-    # We need to check if the transpiled file is in the reachability tree
-    # because J2ObjC protos are not analyzed for dead code stripping and
-    # therefore are not in the reachability tree at all.
-    if transpiled_entry_file in reachability_tree:
-      current_level_deps = reachability_tree[transpiled_entry_file]
-    while current_level_deps:
-      next_level_deps = []
-      for dep in current_level_deps:
-        if dep not in reachable_files:
-          reachable_files.add(dep)
-          if dep in reachability_tree:
-            next_level_deps.extend(reachability_tree[dep])
-      current_level_deps = next_level_deps
-  return reachable_files
+  try:
+    return ReachabilityGraph.Load(graph_file)
+  except (IOError, OSError, ValueError):
+    pass
+  graph = ReachabilityGraph.FromMappingFiles(
+      dependency_mapping_files, header_mapping_files, file_open)
+  try:
+    if not os.path.isdir(os.path.dirname(graph_file)):
+      os.makedirs(os.path.dirname(graph_file))
+    graph.Save(graph_file)
+  except (IOError, OSError):
+    # The cache is only an optimization.
+    pass
+  return graph
 
 
 def PruneFiles(input_files, output_files, objc_file_path, reachable_files,
@@ -241,7 +408,7 @@ def BuildArchiveSourceFileMapping(archive_source_mapping_files, file_open):
 
 def PruneSourceFiles(input_files, output_files, dependency_mapping_files,
                      header_mapping_files, entry_classes, objc_file_path,
-                     file_open=open, file_shutil=shutil):
+                     file_open=open, file_shutil=shutil, cache_dir=None):
   """Copies over translated files and remove the contents of unreachable files.
 
   Args:
@@ -261,13 +428,11 @@ def PruneSourceFiles(input_files, output_files, dependency_mapping_files,
         overridden for testing.
     file_shutil: Reference to the builtin shutil module so it may be
         overridden for testing.
+    cache_dir: The directory to cache reachability graphs in. May be None.
   """
-  reachability_file_mapping = BuildReachabilityTree(
-      dependency_mapping_files, file_open)
-  header_map = BuildHeaderMapping(header_mapping_files, file_open)
-  reachable_files_set = BuildReachableFileSet(entry_classes,
-                                              reachability_file_mapping,
-                                              header_map)
+  reachable_files_set = LoadReachabilityGraph(
+      dependency_mapping_files, header_mapping_files, cache_dir,
+      file_open).ReachableFiles(entry_classes)
   PruneFiles(input_files,
              output_files,
              objc_file_path,
@@ -300,10 +465,237 @@ def MatchObjectNamesInArchive(xcrunwrapper, archive, object_names):
                     flags=re.MULTILINE)
 
 
+class ArchiveError(Exception):
+  """Raised when an archive can't be pruned in-process."""
+
+
+class _ArMember(object):
+  """A member of an archive file.
+
+  Attributes:
+    offset: The offset of the member's header in the archive.
+    header: The member's header, as read from the archive.
+    name: The member's name, with long names resolved.
+    size: The size of the member's data, including a BSD long name.
+    name_size: The size of the BSD long name at the start of the data.
+  """
+
+  __slots__ = ['offset', 'header', 'name', 'size', 'name_size']
+
+  def __init__(self, offset, header, name, size, name_size):
+    self.offset = offset
+    self.header = header
+    self.name = name
+    self.size = size
+    self.name_size = name_size
+
+  def PaddedSize(self):
+    """Returns the size of the member in the archive, including its header."""
+    return _AR_HEADER.size + self.size + self.size % 2
+
+
+def _ReadArMembers(f):
+  """Reads the member headers of an archive, skipping over their data.
+
+  Supports the GNU and BSD (including Darwin) variants of the format. The
+  parsing follows tools/build_defs/pkg/archive.py, which can't be imported
+  here because this script runs on its own.
+
+  Args:
+    f: The archive file, opened for binary reading.
+  Returns:
+    A list of _ArMember.
+  Raises:
+    ArchiveError: If f isn't a supported archive.
+  """
+  if f.read(len(_AR_MAGIC)) != _AR_MAGIC:
+    raise ArchiveError('Not an ar file')
+  file_size = os.fstat(f.fileno()).st_size
+  members = []
+  long_names = None
+  offset = len(_AR_MAGIC)
+  # Some files contain garbage bytes at the end of the archive, ignore them.
+  while offset + _AR_HEADER.size <= file_size:
+    f.seek(offset)
+    header = f.read(_AR_HEADER.size)
+    fields = _AR_HEADER.unpack(header)
+    if fields[6] != _AR_HEADER_END:
+      raise ArchiveError('Invalid AR file header')
+    raw_name = fields[0].rstrip(' ')
+    try:
+      size = int(fields[5].strip())
+      name_size = 0
+      if raw_name.startswith('#1/'):
+        # BSD long name, stored at the start of the data.
+        name_size = int(raw_name[3:])
+        name = f.read(name_size).rstrip('\0')
+      elif raw_name in _AR_GNU_SYMBOL_TABLES or raw_name == _AR_GNU_NAME_TABLE:
+        name = raw_name
+      elif raw_name.startswith('/'):
+        # GNU long name, stored in the long name table.
+        if long_names is None:
+          raise ArchiveError('Long name without a long name table')
+        start = int(raw_name[1:])
+        name = long_names[start:long_names.index('/\n', start)]
+      elif raw_name.endswith('/'):
+        name = raw_name[:-1]
+      else:
+        name = raw_name
+    except ValueError:
+      raise ArchiveError('Invalid AR file header')
+    if not 0 <= name_size <= size:
+      raise ArchiveError('Invalid AR file header')
+    if name == _AR_GNU_NAME_TABLE:
+      long_names = f.read(size)
+    members.append(_ArMember(offset, header, name, size, name_size))
+    offset += members[-1].PaddedSize()
+  return members
+
+
+def _FilterSymbolTable(member, data, new_offsets):
+  """Returns a symbol table with only the symbols of kept members.
+
+  Args:
+    member: The symbol table member.
+    data: The symbol table, without a BSD long name.
+    new_offsets: Maps the offsets of kept members in the input archive to their
+        offsets in the output archive.
+  Returns:
+    The new symbol table.
+  Raises:
+    ArchiveError: If the symbol table has an unknown format or is malformed.
+  """
+  try:
+    return _FilterKnownSymbolTable(member, data, new_offsets)
+  except (IndexError, struct.error):
+    raise ArchiveError('Malformed symbol table ' + member.name)
+
+
+def _FilterKnownSymbolTable(member, data, new_offsets):
+  """Like _FilterSymbolTable, but doesn't check that data is well-formed."""
+  if member.name in _AR_GNU_SYMBOL_TABLES:
+    # Big endian count, member offsets, then null terminated symbol names.
+    width = _AR_GNU_SYMBOL_TABLES[member.name]
+    int_format = '>I' if width == 4 else '>Q'
+    count = struct.unpack_from(int_format, data)[0]
+    offsets = struct.unpack_from('>%d%s' % (count, int_format[1]), data, width)
+    names = data[width * (count + 1):].split('\0')[:count]
+    kept = [(new_offsets[offset], name)
+            for offset, name in zip(offsets, names) if offset in new_offsets]
+    return (struct.pack(int_format, len(kept)) +
+            struct.pack('>%d%s' % (len(kept), int_format[1]),
+                        *[offset for offset, _ in kept]) +
+            ''.join(name + '\0' for _, name in kept))
+  if member.name.startswith('__.SYMDEF'):
+    # Size of the ranlib array, (name index, member offset) pairs, size of the
+    # string table, then the string table, all little endian on Darwin.
+    width = 8 if member.name.startswith('__.SYMDEF_64') else 4
+    int_format = '<I' if width == 4 else '<Q'
+    ranlib_size = struct.unpack_from(int_format, data)[0]
+    ranlib = struct.unpack_from(
+        '<%d%s' % (ranlib_size // width, int_format[1]), data, width)
+    kept = []
+    for i in xrange(0, len(ranlib), 2):
+      if ranlib[i + 1] in new_offsets:
+        kept.extend([ranlib[i], new_offsets[ranlib[i + 1]]])
+    strings = data[width + ranlib_size:]
+    return (struct.pack(int_format, len(kept) * width) +
+            struct.pack('<%d%s' % (len(kept), int_format[1]), *kept) +
+            strings)
+  raise ArchiveError('Unknown symbol table ' + member.name)
+
+
+def _IsSymbolTable(member):
+  return (member.name in _AR_GNU_SYMBOL_TABLES or
+          member.name.startswith('__.SYMDEF'))
+
+
+def _IsUnreachableObject(member, unreachable_object_names):
+  """Returns whether an archive member is an unreachable object file."""
+  stem, ext = os.path.splitext(member.name)
+  if ext != '.o':
+    return False
+  if stem in unreachable_object_names:
+    return True
+  # See MatchObjectNamesInArchive.
+  match = _OBJECT_NAME_HASH_RE.match(stem)
+  return bool(match) and match.group(1) in unreachable_object_names
+
+
+def _CopyRange(src, dest, offset, size):
+  src.seek(offset)
+  while size > 0:
+    data = src.read(min(size, 1 << 20))
+    if not data:
+      raise ArchiveError('Truncated archive')
+    dest.write(data)
+    size -= len(data)
+
+
+def RemoveArchiveMembers(input_archive, output_archive,
+                         unreachable_object_names):
+  """Writes a copy of an archive without unreachable object files.
+
+  The input archive is read once. Other members are copied as is, and the
+  symbol table is rewritten to only list the symbols of kept members, at their
+  new offsets. This replaces ar -d and ranlib.
+
+  Args:
+    input_archive: The archive to prune.
+    output_archive: The location of the pruned archive file.
+    unreachable_object_names: A set of the basenames of the objects to remove,
+        sans extension, which may have a hash appended in the archive.
+  Raises:
+    ArchiveError: If the archive has an unsupported format.
+  """
+  with open(input_archive, 'rb') as src:
+    members = _ReadArMembers(src)
+    kept = [
+        member for member in members
+        if not _IsUnreachableObject(member, unreachable_object_names)
+    ]
+
+    # The size of the symbol table only depends on which members are kept, so
+    # lay out the output with placeholder offsets first.
+    symbol_tables = {}
+    for member in kept:
+      if _IsSymbolTable(member):
+        src.seek(member.offset + _AR_HEADER.size + member.name_size)
+        symbol_tables[member.offset] = src.read(member.size - member.name_size)
+    new_offsets = dict((member.offset, 0) for member in kept)
+    sizes = {}
+    for offset, data in symbol_tables.items():
+      member = next(m for m in kept if m.offset == offset)
+      sizes[offset] = member.name_size + len(
+          _FilterSymbolTable(member, data, new_offsets))
+    position = len(_AR_MAGIC)
+    for member in kept:
+      new_offsets[member.offset] = position
+      size = sizes.get(member.offset, member.size)
+      position += _AR_HEADER.size + size + size % 2
+
+    with open(output_archive, 'wb') as dest:
+      dest.write(_AR_MAGIC)
+      for member in kept:
+        if member.offset not in symbol_tables:
+          _CopyRange(src, dest, member.offset, member.PaddedSize())
+          continue
+        data = _FilterSymbolTable(member, symbol_tables[member.offset],
+                                  new_offsets)
+        size = member.name_size + len(data)
+        dest.write(member.header[:_AR_SIZE_OFFSET] + ('%-10d' % size) +
+                   member.header[_AR_SIZE_OFFSET + 10:])
+        _CopyRange(src, dest, member.offset + _AR_HEADER.size,
+                   member.name_size)
+        dest.write(data)
+        if size % 2:
+          dest.write('\n')
+
+
 def PruneArchiveFile(input_archive, output_archive, dummy_archive,
                      dependency_mapping_files, header_mapping_files,
                      archive_source_mapping_files, entry_classes, xcrunwrapper,
-                     file_open=open):
+                     file_open=open, cache_dir=None):
   """Remove unreachable objects from archive file.
 
   Args:
@@ -320,21 +712,17 @@ def PruneArchiveFile(input_archive, output_archive, dummy_archive,
     xcrunwrapper: A wrapper script over xcrun.
     file_open: Reference to the builtin open function so it may be
         overridden for testing.
+    cache_dir: The directory to cache reachability graphs in. May be None.
   """
-  reachability_file_mapping = BuildReachabilityTree(
-      dependency_mapping_files, file_open)
-  header_map = BuildHeaderMapping(header_mapping_files, file_open)
   archive_source_file_mapping = BuildArchiveSourceFileMapping(
       archive_source_mapping_files, file_open)
-  reachable_files_set = BuildReachableFileSet(entry_classes,
-                                              reachability_file_mapping,
-                                              header_map,
-                                              archive_source_file_mapping)
+  # Translated files going into the same static library archive with
+  # duplicated base names are entry files too, see ReachableFiles.
+  reachable_files_set = LoadReachabilityGraph(
+      dependency_mapping_files, header_mapping_files, cache_dir,
+      file_open).ReachableFiles(entry_classes,
+                                _DuplicatedFiles(archive_source_file_mapping))
 
-  # Copy the current processes' environment, as xcrunwrapper depends on these
-  # variables.
-  cmd_env = dict(os.environ)
-  j2objc_cmd = ''
   if input_archive in archive_source_file_mapping:
     source_files = archive_source_file_mapping[input_archive]
     unreachable_object_names = []
@@ -349,35 +737,59 @@ def PruneArchiveFile(input_archive, output_archive, dummy_archive,
       # If all objects in the archive are unreachable, just copy over a dummy
       # archive that contains no object
       if len(unreachable_object_names) == len(source_files):
-        j2objc_cmd = 'cp %s %s' % (pipes.quote(dummy_archive),
-                                   pipes.quote(output_archive))
+        shutil.copyfile(dummy_archive, output_archive)
       # Else we need to prune the archive of unreachable objects
       else:
-        cmd_env['ZERO_AR_DATE'] = '1'
-        # Copy the input archive to the output location
-        j2objc_cmd += 'cp %s %s && ' % (pipes.quote(input_archive),
-                                        pipes.quote(output_archive))
-        # Make the output archive editable
-        j2objc_cmd += 'chmod +w %s && ' % (pipes.quote(output_archive))
-        # Remove the unreachable objects from the archive
-        unreachable_object_names = MatchObjectNamesInArchive(
-            xcrunwrapper, input_archive, unreachable_object_names)
-        j2objc_cmd += '%s ar -d -s %s %s && ' % (
-            pipes.quote(xcrunwrapper),
-            pipes.quote(output_archive),
-            ' '.join(pipes.quote(uon) for uon in unreachable_object_names))
-        # Update the table of content of the archive file
-        j2objc_cmd += '%s ranlib %s' % (pipes.quote(xcrunwrapper),
-                                        pipes.quote(output_archive))
+        try:
+          RemoveArchiveMembers(input_archive, output_archive,
+                               set(unreachable_object_names))
+        except ArchiveError:
+          _RemoveArchiveMembersWithAr(input_archive, output_archive,
+                                      unreachable_object_names, xcrunwrapper)
     # There are no unreachable objects, we just copy over the original archive
     else:
-      j2objc_cmd = 'cp %s %s' % (pipes.quote(input_archive),
-                                 pipes.quote(output_archive))
+      shutil.copyfile(input_archive, output_archive)
   # The archive cannot be pruned by J2ObjC dead code removal, just copy over
   # the original archive
   else:
-    j2objc_cmd = 'cp %s %s' % (pipes.quote(input_archive),
-                               pipes.quote(output_archive))
+    shutil.copyfile(input_archive, output_archive)
+
+  # "Touch" the output file.
+  # Prevents a pre-Xcode-8 bug in which passing zero-date archive files to ld
+  # would cause ld to error.
+  os.utime(output_archive, None)
+
+
+def _RemoveArchiveMembersWithAr(input_archive, output_archive,
+                                unreachable_object_names, xcrunwrapper):
+  """Like RemoveArchiveMembers, but using ar and ranlib.
+
+  Args:
+    input_archive: The archive to prune.
+    output_archive: The location of the pruned archive file.
+    unreachable_object_names: A list of the basenames of the objects to remove,
+        sans extension.
+    xcrunwrapper: A wrapper script over xcrun.
+  """
+  # Copy the current processes' environment, as xcrunwrapper depends on these
+  # variables.
+  cmd_env = dict(os.environ)
+  cmd_env['ZERO_AR_DATE'] = '1'
+  # Copy the input archive to the output location
+  j2objc_cmd = 'cp %s %s && ' % (pipes.quote(input_archive),
+                                 pipes.quote(output_archive))
+  # Make the output archive editable
+  j2objc_cmd += 'chmod +w %s && ' % (pipes.quote(output_archive))
+  # Remove the unreachable objects from the archive
+  unreachable_object_names = MatchObjectNamesInArchive(
+      xcrunwrapper, input_archive, unreachable_object_names)
+  j2objc_cmd += '%s ar -d -s %s %s && ' % (
+      pipes.quote(xcrunwrapper),
+      pipes.quote(output_archive),
+      ' '.join(pipes.quote(uon) for uon in unreachable_object_names))
+  # Update the table of content of the archive file
+  j2objc_cmd += '%s ranlib %s' % (pipes.quote(xcrunwrapper),
+                                  pipes.quote(output_archive))
 
   try:
     subprocess.check_output(
@@ -386,11 +798,6 @@ def PruneArchiveFile(input_archive, output_archive, dummy_archive,
     raise Exception(
         'executing command failed: %s (%s)' % (j2objc_cmd, e.strerror))
 
-  # "Touch" the output file.
-  # Prevents a pre-Xcode-8 bug in which passing zero-date archive files to ld
-  # would cause ld to error.
-  os.utime(output_archive, None)
-
 
 def BuildArtifactSourceTree(files, file_open=open):
   """Builds a dependency tree using from dependency mapping files.
@@ -464,6 +871,11 @@ if __name__ == '__main__':
   parser.add_argument(
       '--xcrunwrapper',
       help=('The xcrun wrapper script.'))
+  parser.add_argument(
+      '--cache_dir',
+      help=('A persistent directory to cache reachability graphs in, across '
+            'actions. It must be writable by the action, i.e. outside of any '
+            'sandbox. Nothing is cached by default.'))
 
   args = parser.parse_args()
 
@@ -480,7 +892,8 @@ if __name__ == '__main__':
         args.header_mapping_files,
         args.archive_source_mapping_files,
         args.entry_classes,
-        args.xcrunwrapper)
+        args.xcrunwrapper,
+        cache_dir=args.cache_dir)
   else:
     # TODO(rduan): Remove once J2ObjC compile actions are fully moved to the
     # edges.
@@ -490,4 +903,5 @@ if __name__ == '__main__':
         args.dependency_mapping_files,
         args.header_mapping_files,
         args.entry_classes,
-        args.objc_file_path)
+        args.objc_file_path,
+        cache_dir=args.cache_dir)
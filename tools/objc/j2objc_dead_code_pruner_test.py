@@ -0,0 +1,262 @@
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for j2objc_dead_code_pruner."""
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from third_party.py import mock
+from tools.objc import j2objc_dead_code_pruner
+
+DEPENDENCY_MAPPING = """a/A:a/B
+a/A:a/C
+a/B:a/C
+a/C:a/A
+a/D:a/E
+a/package-info:p/P
+b/package-info:b/F
+"""
+
+HEADER_MAPPING = """com.a.A=a/A.h
+com.a.D=a/D.h
+com.p.Proto=p/Proto.h
+"""
+
+PACKAGE_INFO_FILES = set(['a/package-info', 'p/P', 'b/package-info', 'b/F'])
+
+HASH = '0123456789abcdef0123456789abcdef'
+
+
+def _ArHeader(name, size):
+  return '%-16s%-12s%-6s%-6s%-8s%-10d`\n' % (name, '0', '0', '0', '644', size)
+
+
+def _ArMember(name, data):
+  return _ArHeader(name, len(data)) + data + '\n' * (len(data) % 2)
+
+
+def GnuArchive(members, symbols, long_names=None):
+  """Returns a GNU archive, like ar rcs would write it.
+
+  Args:
+    members: A list of (name, data) of the object files.
+    symbols: A list of (symbol, member name) for the symbol table.
+    long_names: The names in the long name table. Defaults to the member names
+        that don't fit in a header.
+  Returns:
+    The archive.
+  """
+  if long_names is None:
+    long_names = [name for name, _ in members if len(name) > 15]
+  name_table = ''.join(name + '/\n' for name in long_names)
+  header_names = []
+  for name, _ in members:
+    if name in long_names:
+      header_names.append('/%d' % name_table.index(name + '/\n'))
+    else:
+      header_names.append(name + '/')
+
+  symbol_table_size = (4 * (len(symbols) + 1) +
+                       sum(len(symbol) + 1 for symbol, _ in symbols))
+  offset = 8 + len(_ArMember('/', 'x' * symbol_table_size))
+  if name_table:
+    offset += len(_ArMember('//', name_table))
+  offsets = {}
+  for header_name, (name, data) in zip(header_names, members):
+    offsets[name] = offset
+    offset += len(_ArMember(header_name, data))
+  symbol_table = (
+      struct.pack('>I', len(symbols)) +
+      ''.join(struct.pack('>I', offsets[name]) for _, name in symbols) +
+      ''.join(symbol + '\0' for symbol, _ in symbols))
+
+  archive = '!<arch>\n' + _ArMember('/', symbol_table)
+  if name_table:
+    archive += _ArMember('//', name_table)
+  for header_name, (_, data) in zip(header_names, members):
+    archive += _ArMember(header_name, data)
+  return archive
+
+
+class ReachabilityGraphTest(unittest.TestCase):
+
+  def setUp(self):
+    super(ReachabilityGraphTest, self).setUp()
+    self._dir = tempfile.mkdtemp(dir=os.environ.get('TEST_TMPDIR'))
+    self._dependency_mapping = self._WriteFile('dep.mapping',
+                                               DEPENDENCY_MAPPING)
+    self._header_mapping = self._WriteFile('header.mapping', HEADER_MAPPING)
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+    super(ReachabilityGraphTest, self).tearDown()
+
+  def _WriteFile(self, name, content):
+    path = os.path.join(self._dir, name)
+    with open(path, 'w') as f:
+      f.write(content)
+    return path
+
+  def _Graph(self):
+    return j2objc_dead_code_pruner.ReachabilityGraph.FromMappingFiles(
+        self._dependency_mapping, self._header_mapping)
+
+  def _AssertReachableFiles(self, graph):
+    # Package-info files with dependencies are entry files too.
+    self.assertEqual(set(['a/A', 'a/B', 'a/C']) | PACKAGE_INFO_FILES,
+                     graph.ReachableFiles('com.a.A'))
+    self.assertEqual(set(['a/D', 'a/E']) | PACKAGE_INFO_FILES,
+                     graph.ReachableFiles('com.a.D'))
+    # Classes without dependencies, like J2ObjC protos, are reachable.
+    self.assertEqual(set(['p/Proto']) | PACKAGE_INFO_FILES,
+                     graph.ReachableFiles('com.p.Proto'))
+    self.assertEqual(set(['a/B', 'a/C', 'a/A', 'a/D', 'a/E', 'x/Unknown']) |
+                     PACKAGE_INFO_FILES,
+                     graph.ReachableFiles('com.a.D', ['a/B', 'x/Unknown']))
+
+  def testReachableFiles(self):
+    self._AssertReachableFiles(self._Graph())
+
+  def testUnknownEntryClass(self):
+    with self.assertRaisesRegexp(Exception, 'com.a.Unknown is not in the'):
+      self._Graph().ReachableFiles('com.a.A,com.a.Unknown')
+
+  def testSaveAndLoad(self):
+    graph_file = os.path.join(self._dir, 'graph')
+    self._Graph().Save(graph_file)
+    graph = j2objc_dead_code_pruner.ReachabilityGraph.Load(graph_file)
+    self.assertEqual(self._Graph().names, graph.names)
+    self._AssertReachableFiles(graph)
+
+  def testLoadInvalidGraph(self):
+    graph_file = self._WriteFile('graph', 'not a graph')
+    with self.assertRaises(ValueError):
+      j2objc_dead_code_pruner.ReachabilityGraph.Load(graph_file)
+
+  def testLoadReachabilityGraphCachesGraphs(self):
+    cache_dir = os.path.join(self._dir, 'cache')
+    graph = j2objc_dead_code_pruner.LoadReachabilityGraph(
+        self._dependency_mapping, self._header_mapping, cache_dir)
+    self._AssertReachableFiles(graph)
+    self.assertEqual(1, len(os.listdir(os.path.join(cache_dir, 'graphs'))))
+    graph = j2objc_dead_code_pruner.LoadReachabilityGraph(
+        self._dependency_mapping, self._header_mapping, cache_dir)
+    self._AssertReachableFiles(graph)
+
+
+class RemoveArchiveMembersTest(unittest.TestCase):
+
+  def setUp(self):
+    super(RemoveArchiveMembersTest, self).setUp()
+    self._dir = tempfile.mkdtemp(dir=os.environ.get('TEST_TMPDIR'))
+    self._input = os.path.join(self._dir, 'input.a')
+    self._output = os.path.join(self._dir, 'output.a')
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+    super(RemoveArchiveMembersTest, self).tearDown()
+
+  def _AssertPruned(self, archive, unreachable_object_names, expected):
+    with open(self._input, 'wb') as f:
+      f.write(archive)
+    j2objc_dead_code_pruner.RemoveArchiveMembers(
+        self._input, self._output, set(unreachable_object_names))
+    with open(self._output, 'rb') as f:
+      self.assertEqual(expected, f.read())
+
+  def testShortNames(self):
+    # Odd sizes are padded.
+    a = ('a.o', 'a data')
+    b = ('b.o', 'b object data')
+    c = ('c.o', 'c data!')
+    self._AssertPruned(
+        GnuArchive([a, b, c], [('_a', 'a.o'), ('_b1', 'b.o'), ('_b2', 'b.o'),
+                               ('_c', 'c.o')]),
+        ['b'],
+        GnuArchive([a, c], [('_a', 'a.o'), ('_c', 'c.o')]))
+
+  def testLongNames(self):
+    short = ('x.o', 'x data')
+    first = ('a_very_long_object_name.o', 'first data')
+    second = ('another_very_long_name.o', 'second data')
+    long_names = [first[0], second[0]]
+    # The long name table is copied as is.
+    self._AssertPruned(
+        GnuArchive([short, first, second],
+                   [('_x', short[0]), ('_first', first[0]),
+                    ('_second', second[0])]),
+        ['a_very_long_object_name', 'x'],
+        GnuArchive([second], [('_second', second[0])], long_names))
+
+  def testHashedNames(self):
+    hashed = ('Foo_%s.o' % HASH, 'foo')
+    numbered = ('Bar_%s-1.o' % HASH, 'bar')
+    not_hashed = ('Foo_x.o', 'foo x')
+    kept = ('Baz_%s.o' % HASH, 'baz')
+    long_names = [hashed[0], numbered[0], kept[0]]
+    self._AssertPruned(
+        GnuArchive([hashed, numbered, not_hashed, kept],
+                   [('_foo', hashed[0]), ('_bar', numbered[0]),
+                    ('_foo_x', not_hashed[0]), ('_baz', kept[0])]),
+        ['Foo', 'Bar'],
+        GnuArchive([not_hashed, kept],
+                   [('_foo_x', not_hashed[0]), ('_baz', kept[0])],
+                   long_names))
+
+  def testMalformedArchives(self):
+    archive = GnuArchive([('a.o', 'a data'), ('b.o', 'b data')],
+                         [('_a', 'a.o'), ('_b', 'b.o')])
+    malformed_size = archive.replace(_ArHeader('a.o/', 6),
+                                     _ArHeader('a.o/', 6)[:48] + 'six       ' +
+                                     '`\n')
+    negative_size = archive.replace(_ArHeader('a.o/', 6),
+                                    _ArHeader('a.o/', -6))
+    truncated_symbol_table = archive.replace(struct.pack('>I', 2),
+                                             struct.pack('>I', 1000), 1)
+    unknown_long_name = archive.replace('a.o/' + ' ' * 12, '/0' + ' ' * 14)
+    for malformed in [malformed_size, negative_size, truncated_symbol_table,
+                      unknown_long_name, 'not an archive']:
+      with open(self._input, 'wb') as f:
+        f.write(malformed)
+      with self.assertRaises(j2objc_dead_code_pruner.ArchiveError):
+        j2objc_dead_code_pruner.RemoveArchiveMembers(
+            self._input, self._output, set(['b']))
+
+  @mock.patch.object(j2objc_dead_code_pruner, '_RemoveArchiveMembersWithAr')
+  def testPruneArchiveFileFallsBackToAr(self, remove_with_ar):
+    remove_with_ar.side_effect = (
+        lambda input_archive, output_archive, *_: shutil.copyfile(
+            input_archive, output_archive))
+    with open(self._input, 'wb') as f:
+      f.write('!<arch>\n' + _ArHeader('a.o/', 6)[:48] + 'six       `\n')
+    mapping_files = []
+    for name, content in [('dep', 'a/a:a/c\n'), ('header', 'com.A=a/a.h\n'),
+                          ('archive', '%s:a/a.m\n%s:b/b.m\n' %
+                           (self._input, self._input))]:
+      mapping_files.append(os.path.join(self._dir, name + '.mapping'))
+      with open(mapping_files[-1], 'w') as f:
+        f.write(content)
+    j2objc_dead_code_pruner.PruneArchiveFile(
+        self._input, self._output, None, mapping_files[0], mapping_files[1],
+        mapping_files[2], 'com.A', 'xcrunwrapper')
+    remove_with_ar.assert_called_once_with(self._input, self._output, ['b'],
+                                           'xcrunwrapper')
+
+
+if __name__ == '__main__':
+  unittest.main()